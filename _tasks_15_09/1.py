@@ -1,4 +1,7 @@
-from functools import reduce
+import argparse
+from functools import partial
+
+from aggregate import aggregation, run_report, merge_groups, GroupStats, BACKENDS
 
 students = [
     {"name": "Alice", "age": 20, "grades": [85, 90, 88, 92]},
@@ -7,35 +10,38 @@ students = [
 ]
 
 target_age = None
-# фильтрация по возрасту (target_age != None)
-filtered_students = list(filter(lambda s: s["age"] == target_age if target_age is not None else True, students))
 
 # средний балл для каждого
 def average(grades):
     return sum(grades) / len(grades) if grades else 0
 
-students_with_avg = list(map(lambda s: {**s, "avg_grade": average(s["grades"])}, filtered_students))
-
-# средний балл по всем студентам
-if students_with_avg:
-    overall_avg = reduce(lambda acc, s: acc + s["avg_grade"], students_with_avg, 0) / len(students_with_avg)
-else:
-    overall_avg = 0
-
-# макс средний балл
-if students_with_avg:
-    max_avg = max(map(lambda s: s["avg_grade"], students_with_avg))
-
-
-# найти студента с максимальным средним баллом
-top_students = list(filter(lambda s: s["avg_grade"] == max_avg, students_with_avg))
-
-print("All students with their average grades:")
-for s in students_with_avg:
-    print(f"{s['name']} (age {s['age']}): average grade = {s['avg_grade']:.2f}")
-
-print(f"\nAverage grade for all filtered students: {overall_avg:.2f}")
-
-print("Students with the highest average grade:")
-for s in top_students:
-    print(f"{s['name']} (age {s['age']}): average grade = {s['avg_grade']:.2f}")
+# один проход: фильтр по возрасту, средний балл, общая сумма, максимум и лучшие студенты
+def students_report(records, emit, target_age=None, backend='python'):
+    agg = aggregation(backend,
+                      value=lambda s: average(s["grades"]),
+                      where=(lambda s: s["age"] == target_age) if target_age is not None else None,
+                      item=lambda s: (s["name"], s["age"]))
+    for s in records:
+        avg_grade = agg.add(s)
+        if avg_grade is not None:
+            emit(f"{s['name']} (age {s['age']}): average grade = {avg_grade:.2f}")
+    return agg.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Average grades of students")
+    parser.add_argument("data", nargs="?", help="JSONL file with students (default: built-in list)")
+    parser.add_argument("--age", type=int, default=target_age, help="only students of this age")
+    parser.add_argument("--workers", type=int, default=1, help="processes for a JSONL file")
+    parser.add_argument("--backend", choices=BACKENDS, default="python")
+    args = parser.parse_args()
+
+    print("All students with their average grades:")
+    report = partial(students_report, target_age=args.age, backend=args.backend)
+    stats = merge_groups(run_report(args.data or students, report, args.workers)).get(None, GroupStats())
+
+    print(f"\nAverage grade for all filtered students: {stats.avg:.2f}")
+
+    print("Students with the highest average grade:")
+    for name, age in stats.top:
+        print(f"{name} (age {age}): average grade = {stats.max:.2f}")
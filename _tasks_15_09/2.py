@@ -1,4 +1,7 @@
-from functools import reduce
+import argparse
+from functools import partial
+
+from aggregate import aggregation, run_report, merge_groups, GroupStats, BACKENDS
 
 users = [
     {"name": "Alice", "expenses": [100, 50, 75, 200]},
@@ -10,17 +13,27 @@ users = [
 def total_expenses(expenses):
     return sum(expenses)
 
-# общая сумма > 300
-filtered_users = list(filter(lambda u: total_expenses(u["expenses"]) > 300, users))
+# один проход: сумма расходов каждого, порог > 300 и общая сумма отфильтрованных
+def expenses_report(records, emit, threshold=300, backend='python'):
+    agg = aggregation(backend, value=lambda u: total_expenses(u["expenses"]), above=threshold,
+                      item=lambda u: u["name"])
+    for u in records:
+        total = agg.add(u)
+        if total is not None:
+            emit(f"{u['name']}: total expenses = {total}")
+    return agg.finish()
 
-# считаем общую сумму расходов для каждого
-users_with_total = list(map(lambda u: {**u, "total_expenses": total_expenses(u["expenses"])}, filtered_users))
 
-# сумма расходов всех отфильтрованных юзеров
-overall_expenses = reduce(lambda acc, u: acc + u["total_expenses"], users_with_total, 0)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Total expenses of users")
+    parser.add_argument("data", nargs="?", help="JSONL file with users (default: built-in list)")
+    parser.add_argument("--threshold", type=float, default=300, help="only users who spent more")
+    parser.add_argument("--workers", type=int, default=1, help="processes for a JSONL file")
+    parser.add_argument("--backend", choices=BACKENDS, default="python")
+    args = parser.parse_args()
 
-print("Filtered users with their total expenses:")
-for u in users_with_total:
-    print(f"{u['name']}: total expenses = {u['total_expenses']}")
+    print("Filtered users with their total expenses:")
+    report = partial(expenses_report, threshold=args.threshold, backend=args.backend)
+    stats = merge_groups(run_report(args.data or users, report, args.workers)).get(None, GroupStats())
 
-print(f"Overall total expenses: {overall_expenses}")
+    print(f"Overall total expenses: {stats.total}")
@@ -1,4 +1,7 @@
-from functools import reduce
+import argparse
+from functools import partial
+
+from aggregate import aggregation, run_report, merge_groups, GroupStats, BACKENDS
 
 orders = [
     {"order_id": 1, "customer_id": 101, "amount": 150.0},
@@ -10,18 +13,37 @@ orders = [
 
 target_customer_id = 101
 
-# фильтрация заказов для определённого клиента
-filtered_orders = list(filter(lambda o: o["customer_id"] == target_customer_id, orders))
+# один проход по всем заказам: сумма, число и средняя стоимость по каждому клиенту,
+# заказы выбранного клиента печатаются по ходу
+def orders_report(records, emit, target_customer_id=target_customer_id, backend='python'):
+    agg = aggregation(backend, value=lambda o: o["amount"], key=lambda o: o["customer_id"],
+                      item=lambda o: o["order_id"])
+    for order in records:
+        agg.add(order)
+        if order["customer_id"] == target_customer_id:
+            emit(f"Order ID: {order['order_id']}, Amount: {order['amount']}")
+    return agg.finish()
+
 
-# подсчёт общей суммы заказов
-total_amount = reduce(lambda acc, o: acc + o["amount"], filtered_orders, 0)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Orders of a customer")
+    parser.add_argument("data", nargs="?", help="JSONL file with orders (default: built-in list)")
+    parser.add_argument("--customer", type=int, default=target_customer_id, help="customer to list orders for")
+    parser.add_argument("--all", action="store_true", help="also print totals of every customer")
+    parser.add_argument("--workers", type=int, default=1, help="processes for a JSONL file")
+    parser.add_argument("--backend", choices=BACKENDS, default="python")
+    args = parser.parse_args()
 
-# подсчёт средней стоимости заказов
-average_amount = total_amount / len(filtered_orders) if filtered_orders else 0
+    print(f"Orders for customer {args.customer}:")
+    report = partial(orders_report, target_customer_id=args.customer, backend=args.backend)
+    customers = merge_groups(run_report(args.data or orders, report, args.workers))
+    stats = customers.get(args.customer, GroupStats())
 
-print(f"Orders for customer {target_customer_id}:")
-for order in filtered_orders:
-    print(f"Order ID: {order['order_id']}, Amount: {order['amount']}")
+    print(f"Total amount of orders: {stats.total}")
+    print(f"Average order amount: {stats.avg}")
 
-print(f"Total amount of orders: {total_amount}")
-print(f"Average order amount: {average_amount}")
+    if args.all:
+        print("\nAll customers:")
+        for customer_id, stats in customers.items():
+            print(f"Customer {customer_id}: {stats.count} orders, total = {stats.total}, "
+                  f"average = {stats.avg}, largest order ID: {stats.top[0]}")
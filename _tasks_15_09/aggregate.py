@@ -0,0 +1,313 @@
+"""Потоковая агрегация записей за один проход.
+
+Записи читаются из JSONL построчно (read_jsonl) или берутся из списка.
+Aggregation за один проход считает по группам количество, сумму, среднее,
+максимум и все записи с максимумом (argmax с равными), с фильтром where
+до агрегации и порогом above на значение. Сумма копится слева направо,
+как reduce в скриптах 1.py - 3.py, поэтому результат совпадает до бита.
+
+backend='numpy' - колоночный вариант: значения копятся пачками по BATCH и
+сворачиваются np.add.at / np.maximum.at - они тоже идут по элементам по
+порядку, так что суммы те же. run_report() делит большой файл на куски
+по строкам и обрабатывает их в нескольких процессах. Сумма дробных
+зависит от порядка сложения, поэтому куски отдают ещё и значения групп
+(array('d')), а при слиянии они досуммируются к итогу предыдущих кусков
+слева направо - результат тот же, что в одном процессе (для целых до 2**53).
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+from array import array
+from multiprocessing import Pool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BATCH = 65536
+BACKENDS = ('python', 'numpy')
+
+# Выставляется в процессе-куске run_report: группы копят значения для точного слияния
+_keep_values = False
+
+
+def _fold(total, values):
+    """Досуммировать values к total слева направо, как в одном процессе."""
+    if np is not None:
+        acc = np.array([total], dtype=np.float64)
+        # add.at без буферизации - строго по порядку элементов
+        np.add.at(acc, np.zeros(len(values), dtype=np.intp), np.asarray(values, dtype=np.float64))
+        return acc[0].item()
+    for value in values:
+        total = total + value
+    return total
+
+
+def read_jsonl(path, start=0, end=None):
+    """Записи из строк файла, начинающихся в байтах [start, end)."""
+    with open(path, 'rb') as f:
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            if line.strip():
+                yield json.loads(line)
+
+
+def shard_ranges(path, shards):
+    """Разбить файл на shards кусков по границам строк: [(start, end)]."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, shards):
+            f.seek(max(size * i // shards - 1, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+class GroupStats:
+    """Итог группы: count, total, max и top - записи (item) с максимальным значением.
+
+    values - значения по порядку, если их нужно слить с другим куском точно.
+    """
+    __slots__ = ('count', 'total', 'max', 'top', 'values')
+
+    def __init__(self, keep_values=False):
+        self.count = 0
+        self.total = 0
+        self.max = None
+        self.top = []
+        self.values = array('d') if keep_values else None
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else 0
+
+    def add(self, value, item):
+        self.count += 1
+        self.total = self.total + value
+        if self.values is not None:
+            self.values.append(value)
+        if self.max is None or value > self.max:
+            self.max = value
+            self.top = [item]
+        elif value == self.max:
+            self.top.append(item)
+
+    def merge(self, other):
+        self.count += other.count
+        if other.values is None or isinstance(self.total, int) and isinstance(other.total, int):
+            self.total = self.total + other.total
+        else:
+            self.total = _fold(self.total, other.values)
+        if other.max is None:
+            return
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+            self.top = list(other.top)
+        elif other.max == self.max:
+            self.top.extend(other.top)
+
+
+class Aggregation:
+    """Один проход по записям: where(record) -> value(record) > above -> группа key(record).
+
+    item(record) - что хранить для записей с максимумом (по умолчанию сама запись).
+    """
+
+    def __init__(self, value, key=None, where=None, above=None, item=None):
+        self.value = value
+        self.key = key
+        self.where = where
+        self.above = above
+        self.item = item
+        self.keep_values = _keep_values
+        self.groups = {}
+
+    def accept(self, record):
+        """Значение записи или None, если она отброшена фильтром или порогом."""
+        if self.where is not None and not self.where(record):
+            return None
+        value = self.value(record)
+        if self.above is not None and not value > self.above:
+            return None
+        return value
+
+    def add(self, record):
+        """Учесть запись; возвращает её значение или None, если она отброшена."""
+        value = self.accept(record)
+        if value is None:
+            return None
+        group = self.key(record) if self.key is not None else None
+        stats = self.groups.get(group)
+        if stats is None:
+            stats = self.groups[group] = GroupStats(self.keep_values)
+        stats.add(value, self.item(record) if self.item is not None else record)
+        return value
+
+    def finish(self):
+        """{группа: GroupStats} в порядке появления групп."""
+        return self.groups
+
+
+class ColumnarAggregation(Aggregation):
+    """То же на NumPy: группы - индексы массивов, пачки сворачиваются ufunc.at."""
+
+    def __init__(self, value, key=None, where=None, above=None, item=None):
+        if np is None:
+            raise ValueError("numpy backend requires the 'numpy' package")
+        super().__init__(value, key, where, above, item)
+        self.index = {}
+        self.order = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.totals = None
+        self.maxes = None
+        self.tops = []
+        self.chunks = []            # значения групп пачками, если keep_values
+        self.batch_groups = []
+        self.batch_values = []
+        self.batch_items = []
+
+    def add(self, record):
+        value = self.accept(record)
+        if value is None:
+            return None
+        self.batch_groups.append(self.key(record) if self.key is not None else None)
+        self.batch_values.append(value)
+        self.batch_items.append(self.item(record) if self.item is not None else record)
+        if len(self.batch_values) >= BATCH:
+            self._flush()
+        return value
+
+    def _group_index(self, group):
+        idx = self.index.get(group)
+        if idx is None:
+            idx = self.index[group] = len(self.order)
+            self.order.append(group)
+            self.tops.append([])
+            self.chunks.append([])
+        return idx
+
+    def _flush(self):
+        if not self.batch_values:
+            return
+        idx = np.fromiter((self._group_index(g) for g in self.batch_groups), dtype=np.intp,
+                          count=len(self.batch_groups))
+        values = np.asarray(self.batch_values)
+        if values.dtype.kind not in 'iuf':
+            raise ValueError(f"numpy backend needs numeric values, got {values.dtype}")
+        # Целые остаются целыми, как сумма int в Python; появились дробные - всё во float64
+        dtype = np.float64 if values.dtype.kind == 'f' or (self.totals is not None
+                                                          and self.totals.dtype.kind == 'f') else np.int64
+        lowest = -np.inf if dtype == np.float64 else np.iinfo(np.int64).min
+        values = values.astype(dtype, copy=False)
+        groups = len(self.order)
+        if self.totals is None:
+            self.totals = np.zeros(groups, dtype=dtype)
+            self.maxes = np.full(groups, lowest, dtype=dtype)
+        else:
+            self.totals = self.totals.astype(dtype, copy=False)
+            self.maxes = self.maxes.astype(dtype, copy=False)
+            grow = groups - len(self.totals)
+            if grow:
+                self.totals = np.concatenate([self.totals, np.zeros(grow, dtype=dtype)])
+                self.maxes = np.concatenate([self.maxes, np.full(grow, lowest, dtype=dtype)])
+        if len(self.counts) < groups:
+            self.counts = np.concatenate([self.counts, np.zeros(groups - len(self.counts), dtype=np.int64)])
+        np.add.at(self.counts, idx, 1)
+        # ufunc.at без буферизации: элементы складываются по порядку, как в цикле Python
+        np.add.at(self.totals, idx, values)
+        before = self.maxes.copy()
+        np.maximum.at(self.maxes, idx, values)
+        for group in np.flatnonzero(self.maxes > before):
+            self.tops[group] = []
+        items = self.batch_items
+        for i in np.flatnonzero(values == self.maxes[idx]):
+            self.tops[idx[i]].append(items[i])
+        if self.keep_values:
+            order = np.argsort(idx, kind='stable')
+            ordered = idx[order]
+            bounds = np.flatnonzero(np.diff(ordered)) + 1
+            for group, chunk in zip(ordered[np.r_[0, bounds]], np.split(values[order], bounds)):
+                self.chunks[group].append(chunk.astype(np.float64))
+        self.batch_groups = []
+        self.batch_values = []
+        self.batch_items = []
+
+    def finish(self):
+        self._flush()
+        groups = {}
+        for i, group in enumerate(self.order):
+            stats = groups[group] = GroupStats()
+            stats.count = int(self.counts[i])
+            stats.total = self.totals[i].item()
+            stats.max = self.maxes[i].item()
+            stats.top = self.tops[i]
+            if self.keep_values:
+                stats.values = np.concatenate(self.chunks[i])
+        return groups
+
+
+def aggregation(backend='python', **options):
+    """Aggregation или ColumnarAggregation по имени backend."""
+    if backend == 'python':
+        return Aggregation(**options)
+    if backend == 'numpy':
+        return ColumnarAggregation(**options)
+    raise ValueError(f"unknown backend: {backend}")
+
+
+def merge_groups(results):
+    """Слить {группа: GroupStats} кусков по порядку."""
+    merged = {}
+    for groups in results:
+        for group, stats in groups.items():
+            if group in merged:
+                merged[group].merge(stats)
+            else:
+                merged[group] = stats
+    for stats in merged.values():
+        stats.values = None
+    return merged
+
+
+def _run_shard(report, path, start, end):
+    global _keep_values
+    _keep_values = True
+    with tempfile.NamedTemporaryFile('w', suffix='.out', delete=False) as out:
+        result = report(read_jsonl(path, start, end), lambda line: print(line, file=out))
+    return out.name, result
+
+
+def run_report(source, report, workers=1):
+    """Выполнить report(records, emit) над source и вернуть список результатов кусков.
+
+    source - путь к JSONL или список записей; emit(line) печатает строку
+    отчёта. workers > 1 - файл делится на куски, report выполняется в
+    процессах (он и его результат должны сериализоваться pickle), а вывод
+    кусков печатается в исходном порядке.
+    """
+    if not isinstance(source, str):
+        return [report(iter(source), print)]
+    if workers <= 1:
+        return [report(read_jsonl(source), print)]
+    ranges = shard_ranges(source, workers)
+    with Pool(min(workers, len(ranges)) or 1) as pool:
+        parts = pool.starmap(_run_shard, [(report, source, start, end) for start, end in ranges])
+    results = []
+    sys.stdout.flush()
+    for out_path, result in parts:
+        with open(out_path) as out:
+            shutil.copyfileobj(out, sys.stdout)
+        os.remove(out_path)
+        results.append(result)
+    return results
@@ -1,24 +1,97 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
-from scapy.all import sniff, IP, TCP, ICMP, send
-from collections import defaultdict
+from scapy.all import sniff, AsyncSniffer, IP, TCP, UDP, ICMP, send
 import time
+import os
+import sqlite3
 import threading
-import requests
+
+from detector import Thresholds, RULE_LABELS
+from pipeline import DetectionPipeline
+from enrichment import Enricher, IspCache, IpApiBackend, CidrTableBackend, PENDING_ISP
+from capture import RawCapture, raw_capture_available, IPPROTO_TCP, IPPROTO_UDP, IPPROTO_ICMP
+from sharding import ShardedCapture
+from blocker import make_blocker, check_blocker, BlockError, DEFAULT_TIMEOUT
+from metrics import MetricsExporter
+from rules import load_rules
+from events import EventStore, EVENTS_FILE
+from profiler import start_profiling
+
+# Движок захвата: raw (AF_PACKET + BPF), scapy или auto (raw, если доступен)
+CAPTURE_BACKEND = os.environ.get("TRAFFIC_MONITOR_CAPTURE", "auto")
+CAPTURE_IFACE = os.environ.get("TRAFFIC_MONITOR_IFACE") or None
+CAPTURE_SECONDS = 15
+# Окно статистики по IP в секундах: в непрерывном режиме она обнуляется по окнам
+STATS_WINDOW = float(os.environ.get("TRAFFIC_MONITOR_WINDOW", "60"))
+# Больше 1 - несколько процессов захвата в группе PACKET_FANOUT (нужен raw)
+CAPTURE_WORKERS = int(os.environ.get("TRAFFIC_MONITOR_WORKERS", "1"))
+# exact - точные множества, approx - скетчи с фиксированной памятью
+DETECTOR_MODE = os.environ.get("TRAFFIC_MONITOR_DETECTOR", "exact")
+# Блокировка: ipset, nft или dryrun[:файл]; таймаут в секундах (0 - бессрочно)
+BLOCKER = os.environ.get("TRAFFIC_MONITOR_BLOCKER", "ipset")
+BLOCK_TIMEOUT = int(os.environ.get("TRAFFIC_MONITOR_BLOCK_TIMEOUT", str(DEFAULT_TIMEOUT)))
+# Экспорт метрик: порт HTTP на 127.0.0.1 и/или файл для textfile-коллектора
+METRICS_PORT = int(os.environ.get("TRAFFIC_MONITOR_METRICS_PORT", "0"))
+METRICS_FILE = os.environ.get("TRAFFIC_MONITOR_METRICS_FILE") or None
+
+# Журнал срабатываний и блокировок (SQLite); пустая строка - не вести
+EVENTS_DB = os.environ.get("TRAFFIC_MONITOR_EVENTS", EVENTS_FILE)
+HISTORY_HOURS = 24          # период окна "История"
+
+# Профилирование: путь к файлу отчёта (JSON, стеки - в <путь>.folded); пусто - выключено
+PROFILE_FILE = os.environ.get("TRAFFIC_MONITOR_PROFILE") or None
+
+# Набор правил в JSON (см. rules.json); без файла - все встроенные правила
+RULES_FILE = os.environ.get(
+    "TRAFFIC_MONITOR_RULES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json"))
+
+# Необязательная офлайн-таблица CIDR -> провайдер (см. CidrTableBackend)
+ISP_TABLE = os.environ.get(
+    "TRAFFIC_MONITOR_ISP_TABLE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "isp_table.csv"))
+
+UI_FPS = 10                 # частота обновления списка и журнала
+MAX_ROWS_PER_FRAME = 200    # сколько срабатываний выводить за один кадр
 
 class TrafficMonitor:
     def __init__(self):
         self.root = tk.Tk()
         self.root.title("Traffic Monitor")
-        self.root.geometry("550x500")
+        self.root.geometry("550x520")
         
         self.is_monitoring = False
-        self.suspicious_ips = set()
-        self.ip_stats = defaultdict(lambda: {'ports': set(), 'count': 0, 'first_seen': 0})
-        self.ip_event_count = defaultdict(int)
-        self.last_event_time = time.time()
+        self.sharded = CAPTURE_WORKERS > 1 and CAPTURE_BACKEND != "scapy" and raw_capture_available()
+        rules = self.read_rules()
+        self.profiler, self.profile_dumper = start_profiling(PROFILE_FILE) if PROFILE_FILE else (None, None)
+        if self.sharded:
+            self.pipeline = ShardedCapture(CAPTURE_WORKERS, CAPTURE_IFACE, mode=DETECTOR_MODE,
+                                           window=STATS_WINDOW, rules=rules, profile=PROFILE_FILE)
+        else:
+            self.pipeline = DetectionPipeline(mode=DETECTOR_MODE, window=STATS_WINDOW, rules=rules,
+                                              profiler=self.profiler)
+        self.enricher = self.create_enricher()
+        self.row_ips = []   # IP для каждой строки списка
+        self.events = self.open_events()
+        self.blocker = make_blocker(BLOCKER, BLOCK_TIMEOUT, self.events)
+        self.stop_event = threading.Event()
+        
+        self.metrics = MetricsExporter(self.pipeline, self.enricher, self.profiler)
+        if self.profiler:
+            # Кадр GUI замеряется целиком (вместе с запросами enrich) и scapy-обработчик
+            self.poll_detections = self.profiler.wrap('ui', self.poll_detections, every=1)
+            self.packet_handler = self.profiler.wrap('submit', self.packet_handler)
+        if METRICS_PORT:
+            self.metrics.serve(METRICS_PORT)
+        if METRICS_FILE:
+            self.metrics.start_textfile(METRICS_FILE)
         
         self.setup_ui()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.update_thresholds()
+        for var in (self.size_check, self.port_check, self.repeat_check,
+                    self.max_size, self.port_thresh, self.repeat_thresh):
+            var.trace_add('write', lambda *_: self.update_thresholds())
         
     def setup_ui(self):
         # Настройки обнаружения
@@ -57,8 +130,19 @@ class TrafficMonitor:
         self.start_btn = ttk.Button(btn_frame, text="Начать сканирование", command=self.start)
         self.start_btn.pack(side=tk.LEFT, padx=5)
         
+        self.stop_btn = ttk.Button(btn_frame, text="Остановить", command=self.stop, state=tk.DISABLED)
+        self.stop_btn.pack(side=tk.LEFT, padx=5)
+        
+        self.continuous = tk.BooleanVar(value=False)
+        ttk.Checkbutton(btn_frame, text="Непрерывно", variable=self.continuous).pack(side=tk.LEFT, padx=5)
+        
         ttk.Button(btn_frame, text="Блокировать выбранные", command=self.block_ips).pack(side=tk.LEFT, padx=5)
         
+        ttk.Button(btn_frame, text="История", command=self.show_history).pack(side=tk.LEFT, padx=5)
+        
+        self.auto_block = tk.BooleanVar(value=False)
+        ttk.Checkbutton(btn_frame, text="Автоблокировка", variable=self.auto_block).pack(side=tk.LEFT, padx=5)
+        
         # Список подозрительных IP
         list_frame = ttk.LabelFrame(self.root, text="Подозрительные IP-адреса")
         list_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
@@ -77,69 +161,131 @@ class TrafficMonitor:
         self.log = tk.Text(log_frame, height=6)
         self.log.pack(fill=tk.X, padx=5, pady=5)
         
+        # Счётчики конвейера
+        self.status = ttk.Label(self.root, text="")
+        self.status.pack(fill=tk.X, padx=10)
+        
+    def update_thresholds(self):
+        """Снять снимок порогов из tk-переменных (только в потоке GUI)."""
+        try:
+            thresholds = Thresholds(
+                self.size_check.get(), self.port_check.get(), self.repeat_check.get(),
+                self.max_size.get(), self.port_thresh.get(), self.repeat_thresh.get(),
+            )
+        except tk.TclError:
+            # Поле ввода редактируется и пока не число - оставляем прежний снимок
+            return
+        self.pipeline.set_thresholds(thresholds)
+        
     def log_msg(self, msg):
         self.log.insert(tk.END, f"{time.strftime('%H:%M:%S')} - {msg}\n")
         self.log.see(tk.END)
         
-    def get_isp_info(self, ip):
-        """Получение информации о провайдере"""
+    def open_events(self):
+        if not EVENTS_DB:
+            return None
+        try:
+            store = EventStore(EVENTS_DB)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Event store unavailable: {e}")
+            return None
+        store.start()
+        return store
+        
+    def read_rules(self):
+        if not os.path.exists(RULES_FILE):
+            return None
         try:
-            response = requests.get(f"http://ip-api.com/json/{ip}", timeout=3)
-            data = response.json()
-            if data.get('status') == 'success':
-                return f"{data.get('isp', 'Unknown')} ({data.get('country', 'Unknown')})"
-        except:
-            pass
-        return "Unknown ISP"
+            return load_rules(RULES_FILE)
+        except (OSError, ValueError) as e:
+            print(f"Error loading rules, using built-in set: {e}")
+            return None
+        
+    def create_enricher(self):
+        """Источники сведений о провайдере: сначала офлайн-таблица, затем ip-api.com"""
+        backends = []
+        if os.path.exists(ISP_TABLE):
+            try:
+                backends.append(CidrTableBackend(ISP_TABLE))
+            except (OSError, ValueError) as e:
+                print(f"Error loading ISP table: {e}")
+        backends.append(IpApiBackend())
+        return Enricher(backends, IspCache(), profiler=self.profiler)
+        
+    def row_text(self, det, isp_info):
+        return f"{det.ip} - {isp_info} - {RULE_LABELS[det.rule]}"
+        
+    def apply_enrichment(self):
+        """Дописать провайдера в строки, добавленные с PENDING_ISP."""
+        for ip, isp_info in self.enricher.drain():
+            for index, (row_ip, det) in enumerate(self.row_ips):
+                if row_ip != ip:
+                    continue
+                selected = self.ip_list.selection_includes(index)
+                self.ip_list.delete(index)
+                self.ip_list.insert(index, self.row_text(det, isp_info))
+                if selected:
+                    self.ip_list.selection_set(index)
         
     def packet_handler(self, packet):
-        if not packet.haslayer(IP) or not packet.haslayer(TCP):
+        """Вызывается в потоке sniff: только извлечь поля и положить в кольцо."""
+        if not packet.haslayer(IP):
             return
-            
-        src_ip = packet[IP].src
-        dst_port = packet[TCP].dport
-        packet_size = len(packet)
-        current_time = time.time()
-        
-        # Инициализация статистики IP
-        if src_ip not in self.ip_stats:
-            self.ip_stats[src_ip]['first_seen'] = current_time
-        
-        ip_info = self.ip_stats[src_ip]
-        
-        # Проверка большого пакета
-        if self.size_check.get() and packet_size > self.max_size.get():
-            if src_ip not in self.suspicious_ips:
-                self.suspicious_ips.add(src_ip)
-                isp_info = self.get_isp_info(src_ip)
-                self.ip_list.insert(tk.END, f"{src_ip} - {isp_info} - Large packet")
-                self.log_msg(f"Обнаружен: {src_ip} - Большой пакет ({packet_size} bytes)")
-        
-        # Проверка сканирования портов
-        if self.port_check.get():
-            ip_info['ports'].add(dst_port)
-            if len(ip_info['ports']) > self.port_thresh.get():
-                if src_ip not in self.suspicious_ips:
-                    self.suspicious_ips.add(src_ip)
-                    isp_info = self.get_isp_info(src_ip)
-                    self.ip_list.insert(tk.END, f"{src_ip} - {isp_info} - Port scan")
-                    self.log_msg(f"Обнаружен: {src_ip} - Сканирование портов ({len(ip_info['ports'])} портов)")
-        
-        # Проверка повторяющихся запросов
-        if self.repeat_check.get():
-            self.ip_event_count[src_ip] += 1
-            
-            # Проверка в временном окне 5 секунд
-            if (self.ip_event_count[src_ip] > self.repeat_thresh.get() and 
-                (current_time - self.last_event_time) < 5):
-                if src_ip not in self.suspicious_ips:
-                    self.suspicious_ips.add(src_ip)
-                    isp_info = self.get_isp_info(src_ip)
-                    self.ip_list.insert(tk.END, f"{src_ip} - {isp_info} - Repeated requests")
-                    self.log_msg(f"Обнаружен: {src_ip} - Повторяющиеся запросы")
-                    self.last_event_time = current_time
-        
-        ip_info['count'] += 1
+        if packet.haslayer(TCP):
+            proto, dst_port, flags = IPPROTO_TCP, packet[TCP].dport, int(packet[TCP].flags)
+        elif packet.haslayer(UDP):
+            proto, dst_port, flags = IPPROTO_UDP, packet[UDP].dport, 0
+        elif packet.haslayer(ICMP):
+            proto, dst_port, flags = IPPROTO_ICMP, 0, packet[ICMP].type
+        else:
+            return
+        self.pipeline.submit(packet[IP].src, dst_port, len(packet), time.time(), proto, flags)
+        
+    def raw_handler(self, src_ip, proto, dst_port, packet_size, ts, flags):
+        """Обработчик RawCapture: поля уже разобраны, scapy не участвует."""
+        self.pipeline.submit(src_ip, dst_port, packet_size, ts, proto, flags)
+        
+    def open_raw_capture(self):
+        """Открыть AF_PACKET-захват или вернуть None, если нужен откат на scapy."""
+        if CAPTURE_BACKEND == "scapy":
+            return None
+        if CAPTURE_BACKEND == "auto" and not raw_capture_available():
+            return None
+        try:
+            return RawCapture(CAPTURE_IFACE, profiler=self.profiler)
+        except (OSError, AttributeError) as e:
+            print(f"Raw capture unavailable, falling back to scapy: {e}")
+            return None
+        
+    def poll_detections(self):
+        """Перенести накопленные срабатывания в список и журнал одним кадром."""
+        found = self.pipeline.drain(MAX_ROWS_PER_FRAME)
+        if found:
+            rows = []
+            lines = []
+            stamp = time.strftime('%H:%M:%S')
+            for det in found:
+                # Строка появляется сразу, провайдер дописывается позже
+                rows.append(self.row_text(det, self.enricher.request(det.ip)))
+                self.row_ips.append((det.ip, det))
+                lines.append(f"{stamp} - Обнаружен: {det.ip} - {det.detail}\n")
+            self.ip_list.insert(tk.END, *rows)
+            self.log.insert(tk.END, ''.join(lines))
+            if self.events is not None:
+                self.events.add_many(found)
+            self.log.see(tk.END)
+            if self.auto_block.get():
+                # Все срабатывания кадра - одной транзакцией
+                self.block_async([det.ip for det in found])
+        self.apply_enrichment()
+        
+        stats = self.pipeline.stats()
+        self.status.config(text=f"Пакетов: {stats['processed']}  "
+                                f"в очереди: {stats['queued']}  "
+                                f"потеряно: {stats['dropped']}")
+        
+        if self.is_monitoring or self.pipeline.detections or self.enricher.pending:
+            self.root.after(1000 // UI_FPS, self.poll_detections)
     
     def start(self):
         if self.is_monitoring:
@@ -147,63 +293,136 @@ class TrafficMonitor:
             
         self.is_monitoring = True
         self.start_btn.config(state=tk.DISABLED)
+        self.stop_btn.config(state=tk.NORMAL)
+        self.stop_event.clear()
+        duration = None if self.continuous.get() else CAPTURE_SECONDS
         
         # Очистка предыдущих результатов
-        self.suspicious_ips.clear()
-        self.ip_stats.clear()
-        self.ip_event_count.clear()
         self.ip_list.delete(0, tk.END)
+        self.row_ips.clear()
+        self.update_thresholds()
+        self.enricher.start()
+        self.pipeline.start()
+        
+        raw = None if self.sharded else self.open_raw_capture()
         
         def sniff_thread():
-            self.log_msg("Сканирование запущено на 15 секунд...")
-            sniff(prn=self.packet_handler, store=0, timeout=15)
+            if self.sharded:
+                # Воркеры сами захватывают и детектируют, ждём окончания или остановки
+                self.stop_event.wait(duration)
+            elif raw is not None:
+                try:
+                    raw.run(self.raw_handler, timeout=duration, stop_event=self.stop_event)
+                finally:
+                    raw.close()
+            else:
+                sniffer = AsyncSniffer(prn=self.packet_handler, store=False, iface=CAPTURE_IFACE)
+                sniffer.start()
+                self.stop_event.wait(duration)
+                sniffer.stop()
+            # Дождаться, пока детектор разберёт остаток кольца
+            self.pipeline.stop()
+            # Сначала остановить пул обогащения: on_sniff_end снова опрашивает
+            # Enricher, а новый start() возможен только после on_sniff_end
+            self.enricher.stop()
             self.root.after(0, self.on_sniff_end)
             
+        if self.sharded:
+            engine = f"AF_PACKET, {CAPTURE_WORKERS} процессов"
+        else:
+            engine = "AF_PACKET" if raw is not None else "scapy"
+        if duration:
+            self.log_msg(f"Сканирование запущено на {duration} секунд ({engine})...")
+        else:
+            self.log_msg(f"Непрерывное сканирование запущено, окно {STATS_WINDOW:g} с ({engine})...")
         threading.Thread(target=sniff_thread, daemon=True).start()
+        self.poll_detections()
+        
+    def stop(self):
+        self.stop_event.set()
+        self.stop_btn.config(state=tk.DISABLED)
         
     def on_sniff_end(self):
         if self.is_monitoring:
             self.is_monitoring = False
             self.start_btn.config(state=tk.NORMAL)
+            self.stop_btn.config(state=tk.DISABLED)
+            self.poll_detections()
+            stats = self.pipeline.stats()
+            if stats['dropped']:
+                self.log_msg(f"Потеряно пакетов при переполнении очереди: {stats['dropped']}")
             self.log_msg("Сканирование завершено")
-            messagebox.showinfo("Готово", f"Найдено подозрительных IP: {len(self.suspicious_ips)}")
+            messagebox.showinfo("Готово", f"Найдено подозрительных IP: {stats['suspicious']}")
         
     def block_ips(self):
         selections = self.ip_list.curselection()
         if not selections:
             messagebox.showwarning("Внимание", "Выберите IP для блокировки")
             return
-            
-        blocked_ips = []
-        for index in selections:
-            ip_text = self.ip_list.get(index)
-            ip = ip_text.split(' - ')[0]
-            
+        self.block_async([self.row_ips[index][0] for index in selections], notify=True)
+        
+    def block_async(self, ips, notify=False):
+        """Заблокировать адреса пачкой в фоновом потоке, не подвешивая GUI."""
+        def worker():
             try:
-                import subprocess
-                # Прямое выполнение iptables в WSL (без wsl команды)
-                result1 = subprocess.run([
-                    'sudo', 'iptables', '-A', 'INPUT', '-s', ip, '-j', 'DROP'
-                ], check=True)
-                
-                result2 = subprocess.run([
-                    'sudo', 'iptables', '-A', 'OUTPUT', '-d', ip, '-j', 'DROP'
-                ], check=True)
-                
-                blocked_ips.append(ip)
-                self.log_msg(f"Заблокирован: {ip}")
-                
-            except subprocess.CalledProcessError:
-                self.log_msg(f"Ошибка прав для {ip} - уже запущено с sudo?")
-            except Exception as e:
-                self.log_msg(f"Ошибка блокировки {ip}: {e}")
-                    
-        if blocked_ips:
-            messagebox.showinfo("Успех", f"Заблокировано IP: {len(blocked_ips)}")
+                blocked = self.blocker.block(ips)
+                error = None
+            except BlockError as e:
+                blocked, error = [], e
+            self.root.after(0, lambda: self.on_blocked(blocked, error, notify))
+            
+        threading.Thread(target=worker, daemon=True).start()
+        
+    def on_blocked(self, blocked, error, notify):
+        if error is not None:
+            self.log_msg(f"Ошибка блокировки ({self.blocker.name}): {error}")
+            if notify:
+                messagebox.showerror("Ошибка", f"Не удалось заблокировать: {error}")
+            return
+        for ip in blocked:
+            self.log_msg(f"Заблокирован: {ip}")
+        if notify and blocked:
+            messagebox.showinfo("Успех", f"Заблокировано IP: {len(blocked)}")
+        
+    def show_history(self):
+        """Самые частые нарушители за HISTORY_HOURS часов из журнала событий."""
+        if self.events is None:
+            messagebox.showwarning("Внимание", "Журнал событий отключён")
+            return
+        top = self.events.top_offenders(time.time() - HISTORY_HOURS * 3600, limit=100)
+        
+        window = tk.Toplevel(self.root)
+        window.title(f"Нарушители за {HISTORY_HOURS} ч")
+        listbox = tk.Listbox(window, selectmode=tk.MULTIPLE, width=80, height=20)
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        for ip, count, last_ts, rules in top:
+            labels = ", ".join(RULE_LABELS.get(rule, rule) for rule in rules.split(','))
+            last = time.strftime('%d.%m %H:%M:%S', time.localtime(last_ts))
+            listbox.insert(tk.END, f"{ip} - {count} раз - {labels} - последний {last}")
+        
+        def block_selected():
+            ips = [top[index][0] for index in listbox.curselection()]
+            if ips:
+                self.block_async(ips, notify=True)
+        
+        ttk.Button(window, text="Блокировать выбранные", command=block_selected).pack(pady=5)
+        
+    def on_close(self):
+        self.stop_event.set()
+        if self.events is not None:
+            self.events.close()
+        if self.profile_dumper is not None:
+            self.profile_dumper.stop()
+        self.root.destroy()
         
     def run(self):
         self.root.mainloop()
 
 if __name__ == "__main__":
+    # Ошибку настройки - до создания окна, а не исключением внутри GUI
+    try:
+        check_blocker(BLOCKER)
+    except ValueError as e:
+        raise SystemExit(f"TRAFFIC_MONITOR_BLOCKER: {e}")
     app = TrafficMonitor()
     app.run()
\ No newline at end of file
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Офлайн-бенчмарк движков захвата и детектирования.
+
+Генерирует синтетический pcap (synth.py) с разметкой и прогоняет его через
+каждый движок в отдельном процессе, чтобы пиковый RSS относился только к нему.
+Для каждого движка печатает пакеты/с, перцентили задержки на пакет, пиковый
+RSS и точность/полноту найденных IP относительно разметки.
+
+    python bench.py --benign 5000 --spoofed 200000
+    python bench.py --pcap incident.pcap --truth incident.truth.json --backends replay-exact batch
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import synth
+from detector import make_detector
+from pcapio import iter_fields
+
+LATENCY_SAMPLE = 64     # замерять задержку каждого N-го пакета
+
+
+def _load_fields(path):
+    return list(iter_fields(path))
+
+
+def _percentiles(samples_ns):
+    if not samples_ns:
+        return {}
+    samples_ns.sort()
+    n = len(samples_ns)
+    return {f"p{p}": samples_ns[min(n - 1, n * p // 100)] / 1000.0 for p in (50, 90, 99)}
+
+
+def bench_detector(path, mode):
+    """Только детектор: пакеты заранее разобраны в память."""
+    fields = _load_fields(path)
+    detector = make_detector(mode)
+    process = detector.process
+    found = set()
+    latencies = []
+    clock = time.perf_counter_ns
+    started = time.perf_counter()
+    for i, (src_ip, proto, dst_port, size, ts, flags) in enumerate(fields):
+        if i % LATENCY_SAMPLE:
+            for det in process(src_ip, dst_port, size, ts, proto, flags):
+                found.add(det.ip)
+        else:
+            t0 = clock()
+            for det in process(src_ip, dst_port, size, ts, proto, flags):
+                found.add(det.ip)
+            latencies.append(clock() - t0)
+    return len(fields), time.perf_counter() - started, found, latencies
+
+
+def bench_replay(path, mode):
+    """Чтение pcap + разбор заголовков + детектор, как cli.py replay."""
+    detector = make_detector(mode)
+    process = detector.process
+    found = set()
+    packets = 0
+    started = time.perf_counter()
+    for src_ip, proto, dst_port, size, ts, flags in iter_fields(path):
+        packets += 1
+        for det in process(src_ip, dst_port, size, ts, proto, flags):
+            found.add(det.ip)
+    return packets, time.perf_counter() - started, found, []
+
+
+def bench_pipeline(path, mode):
+    """Кольцо + поток детектора: сколько успевает принять поток захвата."""
+    from pipeline import DetectionPipeline
+
+    fields = _load_fields(path)
+    pipeline = DetectionPipeline(mode=mode)
+    pipeline.start()
+    submit = pipeline.submit
+    latencies = []
+    clock = time.perf_counter_ns
+    started = time.perf_counter()
+    for i, (src_ip, proto, dst_port, size, ts, flags) in enumerate(fields):
+        if i % LATENCY_SAMPLE:
+            submit(src_ip, dst_port, size, ts, proto, flags)
+        else:
+            t0 = clock()
+            submit(src_ip, dst_port, size, ts, proto, flags)
+            latencies.append(clock() - t0)
+    pipeline.stop()
+    elapsed = time.perf_counter() - started
+    found = {det.ip for det in pipeline.drain()}
+    stats = pipeline.stats()
+    return len(fields), elapsed, found, latencies, {'dropped': stats['dropped']}
+
+
+def bench_batch(path, mode):
+    """Векторизованный движок NumPy (режим детектора не влияет)."""
+    import batch
+
+    started = time.perf_counter()
+    packets = batch.load_pcap(path)
+    found = {det.ip for det in batch.analyze(packets)}
+    return len(packets), time.perf_counter() - started, found, []
+
+
+def bench_raw_lo(path, mode):
+    """AF_PACKET на lo: кадры из pcap отправляются в lo и снимаются RawCapture."""
+    import socket
+    import threading
+    from capture import RawCapture
+    from pcapio import iter_packets
+
+    frames = [bytes(data) for _, _, _, data in iter_packets(path)]
+    capture = RawCapture("lo")
+    detector = make_detector(mode)
+    found = set()
+    seen = [0]
+
+    def handler(src_ip, proto, dst_port, size, ts, flags):
+        seen[0] += 1
+        for det in detector.process(src_ip, dst_port, size, ts, proto, flags):
+            found.add(det.ip)
+
+    stop = threading.Event()
+    reader = threading.Thread(target=capture.run, args=(handler,), kwargs={'stop_event': stop})
+    reader.start()
+    sender = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    sender.bind(("lo", 0))
+    started = time.perf_counter()
+    for frame in frames:
+        sender.send(frame)
+    # Дать читателю разобрать хвост кольца
+    deadline = time.monotonic() + 5
+    while seen[0] < len(frames) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    reader.join()
+    capture.close()
+    sender.close()
+    return seen[0], elapsed, found, [], {'lost': len(frames) - seen[0]}
+
+
+BACKENDS = {
+    'detector-exact': (bench_detector, 'exact'),
+    'detector-approx': (bench_detector, 'approx'),
+    'replay-exact': (bench_replay, 'exact'),
+    'replay-approx': (bench_replay, 'approx'),
+    'pipeline': (bench_pipeline, 'exact'),
+    'batch': (bench_batch, 'exact'),
+    'raw-lo': (bench_raw_lo, 'exact'),
+}
+
+
+def _child(name, path, conn):
+    func, mode = BACKENDS[name]
+    try:
+        result = func(path, mode)
+    except Exception as e:
+        conn.send({'backend': name, 'error': f"{type(e).__name__}: {e}"})
+        return
+    packets, elapsed, found, latencies = result[:4]
+    extra = result[4] if len(result) > 4 else {}
+    conn.send({
+        'backend': name,
+        'packets': packets,
+        'seconds': elapsed,
+        'found': sorted(found),
+        'latency_us': _percentiles(latencies),
+        # ru_maxrss в Linux - килобайты
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        **extra,
+    })
+
+
+def run_backend(name, path):
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(name, path, child))
+    proc.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {'backend': name, 'error': f"exit code {proc.exitcode}"}
+    proc.join()
+    return result
+
+
+def score(found, truth):
+    found = set(found)
+    truth = set(truth)
+    tp = len(found & truth)
+    precision = tp / len(found) if found else 1.0
+    recall = tp / len(truth) if truth else 1.0
+    return precision, recall
+
+
+def available_backends():
+    names = ['detector-exact', 'detector-approx', 'replay-exact', 'replay-approx', 'pipeline']
+    try:
+        import numpy  # noqa: F401
+        names.append('batch')
+    except ImportError:
+        pass
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        names.append('raw-lo')
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline analyzer benchmark")
+    parser.add_argument("--pcap", help="use an existing pcap instead of generating one")
+    parser.add_argument("--truth", help="ground truth JSON for --pcap (synth.py format)")
+    parser.add_argument("--backends", nargs="+", choices=sorted(BACKENDS))
+    parser.add_argument("--benign", type=int, default=2000)
+    parser.add_argument("--scanners", type=int, default=20)
+    parser.add_argument("--flooders", type=int, default=20)
+    parser.add_argument("--large", type=int, default=20)
+    parser.add_argument("--spoofed", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    tmpdir = None
+    if args.pcap:
+        path = args.pcap
+        truth_file = args.truth or synth.truth_path(path)
+    else:
+        tmpdir = tempfile.TemporaryDirectory(prefix="analyzer-bench-")
+        path = os.path.join(tmpdir.name, "synthetic.pcap")
+        events, truth = synth.generate(args.benign, args.scanners, args.flooders, args.large,
+                                       args.spoofed, seed=args.seed)
+        synth.write_pcap(path, events)
+        truth_file = synth.truth_path(path)
+        with open(truth_file, "w") as f:
+            json.dump({"malicious": truth, "packets": len(events)}, f)
+        print(f"generated {len(events)} packets, {len(truth)} malicious sources", file=sys.stderr)
+
+    truth = {}
+    if os.path.exists(truth_file):
+        with open(truth_file) as f:
+            truth = json.load(f)["malicious"]
+
+    names = args.backends or available_backends()
+    if not args.json:
+        print(f"{'backend':<16}{'packets':>10}{'pkt/s':>12}{'p50 us':>9}{'p99 us':>9}"
+              f"{'RSS MB':>9}{'prec':>7}{'recall':>8}")
+    for name in names:
+        result = run_backend(name, path)
+        if 'error' not in result:
+            result['precision'], result['recall'] = score(result.pop('found'), truth)
+            result['packets_per_sec'] = result['packets'] / result['seconds'] if result['seconds'] else 0
+        if args.json:
+            print(json.dumps(result))
+            continue
+        if 'error' in result:
+            print(f"{name:<16} error: {result['error']}")
+            continue
+        lat = result['latency_us']
+        print(f"{name:<16}{result['packets']:>10}{result['packets_per_sec']:>12.0f}"
+              f"{lat.get('p50', float('nan')):>9.2f}{lat.get('p99', float('nan')):>9.2f}"
+              f"{result['peak_rss_mb']:>9.1f}{result['precision']:>7.2f}{result['recall']:>8.2f}")
+
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import os
+import time
+import threading
+import ipaddress
+import subprocess
+
+SET_NAME = "traffic_monitor"
+NFT_TABLE = "traffic_monitor"
+DEFAULT_TIMEOUT = 3600          # секунд, 0 - без истечения
+DRY_RUN_FILE = "blocked_ips.txt"
+
+
+class BlockError(Exception):
+    pass
+
+
+def _sudo(cmd):
+    # Под root sudo не нужен (и может отсутствовать)
+    return cmd if os.geteuid() == 0 else ['sudo', '-n'] + cmd
+
+
+def _run(cmd, script=None):
+    try:
+        result = subprocess.run(_sudo(cmd), input=script, text=True,
+                                capture_output=True, check=False)
+    except OSError as e:
+        raise BlockError(f"{cmd[0]}: {e}")
+    if result.returncode != 0:
+        raise BlockError(f"{' '.join(cmd)}: {result.stderr.strip() or result.returncode}")
+    return result.stdout
+
+
+def _valid_ips(ips):
+    """Отсеять всё, что не IPv4-адрес: строки уходят в скрипт ipset/nft."""
+    out = []
+    for ip in ips:
+        try:
+            out.append(str(ipaddress.IPv4Address(ip)))
+        except ValueError:
+            continue
+    return list(dict.fromkeys(out))
+
+
+class Blocker:
+    """Общий интерфейс: ensure() один раз, затем block()/unblock() пачками.
+
+    Наследник задаёт ensure() (создать набор и правило), _apply(ips, timeout)
+    и _remove(ips); каждый вызов - одна транзакция.
+    """
+
+    name = "base"
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.ready = False
+        self.lock = threading.Lock()
+        self.store = None           # events.EventStore для журнала блокировок
+
+    def block(self, ips, timeout=None):
+        """Заблокировать адреса одной транзакцией; вернуть список заблокированных."""
+        ips = _valid_ips(ips)
+        if not ips:
+            return []
+        timeout = self.timeout if timeout is None else timeout
+        with self.lock:
+            if not self.ready:
+                self.ensure()
+                self.ready = True
+            self._apply(ips, timeout)
+        if self.store is not None:
+            self.store.add_blocks(ips, self.name, timeout)
+        return ips
+
+    def unblock(self, ips):
+        ips = _valid_ips(ips)
+        if not ips:
+            return []
+        with self.lock:
+            if not self.ready:
+                self.ensure()
+                self.ready = True
+            self._remove(ips)
+        if self.store is not None:
+            self.store.add_blocks(ips, self.name, 0, action='unblock')
+        return ips
+
+
+class IpsetBlocker(Blocker):
+    """Один ipset hash:ip с таймаутами и по одному правилу iptables в INPUT и OUTPUT.
+
+    Добавление сотен адресов - один вызов `ipset restore`, а ядро ищет адрес
+    в хеш-таблице вместо линейного прохода по цепочке правил.
+    """
+
+    name = "ipset"
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, set_name=SET_NAME):
+        super().__init__(timeout)
+        self.set_name = set_name
+
+    def ensure(self):
+        _run(['ipset', 'create', self.set_name, 'hash:ip', 'timeout', str(self.timeout), '-exist'])
+        for chain, direction in (('INPUT', 'src'), ('OUTPUT', 'dst')):
+            rule = [chain, '-m', 'set', '--match-set', self.set_name, direction, '-j', 'DROP']
+            try:
+                _run(['iptables', '-C'] + rule)
+            except BlockError:
+                _run(['iptables', '-I'] + rule)
+
+    def _apply(self, ips, timeout):
+        script = "".join(f"add {self.set_name} {ip} timeout {timeout} -exist\n" for ip in ips)
+        _run(['ipset', 'restore'], script)
+
+    def _remove(self, ips):
+        script = "".join(f"del {self.set_name} {ip} -exist\n" for ip in ips)
+        _run(['ipset', 'restore'], script)
+
+
+class NftBlocker(Blocker):
+    """Таблица nftables с именованным множеством и правилами drop в input/output."""
+
+    name = "nft"
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, table=NFT_TABLE):
+        super().__init__(timeout)
+        self.table = table
+
+    def ensure(self):
+        t = self.table
+        # flags timeout всегда, как у ipset: сроки задаются и поэлементно
+        # (reapply_blocks передаёт остаток даже при self.timeout = 0)
+        # flush chain + add rule: повторный ensure не плодит дубликаты правил
+        script = (
+            f"add table inet {t}\n"
+            f"add set inet {t} blocked {{ type ipv4_addr; flags timeout; }}\n"
+            f"add chain inet {t} input {{ type filter hook input priority 0; policy accept; }}\n"
+            f"add chain inet {t} output {{ type filter hook output priority 0; policy accept; }}\n"
+            f"flush chain inet {t} input\n"
+            f"flush chain inet {t} output\n"
+            f"add rule inet {t} input ip saddr @blocked drop\n"
+            f"add rule inet {t} output ip daddr @blocked drop\n"
+        )
+        _run(['nft', '-f', '-'], script)
+
+    def _apply(self, ips, timeout):
+        if timeout:
+            elements = ", ".join(f"{ip} timeout {timeout}s" for ip in ips)
+        else:
+            elements = ", ".join(ips)
+        _run(['nft', '-f', '-'], f"add element inet {self.table} blocked {{ {elements} }}\n")
+
+    def _remove(self, ips):
+        # У nft нет аналога -exist: если какого-то адреса нет в множестве,
+        # транзакция откатывается целиком и вызывающий получит BlockError
+        _run(['nft', '-f', '-'], f"delete element inet {self.table} blocked {{ {', '.join(ips)} }}\n")
+
+
+class DryRunBlocker(Blocker):
+    """Ничего не блокирует, а дописывает транзакции в локальный файл (для тестов)."""
+
+    name = "dryrun"
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, path=DRY_RUN_FILE):
+        super().__init__(timeout)
+        self.path = path
+        self.blocked = {}           # ip -> время истечения (0 - бессрочно)
+
+    def ensure(self):
+        pass
+
+    def active(self, now=None):
+        """Адреса, которые были бы заблокированы сейчас (с учётом истечения)."""
+        now = now or time.time()
+        return sorted(ip for ip, expires in self.blocked.items() if not expires or expires > now)
+
+    def _write(self, op, ips, timeout):
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+        with open(self.path, 'a') as f:
+            f.write("".join(f"{stamp} {op} {ip} timeout {timeout}\n" for ip in ips))
+
+    def _apply(self, ips, timeout):
+        expires = time.time() + timeout if timeout else 0
+        for ip in ips:
+            self.blocked[ip] = expires
+        self._write('add', ips, timeout)
+
+    def _remove(self, ips):
+        for ip in ips:
+            self.blocked.pop(ip, None)
+        self._write('del', ips, 0)
+
+
+BLOCKERS = {
+    'ipset': IpsetBlocker,
+    'nft': NftBlocker,
+    'dryrun': DryRunBlocker,
+}
+
+
+def check_blocker(spec):
+    """Проверить строку блокировщика; вернуть имя бэкенда или ValueError."""
+    name = spec.partition(':')[0]
+    if name not in BLOCKERS:
+        raise ValueError(f"unknown blocker: {spec} (expected {', '.join(BLOCKERS)} or dryrun:FILE)")
+    return name
+
+
+def make_blocker(spec, timeout=DEFAULT_TIMEOUT, store=None):
+    """Создать блокировщик по строке: ipset, nft, dryrun или dryrun:/путь/к/файлу.
+
+    store - журнал событий, в который записывается каждая блокировка.
+    """
+    name = check_blocker(spec)
+    arg = spec.partition(':')[2]
+    if name == 'dryrun' and arg:
+        blocker = DryRunBlocker(timeout, arg)
+    else:
+        blocker = BLOCKERS[name](timeout)
+    blocker.store = store
+    return blocker
+
+
+def reapply_blocks(blocker, store, now=None):
+    """Восстановить из журнала ещё не истекшие блокировки (например, после перезагрузки).
+
+    Адреса группируются по оставшемуся времени с точностью до минуты, чтобы
+    обойтись несколькими транзакциями. Возвращает число восстановленных адресов.
+    """
+    now = now or time.time()
+    groups = {}
+    for ip, (backend, expires) in store.active_blocks(now).items():
+        # Округление вверх до минуты: остаток в 1 с не должен стать 0 (бессрочно)
+        remaining = 0 if not expires else int(-(-(expires - now) // 60)) * 60
+        groups.setdefault(remaining, []).append(ip)
+    restored = 0
+    # Повторная запись в журнал не нужна: сроки там уже есть
+    saved, blocker.store = blocker.store, None
+    try:
+        for remaining, ips in sorted(groups.items()):
+            restored += len(blocker.block(ips, remaining))
+    finally:
+        blocker.store = saved
+    return restored
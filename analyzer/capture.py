@@ -0,0 +1,211 @@
+import os
+import mmap
+import time
+import ctypes
+import select
+import socket
+import struct
+
+# Константы Linux (linux/if_packet.h, linux/filter.h)
+ETH_P_IP = 0x0800
+ETH_HLEN = 14
+SOL_PACKET = 263
+SO_ATTACH_FILTER = 26
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V2 = 1
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+IP_FRAG_OFFSET = 0x1fff         # смещение фрагмента в ip[6:2]
+
+# tcpdump -dd "ip and not ip[6:2] & 0x1fff != 0 and (tcp or udp or icmp)":
+# IPv4, не хвостовые фрагменты, TCP, UDP или ICMP. Остальное отбрасывает ядро.
+BPF_IPV4_TCP_UDP_ICMP = [
+    (0x28, 0, 0, 12),          # ldh [12]            ; EtherType
+    (0x15, 0, 7, ETH_P_IP),    # jeq #0x800          ; не IPv4 -> drop
+    (0x28, 0, 0, 20),          # ldh [20]            ; флаги + смещение фрагмента
+    (0x45, 5, 0, IP_FRAG_OFFSET),  # jset #0x1fff        ; хвост фрагмента -> drop
+    (0x30, 0, 0, 23),          # ldb [23]            ; протокол
+    (0x15, 2, 0, IPPROTO_TCP),  # jeq #6             -> accept
+    (0x15, 1, 0, IPPROTO_UDP),  # jeq #17            -> accept
+    (0x15, 0, 1, IPPROTO_ICMP),  # jeq #1            -> accept / drop
+    (0x06, 0, 0, 0x40000),     # ret #262144         ; accept
+    (0x06, 0, 0, 0),           # ret #0              ; drop
+]
+
+# tpacket2_hdr: status, len, snaplen, mac, net, sec, nsec, vlan_tci, vlan_tpid
+TPACKET2_HDR = struct.Struct("IIIHHIIHH")
+
+RING_BLOCK_SIZE = 1 << 20      # 1 MiB на блок
+RING_BLOCK_NR = 16
+RING_FRAME_SIZE = 512          # хватает на заголовки, хвост кадра ядро обрезает
+
+_ip_fields = struct.Struct("!B8xB2x4s")     # ver/ihl, proto, src
+_port_field = struct.Struct("!2xH")          # dport
+_tcp_fields = struct.Struct("!2xH9xB")       # dport, флаги
+
+
+def compile_bpf(program):
+    """Упаковать программу cBPF в буфер struct sock_filter[]."""
+    return b"".join(struct.pack("HBBI", *insn) for insn in program)
+
+
+def attach_filter(sock, program):
+    code = compile_bpf(program)
+    buf = ctypes.create_string_buffer(code, len(code))
+    # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    fprog = struct.pack("HP", len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def countable_ipv4(buf, offset):
+    """IPv4 и не хвостовой фрагмент - те же пакеты, что пропускает BPF_IPV4_TCP_UDP_ICMP.
+
+    Общее правило для потокового разбора pcap и batch-движка.
+    """
+    return buf[offset] >> 4 == 4 and not ((buf[offset + 6] << 8) | buf[offset + 7]) & IP_FRAG_OFFSET
+
+
+def parse_ipv4(buf, offset, end):
+    """Разобрать фиксированные поля IPv4 в buf[offset:end].
+
+    Возвращает (src_ip, proto, dst_port, flags): flags - флаги TCP или тип ICMP;
+    dst_port = 0 для ICMP и коротких пакетов.
+    """
+    ver_ihl, proto, src = _ip_fields.unpack_from(buf, offset)
+    dst_port = 0
+    flags = 0
+    l4_offset = offset + (ver_ihl & 0x0f) * 4
+    if proto == IPPROTO_ICMP:
+        if l4_offset < end:
+            flags = buf[l4_offset]
+    elif proto == IPPROTO_TCP and l4_offset + 14 <= end:
+        dst_port, flags = _tcp_fields.unpack_from(buf, l4_offset)
+    elif l4_offset + 4 <= end:
+        dst_port = _port_field.unpack_from(buf, l4_offset)[0]
+    return socket.inet_ntoa(src), proto, dst_port, flags
+
+
+def raw_capture_available():
+    return hasattr(socket, "AF_PACKET") and os.geteuid() == 0
+
+
+class RawCapture:
+    """Захват через AF_PACKET с фильтром BPF в ядре и кольцом PACKET_MMAP.
+
+    Разбираются только фиксированные поля заголовков через struct прямо
+    в разделяемой с ядром памяти, без scapy. Если кольцо настроить не удалось,
+    кадры читаются через recv_into в заранее выделенный буфер.
+    Рассчитан на интерфейсы с Ethernet-заголовком (включая lo).
+    С profiler (profiler.Profiler) считаются кадры и выборочно замеряются
+    этапы parse (разбор заголовков) и submit (обработчик).
+    """
+
+    def __init__(self, iface=None, use_mmap=True, program=BPF_IPV4_TCP_UDP_ICMP, profiler=None):
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_IP))
+        attach_filter(self.sock, program)
+        if iface:
+            self.sock.bind((iface, ETH_P_IP))
+        self.ring = None
+        self.frame_nr = 0
+        self.frame_index = 0
+        self.buf = None
+        if use_mmap:
+            try:
+                self._setup_ring()
+            except OSError:
+                self.ring = None
+        self.received = 0
+        self.profiler = profiler
+        self.parse = profiler.wrap('parse', parse_ipv4) if profiler else parse_ipv4
+
+    def _setup_ring(self):
+        self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V2)
+        frames_per_block = RING_BLOCK_SIZE // RING_FRAME_SIZE
+        self.frame_nr = frames_per_block * RING_BLOCK_NR
+        req = struct.pack("IIII", RING_BLOCK_SIZE, RING_BLOCK_NR, RING_FRAME_SIZE, self.frame_nr)
+        self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+        self.ring = mmap.mmap(self.sock.fileno(), RING_BLOCK_SIZE * RING_BLOCK_NR,
+                              mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        self.sock.close()
+
+    def run(self, handler, timeout=None, stop_event=None):
+        """Читать кадры пачками и вызывать handler(src_ip, proto, dst_port, size, ts, flags).
+
+        Работает до истечения timeout секунд или установки stop_event.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN)
+        read_batch = self._read_ring if self.ring is not None else self._read_socket
+        profiler = self.profiler
+        if profiler:
+            handler = profiler.wrap('submit', handler)
+
+        while not (stop_event and stop_event.is_set()):
+            if deadline and time.monotonic() >= deadline:
+                break
+            n = read_batch(handler)
+            if not n:
+                poller.poll(100)
+            elif profiler:
+                profiler.count('capture', n)
+
+    def _read_ring(self, handler):
+        """Разобрать все кадры, готовые в кольце; вернуть их число."""
+        ring = self.ring
+        frame_nr = self.frame_nr
+        unpack_hdr = TPACKET2_HDR.unpack_from
+        parse = self.parse
+        index = self.frame_index
+        n = 0
+        while True:
+            base = index * RING_FRAME_SIZE
+            status, length, snaplen, mac, net, sec, nsec, _, _ = unpack_hdr(ring, base)
+            if not status & TP_STATUS_USER:
+                break
+            if snaplen >= net - mac + 20:
+                try:
+                    src_ip, proto, dst_port, flags = parse(ring, base + net, base + mac + snaplen)
+                    handler(src_ip, proto, dst_port, length, sec + nsec * 1e-9, flags)
+                except struct.error:
+                    pass
+            # Вернуть кадр ядру
+            struct.pack_into("I", ring, base, TP_STATUS_KERNEL)
+            index = (index + 1) % frame_nr
+            n += 1
+        self.frame_index = index
+        self.received += n
+        return n
+
+    def _read_socket(self, handler):
+        if self.buf is None:
+            self.buf = bytearray(65536)
+        buf = self.buf
+        parse = self.parse
+        n = 0
+        while True:
+            try:
+                length = self.sock.recv_into(buf, len(buf), socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            n += 1
+            if length < ETH_HLEN + 20:
+                continue
+            try:
+                src_ip, proto, dst_port, flags = parse(buf, ETH_HLEN, length)
+            except struct.error:
+                continue
+            handler(src_ip, proto, dst_port, length, time.time(), flags)
+        self.received += n
+        return n
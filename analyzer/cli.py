@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""Анализатор трафика без GUI: разбор pcap/pcapng и живой захват.
+
+Срабатывания выводятся в JSONL (по строке на подозрительный IP), сводка
+с пакетами в секунду - в stderr.
+
+    python cli.py replay incident.pcapng rotated_dir/ -o detections.jsonl
+    python cli.py batch huge.pcap --cross-check
+    sudo python cli.py live --iface eth0 --duration 60 --workers 4 --store
+    python cli.py events top --hours 24
+"""
+import sys
+import json
+import time
+import argparse
+
+from detector import make_detector, Thresholds, DEFAULT_THRESHOLDS, RULE_LABELS, DETECTORS
+from capture import IPPROTO_TCP
+from pcapio import list_captures, iter_fields
+from rules import load_rules
+from blocker import make_blocker, reapply_blocks, BlockError, DEFAULT_TIMEOUT
+from events import EventStore, EVENTS_FILE
+from profiler import start_profiling
+
+
+def thresholds_from_args(args):
+    return Thresholds(
+        not args.no_size, not args.no_ports, not args.no_repeat,
+        args.max_size, args.port_thresh, args.repeat_thresh, args.repeat_window,
+    )
+
+
+def detection_record(det, source=None):
+    record = {
+        'ts': round(det.ts, 6),
+        'ip': det.ip,
+        'rule': det.rule,
+        'label': RULE_LABELS[det.rule],
+        'detail': det.detail,
+    }
+    if source:
+        record['source'] = source
+    return record
+
+
+def write_detection(out, det, source=None, store=None):
+    out.write(json.dumps(detection_record(det, source), ensure_ascii=False) + "\n")
+    if store is not None:
+        store.add(det, source)
+
+
+def block(blocker, ips):
+    """Заблокировать накопленные адреса одной транзакцией."""
+    if blocker is None or not ips:
+        return
+    try:
+        blocker.block(ips)
+    except BlockError as e:
+        print(f"block failed: {e}", file=sys.stderr)
+
+
+def replay(args, out):
+    """Прогнать файлы захвата через детектор с максимальной скоростью."""
+    blocker = make_blocker(args.block, args.block_timeout, args.store) if args.block else None
+    detector = make_detector(args.mode, thresholds_from_args(args), args.window, args.rules)
+    process = detector.process
+    profiler = args.profiler
+    if profiler:
+        process = profiler.wrap('detect', process)
+    packets = 0
+    tcp_packets = 0
+    detections = 0
+    started = time.perf_counter()
+
+    for path in list_captures(args.paths):
+        file_started = time.perf_counter()
+        file_packets = 0
+        to_block = []
+        try:
+            fields = iter_fields(path)
+            if profiler:
+                fields = profiler.iterate('parse', fields)
+            for src_ip, proto, dst_port, size, ts, flags in fields:
+                file_packets += 1
+                if proto == IPPROTO_TCP:
+                    tcp_packets += 1
+                for det in process(src_ip, dst_port, size, ts, proto, flags):
+                    write_detection(out, det, path, args.store)
+                    to_block.append(det.ip)
+                    detections += 1
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            continue
+        finally:
+            block(blocker, to_block)
+        packets += file_packets
+        elapsed = time.perf_counter() - file_started
+        if args.verbose:
+            print(f"{path}: {file_packets} packets, {file_packets / max(elapsed, 1e-9):.0f} pkt/s",
+                  file=sys.stderr)
+
+    elapsed = time.perf_counter() - started
+    report(packets, tcp_packets, detections, elapsed, detector)
+
+
+def batch(args, out):
+    """Пакетный разбор на NumPy (только классический pcap)."""
+    import batch as batch_engine
+
+    blocker = make_blocker(args.block, args.block_timeout, args.store) if args.block else None
+    thresholds = thresholds_from_args(args)
+    packets = 0
+    detections = 0
+    mismatches = 0
+    started = time.perf_counter()
+    for path in list_captures(args.paths):
+        try:
+            data = batch_engine.load_pcap(path)
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            continue
+        packets += len(data)
+        found = batch_engine.analyze(data, thresholds)
+        for det in found:
+            write_detection(out, det, path, args.store)
+            detections += 1
+        block(blocker, [det.ip for det in found])
+        if args.cross_check:
+            same, only_batch, only_stream = batch_engine.cross_check(path, thresholds)
+            if not same:
+                mismatches += 1
+                print(json.dumps({'source': path, 'only_batch': sorted(only_batch),
+                                  'only_stream': sorted(only_stream)}), file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    report(packets, packets, detections, elapsed, None)
+    if mismatches:
+        sys.exit(1)
+
+
+def live(args, out):
+    """Живой захват без дисплея: AF_PACKET (один или несколько процессов)."""
+    from capture import RawCapture
+    from pipeline import DetectionPipeline
+    from sharding import ShardedCapture
+    from metrics import MetricsExporter
+
+    blocker = make_blocker(args.block, args.block_timeout, args.store) if args.block else None
+    thresholds = thresholds_from_args(args)
+    detections = 0
+    started = time.perf_counter()
+
+    if args.workers > 1:
+        pipeline = ShardedCapture(args.workers, args.iface, thresholds, mode=args.mode,
+                                  window=args.window, rules=args.rules, profile=args.profile)
+        pipeline.start()
+        capture = None
+    else:
+        pipeline = DetectionPipeline(thresholds, mode=args.mode, window=args.window, rules=args.rules,
+                                     profiler=args.profiler)
+        pipeline.start()
+        capture = RawCapture(args.iface, profiler=args.profiler)
+
+    exporter = MetricsExporter(pipeline, profiler=args.profiler)
+    if args.metrics_port:
+        exporter.serve(args.metrics_port)
+    if args.metrics_file:
+        exporter.start_textfile(args.metrics_file)
+
+    def handler(src_ip, proto, dst_port, packet_size, ts, flags):
+        pipeline.submit(src_ip, dst_port, packet_size, ts, proto, flags)
+
+    deadline = time.monotonic() + args.duration if args.duration else None
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            step = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+            if capture is not None:
+                capture.run(handler, timeout=max(step, 0.01))
+            else:
+                time.sleep(max(step, 0))
+            found = pipeline.drain()
+            for det in found:
+                write_detection(out, det, store=args.store)
+                detections += 1
+            block(blocker, [det.ip for det in found])
+            out.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if capture is not None:
+            capture.close()
+        pipeline.stop()
+        exporter.stop()
+        if args.metrics_file:
+            exporter.write_textfile(args.metrics_file)
+    found = pipeline.drain()
+    for det in found:
+        write_detection(out, det, store=args.store)
+        detections += 1
+    block(blocker, [det.ip for det in found])
+
+    stats = pipeline.stats()
+    elapsed = time.perf_counter() - started
+    # В живом захвате детектор получает все протоколы, отдельного счёта TCP нет
+    report(stats['processed'], None, detections, elapsed, None, dropped=stats['dropped'])
+
+
+def events(args, out):
+    """Запросы к журналу событий."""
+    store = EventStore(args.db)
+    since = time.time() - args.hours * 3600 if args.hours else 0
+    if args.query == 'top':
+        for ip, count, last_ts, rules in store.top_offenders(since, args.limit):
+            out.write(json.dumps({'ip': ip, 'detections': count, 'last_ts': round(last_ts, 6),
+                                  'rules': rules.split(',')}) + "\n")
+    elif args.query == 'list':
+        for ts, ip, rule, detail, source in store.recent(args.limit, since, args.ip, args.rule):
+            record = {'ts': round(ts, 6), 'ip': ip, 'rule': rule,
+                      'label': RULE_LABELS.get(rule, rule), 'detail': detail}
+            if source:
+                record['source'] = source
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+    elif args.query == 'blocked':
+        for ip, (backend, expires) in sorted(store.active_blocks().items()):
+            out.write(json.dumps({'ip': ip, 'backend': backend, 'expires': expires or None}) + "\n")
+    else:
+        blocker = make_blocker(args.block, args.block_timeout, store)
+        try:
+            restored = reapply_blocks(blocker, store)
+        except BlockError as e:
+            print(f"reapply failed: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps({'restored': restored}), file=sys.stderr)
+    store.close()
+
+
+def report(packets, tcp_packets, detections, elapsed, detector, dropped=0):
+    rate = packets / elapsed if elapsed > 0 else 0.0
+    summary = {
+        'packets': packets,
+        'tcp_packets': tcp_packets,
+        'detections': detections,
+        'seconds': round(elapsed, 3),
+        'packets_per_sec': round(rate),
+        'dropped': dropped,
+    }
+    if detector is not None:
+        summary['tracked_ips'] = len(detector.ips)
+        summary['evicted_ips'] = detector.evicted
+    print(json.dumps(summary), file=sys.stderr)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Headless traffic analyzer')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-o', '--output', default='-', help='JSONL file for detections (default: stdout)')
+    common.add_argument('--mode', choices=sorted(DETECTORS), default='exact',
+                        help='exact: precise per-IP state, approx: fixed-memory sketches')
+    common.add_argument('--max-size', type=int, default=DEFAULT_THRESHOLDS.max_size)
+    common.add_argument('--port-thresh', type=int, default=DEFAULT_THRESHOLDS.port_thresh)
+    common.add_argument('--repeat-thresh', type=int, default=DEFAULT_THRESHOLDS.repeat_thresh)
+    common.add_argument('--repeat-window', type=float, default=DEFAULT_THRESHOLDS.repeat_window)
+    common.add_argument('--window', type=float, default=None,
+                        help='reset per-IP statistics every N seconds (detections carry over)')
+    common.add_argument('--no-size', action='store_true', help='disable large packet rule')
+    common.add_argument('--no-ports', action='store_true', help='disable port scan rule')
+    common.add_argument('--no-repeat', action='store_true', help='disable repeated requests rule')
+    common.add_argument('--rules', default=None, metavar='FILE',
+                        help='JSON rule set (see rules.json); default: all built-in rules')
+    common.add_argument('--block', default=None, metavar='BACKEND',
+                        help='auto-block detected IPs: ipset, nft, dryrun or dryrun:FILE')
+    common.add_argument('--block-timeout', type=int, default=DEFAULT_TIMEOUT,
+                        help='seconds until a block expires, 0 = never')
+    common.add_argument('--store', nargs='?', const=EVENTS_FILE, default=None, metavar='DB',
+                        help=f'also append detections and blocks to the event store (default {EVENTS_FILE})')
+    common.add_argument('--profile', default=None, metavar='FILE',
+                        help='sample per-stage timings and thread stacks; write FILE (JSON) '
+                             'and FILE.folded every 30 s and on exit')
+    common.add_argument('-v', '--verbose', action='store_true')
+
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_replay = sub.add_parser('replay', parents=[common], help='analyze pcap/pcapng files or directories')
+    p_replay.add_argument('paths', nargs='+')
+    p_batch = sub.add_parser('batch', parents=[common], help='vectorized NumPy analysis of pcap files')
+    p_batch.add_argument('paths', nargs='+')
+    p_batch.add_argument('--cross-check', action='store_true',
+                         help='also run the streaming detector and fail on any difference')
+    p_live = sub.add_parser('live', parents=[common], help='capture from an interface (root)')
+    p_live.add_argument('--iface', default=None)
+    p_live.add_argument('--duration', type=float, default=15, help='seconds, 0 = until Ctrl+C')
+    p_live.add_argument('--workers', type=int, default=1, help='PACKET_FANOUT capture processes')
+    p_live.add_argument('--metrics-port', type=int, default=0,
+                        help='serve Prometheus metrics on 127.0.0.1:PORT/metrics')
+    p_live.add_argument('--metrics-file', default=None,
+                        help='write Prometheus textfile every 10 s')
+    p_events = sub.add_parser('events', help='query the persistent event store')
+    p_events.add_argument('query', choices=['top', 'list', 'blocked', 'reapply'],
+                          help='top offenders, recent detections, active blocks, '
+                               'or re-apply active blocks after a reboot')
+    p_events.add_argument('--db', default=EVENTS_FILE)
+    p_events.add_argument('-o', '--output', default='-')
+    p_events.add_argument('--hours', type=float, default=24, help='look back N hours, 0 = all')
+    p_events.add_argument('--limit', type=int, default=20)
+    p_events.add_argument('--ip', default=None)
+    p_events.add_argument('--rule', default=None)
+    p_events.add_argument('--block', default='ipset', metavar='BACKEND',
+                          help='backend for reapply: ipset, nft, dryrun or dryrun:FILE')
+    p_events.add_argument('--block-timeout', type=int, default=DEFAULT_TIMEOUT)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'events':
+        out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+        try:
+            events(args, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return
+    if args.rules:
+        try:
+            args.rules = load_rules(args.rules)
+        except (OSError, ValueError) as e:
+            parser.error(f"--rules: {e}")
+    if args.store:
+        args.store = EventStore(args.store)
+        args.store.start()
+    args.profiler, dumper = start_profiling(args.profile) if args.profile else (None, None)
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        if args.command == 'replay':
+            replay(args, out)
+        elif args.command == 'batch':
+            batch(args, out)
+        else:
+            live(args, out)
+    finally:
+        if dumper is not None:
+            dumper.stop()
+        if args.store:
+            args.store.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
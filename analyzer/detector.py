@@ -0,0 +1,306 @@
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+
+from capture import IPPROTO_TCP
+from rules import build_rules, compile_table, FLAG_MASKS, RULE_LABELS
+from sketches import PortBitmap, HyperLogLog, CountMinSketch, TopK
+
+# Снимок порогов: детектор не трогает tk-переменные из чужого потока
+Thresholds = namedtuple('Thresholds', [
+    'check_size', 'check_ports', 'check_repeat',
+    'max_size', 'port_thresh', 'repeat_thresh', 'repeat_window',
+], defaults=(5.0,))
+
+DEFAULT_THRESHOLDS = Thresholds(True, True, True, 500, 3, 10)
+
+MAX_TRACKED_IPS = 100000    # жёсткий предел числа отслеживаемых источников
+IDLE_TIMEOUT = 60.0         # источник без пакетов дольше этого забывается
+SWEEP_INTERVAL = 1.0        # как часто искать простаивающие источники
+
+# Сработавшее правило
+Detection = namedtuple('Detection', ['ip', 'rule', 'detail', 'ts'])
+
+
+class IpState:
+    """Компактное состояние одного источника.
+
+    ports - кортеж не больше чем из port_thresh + 1 портов (дальше правило уже
+    сработало), пустой кортеж не занимает памяти в отличие от set().
+    times - кольцо из repeat_thresh последних отметок времени; если отметка
+    repeat_thresh пакетов назад моложе окна, значит в окно попало больше
+    repeat_thresh пакетов (скользящее окно без хранения всей истории).
+    """
+
+    __slots__ = ('first_seen', 'last_seen', 'count', 'ports', 'times', 'pos', 'extra')
+
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_seen = now
+        self.count = 0
+        self.ports = ()
+        self.times = None
+        self.pos = 0
+        self.extra = None       # состояние дополнительных правил: {имя: ...}
+
+
+class Detector:
+    """Правила обнаружения без привязки к GUI.
+
+    Состояние по источникам лежит в LRU-словаре: при каждом пакете запись
+    переносится в конец, поэтому в начале всегда самые давно молчавшие
+    источники - их вытесняет предел MAX_TRACKED_IPS и чистка по IDLE_TIMEOUT.
+    Если задан window (секунды), статистика по источникам обнуляется в начале
+    каждого окна, а найденные подозрительные IP переходят в следующее окно.
+    Правила подключаются списком описаний (rules.py) и компилируются в
+    таблицу проверок по протоколу и флагам с подставленными порогами; таблица
+    пересобирается при смене порогов.
+    """
+
+    def __init__(self, thresholds=DEFAULT_THRESHOLDS, max_tracked=MAX_TRACKED_IPS,
+                 idle_timeout=IDLE_TIMEOUT, window=None, rules=None):
+        self.rules = build_rules(rules)
+        self.thresholds = thresholds
+        self.max_tracked = max_tracked
+        self.idle_timeout = idle_timeout
+        self.window = window
+        self.suspicious_ips = set()
+        self.ips = OrderedDict()
+        self.rule_counts = dict.fromkeys(RULE_LABELS, 0)
+        self.evicted = 0
+        self.windows = 0
+        self.next_sweep = 0.0
+        self.window_end = None
+
+    @property
+    def thresholds(self):
+        return self._thresholds
+
+    @thresholds.setter
+    def thresholds(self, thresholds):
+        # Новая таблица подменяется целиком - поток детектора видит старую или новую
+        self._thresholds = thresholds
+        self.table = compile_table(self.rules, self, thresholds)
+
+    def reset(self):
+        self.suspicious_ips.clear()
+        self.ips.clear()
+        self.rule_counts = dict.fromkeys(RULE_LABELS, 0)
+        self.evicted = 0
+        self.windows = 0
+        self.next_sweep = 0.0
+        self.window_end = None
+
+    def rotate(self, current_time):
+        """Начать новое окно: забыть статистику, но не срабатывания."""
+        self.ips.clear()
+        self.windows += 1
+        self.window_end = current_time + self.window if self.window else None
+
+    def tick(self, current_time):
+        """Смена окна и чистка простаивающих источников по времени пакета."""
+        if self.window:
+            if self.window_end is None:
+                self.window_end = current_time + self.window
+            elif current_time >= self.window_end:
+                self.rotate(current_time)
+        if current_time >= self.next_sweep:
+            self.sweep(current_time)
+            self.next_sweep = current_time + SWEEP_INTERVAL
+
+    def _flag(self, src_ip, rule, detail, current_time):
+        if src_ip in self.suspicious_ips:
+            return None
+        self.suspicious_ips.add(src_ip)
+        self.rule_counts[rule] = self.rule_counts.get(rule, 0) + 1
+        return Detection(src_ip, rule, detail, current_time)
+
+    def _state(self, src_ip, current_time):
+        ips = self.ips
+        state = ips.get(src_ip)
+        if state is not None:
+            ips.move_to_end(src_ip)
+            return state
+        state = ips[src_ip] = IpState(current_time)
+        if len(ips) > self.max_tracked:
+            ips.popitem(last=False)
+            self.evicted += 1
+        return state
+
+    def sweep(self, current_time):
+        """Забыть источники, молчащие дольше idle_timeout."""
+        ips = self.ips
+        deadline = current_time - self.idle_timeout
+        while ips:
+            src_ip, state = next(iter(ips.items()))
+            if state.last_seen >= deadline:
+                break
+            del ips[src_ip]
+            self.evicted += 1
+
+    def compile_ports(self, th):
+        """Проверка сканирования портов с порогом, подставленным при компиляции."""
+        limit = th.port_thresh
+
+        def check(state, src_ip, dst_port, packet_size, current_time, flags):
+            ports = state.ports
+            if len(ports) <= limit and dst_port not in ports:
+                ports = state.ports = ports + (dst_port,)
+            if len(ports) > limit:
+                return f"Сканирование портов ({len(ports)} портов)"
+            return None
+
+        return check
+
+    def compile_repeat(self, th):
+        """Проверка повторяющихся запросов в скользящем окне repeat_window."""
+        limit = th.repeat_thresh
+        window = th.repeat_window
+        detail = f"Повторяющиеся запросы (>{limit} за {window:g} с)"
+        empty = array('d', [float('-inf')])
+
+        def check(state, src_ip, dst_port, packet_size, current_time, flags):
+            if limit <= 0:
+                return detail
+            times = state.times
+            if times is None or len(times) != limit:
+                times = state.times = empty * limit
+                state.pos = 0
+            pos = state.pos
+            oldest = times[pos]
+            times[pos] = current_time
+            state.pos = (pos + 1) % limit
+            if current_time - oldest < window:
+                return detail
+            return None
+
+        return check
+
+    def process(self, src_ip, dst_port, packet_size, current_time, proto=IPPROTO_TCP, flags=0):
+        """Прогнать один пакет через правила его протокола, вернуть список срабатываний."""
+        self.tick(current_time)
+
+        state = self._state(src_ip, current_time)
+        state.last_seen = current_time
+        state.count += 1
+
+        detections = []
+        checks = self.table.get(proto << 8 | flags & FLAG_MASKS.get(proto, 0))
+        if checks:
+            for rule, check in checks:
+                detail = check(state, src_ip, dst_port, packet_size, current_time, flags)
+                if detail:
+                    det = self._flag(src_ip, rule, detail, current_time)
+                    if det:
+                        detections.append(det)
+        return detections
+
+
+class ApproxState:
+    """Состояние источника в приближённом режиме: битовая маска портов и счётчик."""
+
+    __slots__ = ('last_seen', 'count', 'ports', 'extra')
+
+    def __init__(self, now):
+        self.last_seen = now
+        self.count = 0
+        self.ports = 0
+        self.extra = None
+
+
+class ApproxDetector(Detector):
+    """Приближённые правила с O(1) на пакет и фиксированной памятью.
+
+    Различные порты источника считаются линейным счётчиком по маске из
+    port_bits бит, повторяющиеся запросы - Count-Min Sketch по окнам
+    repeat_window (окна сменяют друг друга, а не скользят), самые активные
+    источники окна держатся в TopK. Общее число различных источников
+    оценивает HyperLogLog.
+    """
+
+    def __init__(self, thresholds=DEFAULT_THRESHOLDS, max_tracked=MAX_TRACKED_IPS,
+                 idle_timeout=IDLE_TIMEOUT, window=None, port_bits=64, cms_eps=0.0005,
+                 cms_delta=0.01, top_k=20, hll_p=12, rules=None):
+        # Скетчи нужны до компиляции правил в Detector.__init__
+        self.port_counter = PortBitmap(port_bits)
+        self.sketch = CountMinSketch(cms_eps, cms_delta)
+        self.top = TopK(top_k)
+        self.sources = HyperLogLog(hll_p)
+        self.sketch_end = None
+        super().__init__(thresholds, max_tracked, idle_timeout, window, rules)
+
+    def reset(self):
+        super().reset()
+        self.sketch.clear()
+        self.top.clear()
+        self.sources.clear()
+        self.sketch_end = None
+
+    def rotate(self, current_time):
+        super().rotate(current_time)
+        self.sources.clear()
+
+    def _state(self, src_ip, current_time):
+        self.sources.add(src_ip)
+        ips = self.ips
+        state = ips.get(src_ip)
+        if state is not None:
+            ips.move_to_end(src_ip)
+            return state
+        state = ips[src_ip] = ApproxState(current_time)
+        if len(ips) > self.max_tracked:
+            ips.popitem(last=False)
+            self.evicted += 1
+        return state
+
+    def top_talkers(self):
+        """Самые активные источники текущего окна: [(ip, оценка), ...]."""
+        return self.top.items()
+
+    def compile_ports(self, th):
+        limit = th.port_thresh
+        counter = self.port_counter
+        add = counter.add
+        estimate = counter.estimate
+
+        def check(state, src_ip, dst_port, packet_size, current_time, flags):
+            state.ports = add(state.ports, dst_port)
+            ports = estimate(state.ports)
+            if ports > limit:
+                return f"Сканирование портов (~{ports:.0f} портов)"
+            return None
+
+        return check
+
+    def compile_repeat(self, th):
+        limit = th.repeat_thresh
+        window = th.repeat_window
+        sketch_add = self.sketch.add
+        top_update = self.top.update
+
+        def check(state, src_ip, dst_port, packet_size, current_time, flags):
+            end = self.sketch_end
+            if end is None or current_time >= end:
+                self.sketch.clear()
+                self.top.clear()
+                self.sketch_end = current_time + window
+            count = sketch_add(src_ip)
+            top_update(src_ip, count)
+            if count > limit:
+                return f"Повторяющиеся запросы (~{count} за {window:g} с)"
+            return None
+
+        return check
+
+
+DETECTORS = {
+    'exact': Detector,
+    'approx': ApproxDetector,
+}
+
+
+def make_detector(mode='exact', thresholds=DEFAULT_THRESHOLDS, window=None, rules=None):
+    """rules - список описаний правил (см. rules.py), None - DEFAULT_RULES."""
+    if mode not in DETECTORS:
+        raise ValueError(f"unknown detector mode: {mode}")
+    return DETECTORS[mode](thresholds, window=window, rules=rules)
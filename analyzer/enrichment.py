@@ -0,0 +1,240 @@
+import os
+import csv
+import json
+import time
+import socket
+import struct
+import bisect
+import threading
+import ipaddress
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+CACHE_FILE = os.path.expanduser("~/.cache/traffic_monitor/isp_cache.json")
+CACHE_MAX_ENTRIES = 50000
+CACHE_TTL = 7 * 24 * 3600        # удачный ответ живёт неделю
+NEGATIVE_TTL = 15 * 60           # неудачный - 15 минут, чтобы не долбить API
+UNKNOWN_ISP = "Unknown ISP"
+PENDING_ISP = "..."
+
+
+def ip_to_int(ip):
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+class IspCache:
+    """LRU-кэш с TTL и негативными записями, сохраняемый на диск.
+
+    Значение None означает закэшированную неудачу.
+    """
+
+    def __init__(self, path=CACHE_FILE, max_entries=CACHE_MAX_ENTRIES,
+                 ttl=CACHE_TTL, negative_ttl=NEGATIVE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()     # ip -> (expires, info)
+        self.lock = threading.Lock()
+
+    def get(self, ip):
+        """Вернуть (найдено, info); просроченные записи удаляются."""
+        with self.lock:
+            entry = self.entries.get(ip)
+            if entry is None:
+                return False, None
+            expires, info = entry
+            if expires < time.time():
+                del self.entries[ip]
+                return False, None
+            self.entries.move_to_end(ip)
+            return True, info
+
+    def put(self, ip, info):
+        ttl = self.ttl if info is not None else self.negative_ttl
+        with self.lock:
+            self.entries[ip] = (time.time() + ttl, info)
+            self.entries.move_to_end(ip)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self.lock:
+            # Файл записан в порядке LRU -> MRU, порядок сохраняется
+            for ip, expires, info in data:
+                if expires > now:
+                    self.entries[ip] = (expires, info)
+                    self.entries.move_to_end(ip)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = [[ip, expires, info] for ip, (expires, info) in self.entries.items()]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+class IpApiBackend:
+    """Онлайн-источник ip-api.com (медленный, только в пуле потоков)."""
+
+    offline = False
+
+    def __init__(self, timeout=3):
+        self.timeout = timeout
+
+    def lookup(self, ip):
+        if requests is None:
+            return None
+        try:
+            response = requests.get(f"http://ip-api.com/json/{ip}", timeout=self.timeout)
+            data = response.json()
+            if data.get('status') == 'success':
+                return f"{data.get('isp', 'Unknown')} ({data.get('country', 'Unknown')})"
+        except Exception:
+            pass
+        return None
+
+
+class CidrTableBackend:
+    """Локальная таблица CIDR -> ASN/провайдер с двоичным поиском.
+
+    CSV-файл со столбцами: network,asn,isp,country (например 8.8.8.0/24,15169,Google,US).
+    Пересекающиеся сети не поддерживаются: побеждает сеть с меньшим началом.
+    """
+
+    offline = True
+
+    def __init__(self, path):
+        rows = []
+        with open(path, newline='') as f:
+            for row in csv.reader(f):
+                if not row or row[0].startswith('#'):
+                    continue
+                try:
+                    net = ipaddress.IPv4Network(row[0].strip(), strict=False)
+                except ValueError:
+                    continue
+                asn = row[1].strip() if len(row) > 1 else ''
+                isp = row[2].strip() if len(row) > 2 else 'Unknown'
+                country = row[3].strip() if len(row) > 3 else 'Unknown'
+                label = f"{isp} ({country})"
+                if asn:
+                    label = f"AS{asn} {label}"
+                rows.append((int(net.network_address), int(net.broadcast_address), label))
+        rows.sort()
+        self.starts = [r[0] for r in rows]
+        self.ends = [r[1] for r in rows]
+        self.labels = [r[2] for r in rows]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, ip):
+        try:
+            addr = ip_to_int(ip)
+        except OSError:
+            return None
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr <= self.ends[i]:
+            return self.labels[i]
+        return None
+
+
+class Enricher:
+    """Неблокирующее дополнение IP сведениями о провайдере.
+
+    request(ip) сразу отвечает из кэша или офлайн-таблицы, а сетевые запросы
+    уходят в пул потоков; готовые ответы забираются через drain().
+    С profiler замеряются этапы enrich (ответ GUI) и enrich_resolve (запрос в пуле).
+    """
+
+    def __init__(self, backends, cache=None, workers=4, profiler=None):
+        self.offline_backends = [b for b in backends if b.offline]
+        self.online_backends = [b for b in backends if not b.offline]
+        self.cache = cache if cache is not None else IspCache()
+        self.workers = workers
+        self.executor = None
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.results = deque()
+        self.latency_sum = 0.0      # суммарное время онлайн-запросов, с
+        self.latency_count = 0
+        if profiler:
+            # Подмена на уровне экземпляра: без профилировщика вызовы не меняются
+            self.request = profiler.wrap('enrich', self.request, every=1)
+            self._resolve = profiler.wrap('enrich_resolve', self._resolve, every=1)
+
+    def start(self):
+        self.cache.load()
+        with self.pending_lock:
+            if self.online_backends and self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                   thread_name_prefix="enrich")
+
+    def stop(self):
+        """Дождаться текущих запросов и сохранить кэш."""
+        # Пул снимается под замком: request() после этого в него уже не отправит
+        with self.pending_lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        self.cache.save()
+
+    def request(self, ip):
+        """Вернуть сведения, если они уже известны, иначе PENDING_ISP."""
+        found, info = self.cache.get(ip)
+        if found:
+            return info or UNKNOWN_ISP
+
+        for backend in self.offline_backends:
+            info = backend.lookup(ip)
+            if info is not None:
+                self.cache.put(ip, info)
+                return info
+
+        with self.pending_lock:
+            if self.executor is None:
+                return UNKNOWN_ISP
+            if ip in self.pending:
+                return PENDING_ISP
+            self.pending.add(ip)
+            self.executor.submit(self._resolve, ip)
+        return PENDING_ISP
+
+    def _resolve(self, ip):
+        started = time.monotonic()
+        info = None
+        for backend in self.online_backends:
+            info = backend.lookup(ip)
+            if info is not None:
+                break
+        # None тоже кэшируется - как негативная запись
+        self.cache.put(ip, info)
+        with self.pending_lock:
+            self.pending.discard(ip)
+            self.latency_sum += time.monotonic() - started
+            self.latency_count += 1
+        self.results.append((ip, info or UNKNOWN_ISP))
+
+    def drain(self):
+        out = []
+        while self.results:
+            out.append(self.results.popleft())
+        return out
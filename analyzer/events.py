@@ -0,0 +1,233 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import deque
+
+EVENTS_FILE = os.path.expanduser("~/.local/share/traffic_monitor/events.sqlite3")
+COMMIT_INTERVAL = 0.5       # секунд между групповыми коммитами
+COMMIT_BATCH = 1000         # или раньше, если накопилось столько записей
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,           -- время пакета
+    recorded REAL NOT NULL,     -- время записи
+    ip TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    detail TEXT NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS detections_ts ON detections(ts, ip, rule);
+CREATE INDEX IF NOT EXISTS detections_ip ON detections(ip, ts);
+CREATE INDEX IF NOT EXISTS detections_rule ON detections(rule, ts);
+CREATE TABLE IF NOT EXISTS blocks (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    ip TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    expires REAL NOT NULL,      -- 0 - бессрочно
+    action TEXT NOT NULL        -- block / unblock
+);
+CREATE INDEX IF NOT EXISTS blocks_ip ON blocks(ip, ts);
+"""
+
+
+class EventStore:
+    """Журнал срабатываний и блокировок в SQLite (WAL), только дозапись.
+
+    add()/add_blocks() лишь кладут запись в очередь; отдельный поток пишет
+    накопленное одной транзакцией раз в COMMIT_INTERVAL или по COMMIT_BATCH
+    записей, поэтому ни захват, ни GUI не ждут диска. Чтение идёт через
+    отдельные соединения на каждый поток - WAL не блокирует читателей писателем.
+    """
+
+    def __init__(self, path=EVENTS_FILE, commit_interval=COMMIT_INTERVAL, commit_batch=COMMIT_BATCH):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        self.thread = None
+        self.running = False
+        self.written = 0
+        self.commits = 0
+        self.cycles = 0
+        self.error = None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.executescript(SCHEMA)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="event-store", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Дописать очередь и остановить поток записи."""
+        if not self.running:
+            return
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        self.thread = None
+
+    def add(self, det, source=None):
+        self.queue.append(('det', det.ts, det.ip, det.rule, det.detail, source))
+        self._wake()
+
+    def add_many(self, detections, source=None):
+        for det in detections:
+            self.queue.append(('det', det.ts, det.ip, det.rule, det.detail, source))
+        self._wake()
+
+    def add_blocks(self, ips, backend, timeout, action='block'):
+        now = time.time()
+        expires = now + timeout if timeout and action == 'block' else 0
+        for ip in ips:
+            self.queue.append(('block', now, ip, backend, expires, action))
+        self._wake()
+
+    def _wake(self):
+        if len(self.queue) >= self.commit_batch:
+            with self.cond:
+                self.cond.notify()
+
+    def flush(self):
+        """Дождаться записи всего, что уже в очереди."""
+        if not self.running:
+            conn = self._connect()
+            try:
+                self._write(conn)
+            finally:
+                conn.close()
+            return
+        with self.cond:
+            # Полный цикл записи должен начаться после вызова flush
+            target = self.cycles + 2
+            while self.running and self.cycles < target:
+                self.cond.notify_all()
+                self.cond.wait(0.1)
+
+    def _run(self):
+        conn = self._connect()
+        try:
+            while True:
+                with self.cond:
+                    if self.running and len(self.queue) < self.commit_batch:
+                        self.cond.wait(self.commit_interval)
+                    running = self.running
+                self._write(conn)
+                with self.cond:
+                    self.cycles += 1
+                    self.cond.notify_all()
+                if not running and not self.queue:
+                    break
+        finally:
+            conn.close()
+
+    def _write(self, conn):
+        detections = []
+        blocks = []
+        queue = self.queue
+        while queue:
+            item = queue.popleft()
+            if item[0] == 'det':
+                detections.append(item[1:])
+            else:
+                blocks.append(item[1:])
+        if not detections and not blocks:
+            return
+        now = time.time()
+        try:
+            with conn:
+                if detections:
+                    conn.executemany(
+                        "INSERT INTO detections (ts, recorded, ip, rule, detail, source) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [(ts, now, ip, rule, detail, source)
+                         for ts, ip, rule, detail, source in detections])
+                if blocks:
+                    conn.executemany(
+                        "INSERT INTO blocks (ts, ip, backend, expires, action) VALUES (?, ?, ?, ?, ?)",
+                        blocks)
+        except sqlite3.Error as e:
+            # Журнал вспомогательный: ошибка диска не должна ронять анализатор
+            self.error = str(e)
+            return
+        self.written += len(detections) + len(blocks)
+        self.commits += 1
+
+    # Запросы
+
+    def recent(self, limit=100, since=None, ip=None, rule=None):
+        """Последние срабатывания: [(ts, ip, rule, detail, source), ...], новые первыми."""
+        where = []
+        args = []
+        if since is not None:
+            where.append("ts >= ?")
+            args.append(since)
+        if ip:
+            where.append("ip = ?")
+            args.append(ip)
+        if rule:
+            where.append("rule = ?")
+            args.append(rule)
+        sql = "SELECT ts, ip, rule, detail, source FROM detections"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts DESC LIMIT ?"
+        args.append(limit)
+        return self._reader().execute(sql, args).fetchall()
+
+    def top_offenders(self, since, limit=20):
+        """[(ip, срабатываний, последнее ts, правила через запятую), ...] с момента since."""
+        # Диапазон по покрывающему индексу (ts, ip, rule), таблица не читается.
+        # Без подсказки планировщик выбирает полный проход по индексу ip ради GROUP BY
+        return self._reader().execute(
+            "SELECT ip, COUNT(*) AS n, MAX(ts), GROUP_CONCAT(DISTINCT rule) "
+            "FROM detections INDEXED BY detections_ts "
+            "WHERE ts >= ? GROUP BY ip ORDER BY n DESC, ip LIMIT ?",
+            (since, limit)).fetchall()
+
+    def rule_counts(self, since):
+        return dict(self._reader().execute(
+            "SELECT rule, COUNT(*) FROM detections INDEXED BY detections_ts "
+            "WHERE ts >= ? GROUP BY rule", (since,)))
+
+    def active_blocks(self, now=None):
+        """{ip: (backend, expires)} - последняя запись по адресу - блокировка, ещё не истекшая."""
+        now = now or time.time()
+        rows = self._reader().execute(
+            "SELECT ip, backend, expires, action FROM blocks b "
+            "WHERE id = (SELECT MAX(id) FROM blocks WHERE ip = b.ip)").fetchall()
+        return {ip: (backend, expires) for ip, backend, expires, action in rows
+                if action == 'block' and (not expires or expires > now)}
+
+    def close(self):
+        self.stop()
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
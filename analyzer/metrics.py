@@ -0,0 +1,154 @@
+import os
+import math
+import time
+import numbers
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "traffic_monitor"
+TEXTFILE_INTERVAL = 10      # секунд между записями textfile
+
+
+def _format_value(value):
+    """Значение в формате Prometheus: целые без округления, дробные с полной точностью."""
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class MetricsExporter:
+    """Счётчики анализатора в текстовом формате Prometheus.
+
+    Значения не хранятся, а снимаются при каждом запросе с источников:
+    stats() конвейера (DetectionPipeline/ShardedCapture), счётчиков правил
+    детектора, задержек Enricher и этапов Profiler. Отдаются по HTTP (/metrics на localhost)
+    и/или периодически пишутся в файл для textfile-коллектора node_exporter.
+    """
+
+    def __init__(self, pipeline, enricher=None, profiler=None):
+        self.pipeline = pipeline
+        self.enricher = enricher
+        self.profiler = profiler
+        self.started = time.time()
+        self.last_packets = 0
+        self.last_time = time.monotonic()
+        self.rate = 0.0
+        self.lock = threading.Lock()
+        self.server = None
+        self.stop_event = threading.Event()
+
+    def _packet_rate(self, packets):
+        # Мгновенная скорость между двумя снимками (для тех, кто не считает rate())
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.last_time
+            if elapsed >= 1.0 or packets < self.last_packets:
+                self.rate = max(packets - self.last_packets, 0) / elapsed
+                self.last_packets = packets
+                self.last_time = now
+            return self.rate
+
+    def samples(self):
+        """[(имя, тип, описание, [(суффикс, метки, значение), ...]), ...]"""
+        stats = self.pipeline.stats()
+        out = [
+            ('packets_total', 'counter', 'Packets handed to the detector',
+             [('', {}, stats['processed'])]),
+            ('packets_per_second', 'gauge', 'Packet rate since the previous scrape',
+             [('', {}, self._packet_rate(stats['processed']))]),
+            ('dropped_total', 'counter', 'Packets dropped on a full capture ring',
+             [('', {}, stats['dropped'])]),
+            ('queue_depth', 'gauge', 'Packets waiting in the capture ring',
+             [('', {}, stats['queued'])]),
+            ('tracked_ips', 'gauge', 'Sources with per-IP state in the current window',
+             [('', {}, stats.get('tracked', 0))]),
+            ('suspicious_ips', 'gauge', 'Distinct suspicious sources since start',
+             [('', {}, stats['suspicious'])]),
+            ('detections_total', 'counter', 'Detections by rule',
+             [('', {'rule': rule}, n) for rule, n in sorted(stats.get('rules', {}).items())]),
+            ('windows_total', 'counter', 'Completed statistics windows',
+             [('', {}, stats.get('windows', 0))]),
+            ('uptime_seconds', 'gauge', 'Seconds since the exporter started',
+             [('', {}, time.time() - self.started)]),
+        ]
+        if self.enricher is not None:
+            e = self.enricher
+            out.append(('enrichment_latency_seconds', 'summary', 'Online ISP lookup latency',
+                        [('_sum', {}, e.latency_sum),
+                         ('_count', {}, e.latency_count)]))
+            out.append(('enrichment_pending', 'gauge', 'ISP lookups in flight',
+                        [('', {}, len(e.pending))]))
+        if self.profiler is not None:
+            stages = sorted(self.profiler.stages.items())
+            out.append(('stage_calls_total', 'counter', 'Calls per instrumented stage',
+                        [('', {'stage': name}, s.calls) for name, s in stages]))
+            out.append(('stage_items_total', 'counter', 'Packets or records per instrumented stage',
+                        [('', {'stage': name}, s.items) for name, s in stages]))
+            out.append(('stage_sampled_seconds', 'summary', 'Sampled stage durations',
+                        [(suffix, {'stage': name}, value) for name, s in stages
+                         for suffix, value in (('_sum', s.total_ns / 1e9), ('_count', s.samples))]))
+        return out
+
+    def render(self):
+        lines = []
+        for name, kind, help_text, values in self.samples():
+            full = f"{PREFIX}_{name}"
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for suffix, labels, value in values:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                if label_text:
+                    label_text = "{" + label_text + "}"
+                lines.append(f"{full}{suffix}{label_text} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Атомарно записать снимок (rename поверх старого файла)."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def start_textfile(self, path, interval=TEXTFILE_INTERVAL):
+        def loop():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.write_textfile(path)
+                except OSError:
+                    pass
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
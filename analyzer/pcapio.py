@@ -0,0 +1,164 @@
+import os
+import gzip
+import struct
+
+from capture import parse_ipv4, countable_ipv4, ETH_P_IP
+
+# Типы канального уровня (LINKTYPE_*)
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+PCAP_EXTENSIONS = ('.pcap', '.pcapng', '.cap', '.pcap.gz', '.pcapng.gz')
+
+READ_CHUNK = 1 << 20
+
+_PCAP_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_SHB = b"\x0a\x0d\x0d\x0a"
+
+
+def open_capture(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb', buffering=READ_CHUNK)
+
+
+def list_captures(paths):
+    """Развернуть каталоги в отсортированный список файлов захвата."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(n for n in os.listdir(path) if n.endswith(PCAP_EXTENSIONS))
+            files.extend(os.path.join(path, n) for n in names)
+        else:
+            files.append(path)
+    return files
+
+
+def iter_packets(path):
+    """Потоково читать pcap/pcapng: (ts, wire_len, linktype, data).
+
+    data - memoryview на внутренний буфер, действителен до следующей итерации.
+    """
+    with open_capture(path) as f:
+        magic = f.read(4)
+        if magic == PCAPNG_SHB:
+            yield from _iter_pcapng(f, magic)
+        elif magic in _PCAP_MAGICS:
+            yield from _iter_pcap(f, *_PCAP_MAGICS[magic])
+        else:
+            raise ValueError(f"{path}: not a pcap/pcapng file")
+
+
+def _iter_pcap(f, endian, ts_scale):
+    header = f.read(20)
+    if len(header) < 20:
+        return
+    linktype = struct.unpack(endian + "16xI", header)[0] & 0x0fffffff
+    rec = struct.Struct(endian + "IIII")
+    rec_size = rec.size
+    buf = bytearray(65536 + rec_size)
+    view = memoryview(buf)
+    readinto = f.readinto
+    while True:
+        if readinto(view[:rec_size]) < rec_size:
+            return
+        sec, frac, caplen, wire_len = rec.unpack_from(buf)
+        if caplen > len(buf):
+            buf = bytearray(caplen)
+            view = memoryview(buf)
+        data = view[:caplen]
+        if readinto(data) < caplen:
+            return
+        yield sec + frac * ts_scale, wire_len, linktype, data
+
+
+def _iter_pcapng(f, first):
+    endian = "<"
+    interfaces = []     # (linktype, ts_scale) по номеру интерфейса
+    head = first + f.read(8)
+    while len(head) == 12:
+        block_type = struct.unpack(endian + "I", head[:4])[0]
+        if head[:4] == PCAPNG_SHB:
+            endian = "<" if head[8:12] == b"\x4d\x3c\x2b\x1a" else ">"
+            interfaces = []
+        block_len = struct.unpack(endian + "I", head[4:8])[0]
+        body = f.read(block_len - 12)
+        if len(body) < block_len - 12:
+            return
+        body = head[8:] + body
+        if block_type == 1:             # Interface Description Block
+            linktype = struct.unpack_from(endian + "H", body, 0)[0]
+            interfaces.append((linktype, _if_tsresol(body, endian)))
+        elif block_type == 6:           # Enhanced Packet Block
+            if_id, ts_high, ts_low, caplen, wire_len = struct.unpack_from(endian + "IIIII", body, 0)
+            linktype, ts_scale = interfaces[if_id] if if_id < len(interfaces) else (LINKTYPE_ETHERNET, 1e-6)
+            data = memoryview(body)[20:20 + caplen]
+            yield ((ts_high << 32) | ts_low) * ts_scale, wire_len, linktype, data
+        elif block_type == 3:           # Simple Packet Block: без отметки времени
+            wire_len = struct.unpack_from(endian + "I", body, 0)[0]
+            linktype, _ = interfaces[0] if interfaces else (LINKTYPE_ETHERNET, 1e-6)
+            caplen = min(wire_len, block_len - 16)
+            yield 0.0, wire_len, linktype, memoryview(body)[4:4 + caplen]
+        head = f.read(12)
+
+
+def _if_tsresol(body, endian):
+    """Разрешение отметок времени из опции if_tsresol (по умолчанию микросекунды)."""
+    offset = 8
+    while offset + 4 <= len(body):
+        code, length = struct.unpack_from(endian + "HH", body, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = body[offset + 4]
+            if value & 0x80:
+                return 2.0 ** -(value & 0x7f)
+            return 10.0 ** -value
+        offset += 4 + ((length + 3) & ~3)
+    return 1e-6
+
+
+def ip_offset(linktype, data):
+    """Смещение IPv4-заголовка в кадре или -1, если это не IPv4."""
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 34:
+            return -1
+        ethertype = (data[12] << 8) | data[13]
+        if ethertype == 0x8100 and len(data) >= 38:     # один тег VLAN
+            ethertype = (data[16] << 8) | data[17]
+            return 18 if ethertype == ETH_P_IP else -1
+        return 14 if ethertype == ETH_P_IP else -1
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return 0 if len(data) >= 20 and data[0] >> 4 == 4 else -1
+    if linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 36:
+            return -1
+        return 16 if ((data[14] << 8) | data[15]) == ETH_P_IP else -1
+    if linktype == LINKTYPE_LINUX_SLL2:
+        if len(data) < 40:
+            return -1
+        return 20 if ((data[0] << 8) | data[1]) == ETH_P_IP else -1
+    return -1
+
+
+def iter_fields(path):
+    """(src_ip, proto, dst_port, wire_len, ts, flags) для IPv4-пакетов файла.
+
+    Хвостовые фрагменты пропускаются, как и фильтром BPF при живом захвате.
+    """
+    for ts, wire_len, linktype, data in iter_packets(path):
+        offset = ip_offset(linktype, data)
+        if offset < 0:
+            continue
+        if not countable_ipv4(data, offset):
+            continue
+        src_ip, proto, dst_port, flags = parse_ipv4(data, offset, len(data))
+        yield src_ip, proto, dst_port, wire_len, ts, flags
@@ -0,0 +1,141 @@
+import time
+import threading
+from collections import deque
+
+from capture import IPPROTO_TCP
+from detector import make_detector, DEFAULT_THRESHOLDS
+
+RING_SIZE = 65536      # записей в кольцевом буфере
+BATCH_SIZE = 512       # сколько записей детектор забирает за раз
+
+
+class PacketRing:
+    """Ограниченный кольцевой буфер захват -> детектор со счётчиком потерь.
+
+    При переполнении новые записи отбрасываются, а не блокируют поток захвата.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.slots = [None] * size
+        self.head = 0          # откуда читать
+        self.tail = 0          # куда писать
+        self.count = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+
+    def put(self, item):
+        with self.lock:
+            if self.count == self.size:
+                self.dropped += 1
+                return False
+            self.slots[self.tail] = item
+            self.tail = (self.tail + 1) % self.size
+            self.count += 1
+            self.not_empty.notify()
+            return True
+
+    def get_batch(self, max_items=BATCH_SIZE, timeout=0.1):
+        """Забрать до max_items записей, подождав не дольше timeout."""
+        with self.lock:
+            if not self.count:
+                self.not_empty.wait(timeout)
+            n = min(self.count, max_items)
+            batch = []
+            for _ in range(n):
+                batch.append(self.slots[self.head])
+                self.slots[self.head] = None
+                self.head = (self.head + 1) % self.size
+            self.count -= n
+            return batch
+
+    def clear(self):
+        with self.lock:
+            self.slots = [None] * self.size
+            self.head = self.tail = self.count = 0
+            self.dropped = 0
+
+
+class DetectionPipeline:
+    """Поток детектора между захватом и GUI.
+
+    Захват кладёт кортежи (src_ip, dst_port, size, ts, proto, flags) в кольцо через submit(),
+    детектор работает в своём потоке, а GUI забирает накопленные срабатывания
+    через drain() по таймеру. mode - 'exact' или 'approx' (см. detector.DETECTORS),
+    window - длина окна статистики в секундах для непрерывной работы,
+    rules - описания правил (см. rules.py), profiler - profiler.Profiler
+    для выборочного замера этапа detect.
+    """
+
+    def __init__(self, thresholds=DEFAULT_THRESHOLDS, ring_size=RING_SIZE, mode='exact', window=None,
+                 rules=None, profiler=None):
+        self.ring = PacketRing(ring_size)
+        self.profiler = profiler
+        self.detector = make_detector(mode, thresholds, window, rules)
+        self.detections = deque()
+        self.processed = 0
+        self.running = False
+        self.thread = None
+
+    def set_thresholds(self, thresholds):
+        # Подмена снимка целиком атомарна, блокировка не нужна
+        self.detector.thresholds = thresholds
+
+    def submit(self, src_ip, dst_port, packet_size, ts, proto=IPPROTO_TCP, flags=0):
+        return self.ring.put((src_ip, dst_port, packet_size, ts, proto, flags))
+
+    def start(self):
+        if self.running:
+            return
+        self.detector.reset()
+        self.ring.clear()
+        self.detections.clear()
+        self.processed = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Остановить поток, предварительно разобрав остаток кольца."""
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        process = self.detector.process
+        profiler = self.profiler
+        if profiler:
+            process = profiler.wrap('detect', process)
+        while self.running or self.ring.count:
+            batch = self.ring.get_batch()
+            if profiler and batch:
+                profiler.count('detect', len(batch))
+            if not batch:
+                # Пакетов нет - окно статистики всё равно должно сменяться вовремя
+                self.detector.tick(time.time())
+            for src_ip, dst_port, packet_size, ts, proto, flags in batch:
+                found = process(src_ip, dst_port, packet_size, ts, proto, flags)
+                if found:
+                    self.detections.extend(found)
+            self.processed += len(batch)
+
+    def drain(self, max_items=None):
+        """Забрать накопленные срабатывания (вызывается из потока GUI)."""
+        out = []
+        while self.detections and (max_items is None or len(out) < max_items):
+            out.append(self.detections.popleft())
+        return out
+
+    def stats(self):
+        return {
+            'processed': self.processed,
+            'queued': self.ring.count,
+            'dropped': self.ring.dropped,
+            'suspicious': len(self.detector.suspicious_ips),
+            'tracked': len(self.detector.ips),
+            'evicted': self.detector.evicted,
+            'rules': dict(self.detector.rule_counts),
+            'windows': self.detector.windows,
+        }
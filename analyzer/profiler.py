@@ -0,0 +1,254 @@
+"""Встроенная инструментовка горячего пути анализатора.
+
+Profiler ведёт по этапу (capture, parse, detect, enrich, ui, ...) счётчик
+вызовов и гистограмму длительностей. Время замеряется не на каждом вызове,
+а на каждом sample_every-м (perf_counter_ns), гистограмма - логарифмическая
+по степеням двойки. Без флага профилирования код горячего пути не меняется:
+обёртки из wrap() подставляются только при включённом профилировщике.
+
+StackSampler - статистический профилировщик: раз в interval снимает стеки
+всех потоков через sys._current_frames() и копит их в формате folded stacks
+(flamegraph.pl, speedscope). Отчёт по этапам и стеки можно периодически
+сбрасывать в файл.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from collections import Counter
+
+SAMPLE_EVERY = 64           # замерять каждый N-й вызов этапа
+STACK_INTERVAL = 0.01       # период снятия стеков, с
+DUMP_INTERVAL = 30          # период записи профиля в файл, с
+HIST_BUCKETS = 48           # 2**47 нс ~ 39 ч, больше не бывает
+
+
+class Stage:
+    """Счётчики одного этапа. calls - все вызовы, samples - замеренные."""
+
+    __slots__ = ('name', 'calls', 'items', 'samples', 'total_ns', 'max_ns', 'hist')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.items = 0              # сколько пакетов/записей прошло через этап
+        self.samples = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.hist = [0] * HIST_BUCKETS
+
+    def record(self, ns):
+        self.samples += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        # Корзина i - длительности в [2**(i-1), 2**i) нс
+        self.hist[min(ns.bit_length(), HIST_BUCKETS - 1)] += 1
+
+    def percentile(self, p):
+        """Верхняя граница корзины, в которую попадает p-й процентиль, нс."""
+        if not self.samples:
+            return 0
+        rank = self.samples * p / 100
+        seen = 0
+        for i, n in enumerate(self.hist):
+            seen += n
+            if seen >= rank:
+                return 1 << i
+        return self.max_ns
+
+    def report(self):
+        mean = self.total_ns / self.samples if self.samples else 0
+        return {
+            'calls': self.calls,
+            'items': self.items,
+            'samples': self.samples,
+            'mean_us': round(mean / 1000, 3),
+            'p50_us': self.percentile(50) / 1000,
+            'p99_us': self.percentile(99) / 1000,
+            'max_us': round(self.max_ns / 1000, 3),
+            # Оценка всего времени этапа: среднее по выборке * число вызовов
+            'est_total_s': round(mean * self.calls / 1e9, 3),
+        }
+
+
+class Profiler:
+    def __init__(self, sample_every=SAMPLE_EVERY):
+        self.sample_every = sample_every
+        self.stages = {}
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            with self.lock:
+                stage = self.stages.setdefault(name, Stage(name))
+        return stage
+
+    def wrap(self, name, func, every=None):
+        """Обёртка func с выборочным замером каждого every-го вызова."""
+        stage = self.stage(name)
+        every = every or self.sample_every
+        clock = time.perf_counter_ns
+
+        def wrapper(*args):
+            stage.calls += 1
+            if stage.calls % every:
+                return func(*args)
+            t0 = clock()
+            try:
+                return func(*args)
+            finally:
+                stage.record(clock() - t0)
+
+        return wrapper
+
+    def iterate(self, name, iterable):
+        """Выборочно замерять получение очередного элемента (чтение + разбор пакета)."""
+        stage = self.stage(name)
+        every = self.sample_every
+        clock = time.perf_counter_ns
+        it = iter(iterable)
+        while True:
+            stage.calls += 1
+            if stage.calls % every:
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            else:
+                t0 = clock()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                stage.record(clock() - t0)
+            yield item
+
+    def count(self, name, items):
+        self.stage(name).items += items
+
+    def report(self):
+        stages = {name: stage.report() for name, stage in sorted(self.stages.items())}
+        # Этапы в разных потоках идут параллельно, поэтому "узкое место" -
+        # этап с наибольшим оценочным временем, а не доля от суммы
+        bottleneck = max(stages, key=lambda n: stages[n]['est_total_s'], default=None)
+        return {
+            'uptime_s': round(time.monotonic() - self.started, 3),
+            'sample_every': self.sample_every,
+            'bottleneck': bottleneck,
+            'stages': stages,
+        }
+
+
+class StackSampler:
+    """Статистический профилировщик по стекам всех потоков, кроме своего."""
+
+    def __init__(self, interval=STACK_INTERVAL, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                parts = []
+                while frame is not None and len(parts) < self.max_depth:
+                    code = frame.f_code
+                    parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                parts.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(parts))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+def write_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class ProfileDumper:
+    """Периодически пишет отчёт по этапам в path (JSON) и стеки в path.folded."""
+
+    def __init__(self, profiler, path, sampler=None, interval=DUMP_INTERVAL):
+        self.profiler = profiler
+        self.path = path
+        self.sampler = sampler
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def dump(self):
+        write_atomic(self.path, json.dumps(self.profiler.report(), indent=2) + "\n")
+        if self.sampler is not None:
+            write_atomic(self.path + ".folded", self.sampler.folded())
+
+    def start(self):
+        if self.sampler is not None:
+            self.sampler.start()
+
+        def loop():
+            while not self.stop_event.wait(self.interval):
+                try:
+                    self.dump()
+                except OSError:
+                    pass
+
+        self.thread = threading.Thread(target=loop, name="profile-dump", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Остановить выборку и записать итоговый профиль."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.sampler is not None:
+            self.sampler.stop()
+        try:
+            self.dump()
+        except OSError:
+            pass
+
+
+def start_profiling(path=None, sample_every=SAMPLE_EVERY, stacks=True):
+    """Создать Profiler и, если задан path, запустить периодическую запись.
+
+    Возвращает (profiler, dumper или None).
+    """
+    profiler = Profiler(sample_every)
+    dumper = None
+    if path:
+        dumper = ProfileDumper(profiler, path, StackSampler() if stacks else None)
+        dumper.start()
+    return profiler, dumper
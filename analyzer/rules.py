@@ -0,0 +1,253 @@
+"""Подключаемые правила обнаружения и их компиляция в таблицу диспетчеризации.
+
+Набор правил задаётся списком словарей (обычно из JSON-файла):
+
+    {"rules": [
+        {"rule": "size"}, {"rule": "ports"}, {"rule": "repeat"},
+        {"rule": "syn_flood", "window": 5, "min_packets": 100, "ratio": 0.9},
+        {"rule": "icmp_flood", "window": 5, "threshold": 100, "types": [8]},
+        {"rule": "udp_spray", "window": 5, "port_thresh": 20}
+    ]}
+
+Параметры size/ports/repeat берутся из Thresholds (их меняет GUI), у
+остальных правил - из конфигурации. compile_table() превращает включённые
+правила в замыкания с подставленными параметрами и раскладывает их по ключу
+(протокол, значимые флаги): каждый пакет проверяется только правилами своего
+ключа, без ветвлений по протоколу, флагам и включённости в горячем цикле.
+"""
+import json
+
+from capture import IPPROTO_ICMP, IPPROTO_TCP, IPPROTO_UDP
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+ICMP_ECHO_REQUEST = 8
+
+# Какие биты flags различает таблица: для TCP - SYN/ACK, для ICMP - тип целиком
+FLAG_MASKS = {
+    IPPROTO_TCP: TCP_SYN | TCP_ACK,
+    IPPROTO_UDP: 0,
+    IPPROTO_ICMP: 0xff,
+}
+
+
+def dispatch_key(proto, flags):
+    return proto << 8 | flags & FLAG_MASKS.get(proto, 0)
+
+
+class Rule:
+    """Базовое правило.
+
+    protocols - {протокол: значения flags после маски или None для любых}.
+    compile() возвращает проверку check(state, src_ip, dst_port, size, ts, flags)
+    с уже подставленными параметрами; она отдаёт текст срабатывания или None.
+    Собственное состояние правила по источнику хранится в state.extra[name].
+    """
+
+    name = None
+    label = None
+    protocols = {}
+    defaults = {}
+
+    def __init__(self, **params):
+        unknown = set(params) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"{self.name}: unknown parameters: {', '.join(sorted(unknown))}")
+        for key, value in self.defaults.items():
+            setattr(self, key, params.get(key, value))
+
+    def enabled(self, thresholds):
+        return True
+
+    def keys(self):
+        for proto, values in self.protocols.items():
+            mask = FLAG_MASKS.get(proto, 0)
+            if values is None:
+                values = [v for v in range(mask + 1) if v & mask == v]
+            for value in values:
+                yield dispatch_key(proto, value)
+
+
+class SizeRule(Rule):
+    name = 'size'
+    label = "Large packet"
+    protocols = {IPPROTO_TCP: None}
+
+    def enabled(self, thresholds):
+        return thresholds.check_size
+
+    def compile(self, detector, thresholds):
+        max_size = thresholds.max_size
+
+        def check(state, src_ip, dst_port, packet_size, current_time, flags):
+            if packet_size > max_size:
+                return f"Большой пакет ({packet_size} bytes)"
+            return None
+
+        return check
+
+
+class PortScanRule(Rule):
+    """Состояние портов у точного и приближённого детекторов разное - проверку строит детектор."""
+
+    name = 'ports'
+    label = "Port scan"
+    protocols = {IPPROTO_TCP: None}
+
+    def enabled(self, thresholds):
+        return thresholds.check_ports
+
+    def compile(self, detector, thresholds):
+        return detector.compile_ports(thresholds)
+
+
+class RepeatRule(Rule):
+    name = 'repeat'
+    label = "Repeated requests"
+    protocols = {IPPROTO_TCP: None}
+
+    def enabled(self, thresholds):
+        return thresholds.check_repeat
+
+    def compile(self, detector, thresholds):
+        return detector.compile_repeat(thresholds)
+
+
+class SynFloodRule(Rule):
+    """Много SYN без ACK от источника, и они составляют большую долю его пакетов.
+
+    Проверяется только на SYN без ACK; знаменатель - все пакеты источника
+    с начала окна (по счётчику состояния), поэтому обычные рукопожатия
+    с последующим обменом данными долю не набирают.
+    """
+
+    name = 'syn_flood'
+    label = "SYN flood"
+    protocols = {IPPROTO_TCP: [TCP_SYN]}
+    defaults = {'window': 5.0, 'min_packets': 100, 'ratio': 0.9}
+
+    def compile(self, detector, thresholds):
+        name, window, min_packets, ratio = self.name, self.window, self.min_packets, self.ratio
+
+        def check(state, src_ip, dst_port, packet_size, current_time, flags):
+            extra = state.extra
+            if extra is None:
+                extra = state.extra = {}
+            # [конец окна, SYN в окне, state.count до начала окна]
+            counter = extra.get(name)
+            if counter is None or current_time >= counter[0]:
+                counter = extra[name] = [current_time + window, 0, state.count - 1]
+            counter[1] += 1
+            syn = counter[1]
+            total = state.count - counter[2]
+            if syn >= min_packets and syn >= ratio * total:
+                return f"SYN-флуд ({syn} SYN без ACK из {total} пакетов за {window:g} с)"
+            return None
+
+        return check
+
+
+class IcmpFloodRule(Rule):
+    """Больше threshold ICMP-пакетов заданных типов (null - любых) от источника за окно."""
+
+    name = 'icmp_flood'
+    label = "ICMP flood"
+    defaults = {'window': 5.0, 'threshold': 100, 'types': [ICMP_ECHO_REQUEST]}
+
+    @property
+    def protocols(self):
+        return {IPPROTO_ICMP: self.types}
+
+    def compile(self, detector, thresholds):
+        name, window, threshold = self.name, self.window, self.threshold
+        detail = f"ICMP-флуд (>{threshold} пакетов за {window:g} с)"
+
+        def check(state, src_ip, dst_port, packet_size, current_time, flags):
+            extra = state.extra
+            if extra is None:
+                extra = state.extra = {}
+            counter = extra.get(name)
+            if counter is None or current_time >= counter[0]:
+                counter = extra[name] = [current_time + window, 0]
+            counter[1] += 1
+            return detail if counter[1] > threshold else None
+
+        return check
+
+
+class UdpSprayRule(Rule):
+    """UDP на больше чем port_thresh различных портов за окно.
+
+    Как и в проверке портов TCP, порты хранятся кортежем не длиннее port_thresh + 1.
+    """
+
+    name = 'udp_spray'
+    label = "UDP port spray"
+    protocols = {IPPROTO_UDP: None}
+    defaults = {'window': 5.0, 'port_thresh': 20}
+
+    def compile(self, detector, thresholds):
+        name, window, limit = self.name, self.window, self.port_thresh
+
+        def check(state, src_ip, dst_port, packet_size, current_time, flags):
+            extra = state.extra
+            if extra is None:
+                extra = state.extra = {}
+            counter = extra.get(name)
+            if counter is None or current_time >= counter[0]:
+                counter = extra[name] = [current_time + window, ()]
+            ports = counter[1]
+            if len(ports) <= limit and dst_port not in ports:
+                ports = counter[1] = ports + (dst_port,)
+            if len(ports) > limit:
+                return f"UDP на {len(ports)} портов за {window:g} с"
+            return None
+
+        return check
+
+
+RULES = {cls.name: cls for cls in (SizeRule, PortScanRule, RepeatRule,
+                                   SynFloodRule, IcmpFloodRule, UdpSprayRule)}
+
+RULE_LABELS = {name: cls.label for name, cls in RULES.items()}
+
+# Исходные три правила (с ними сверяется пакетный движок batch.py)
+CLASSIC_RULES = [{'rule': 'size'}, {'rule': 'ports'}, {'rule': 'repeat'}]
+DEFAULT_RULES = CLASSIC_RULES + [{'rule': 'syn_flood'}, {'rule': 'icmp_flood'}, {'rule': 'udp_spray'}]
+
+
+def build_rules(specs=None):
+    """Создать правила по списку словарей; порядок списка - порядок проверки."""
+    rules = []
+    for spec in DEFAULT_RULES if specs is None else specs:
+        params = dict(spec)
+        name = params.pop('rule', None)
+        if name not in RULES:
+            raise ValueError(f"unknown rule: {name}")
+        if not params.pop('enabled', True):
+            continue
+        rules.append(RULES[name](**params))
+    return rules
+
+
+def compile_table(rules, detector, thresholds):
+    """{ключ диспетчеризации: ((имя правила, check), ...)} для включённых правил."""
+    table = {}
+    for rule in rules:
+        if not rule.enabled(thresholds):
+            continue
+        check = rule.compile(detector, thresholds)
+        for key in rule.keys():
+            table.setdefault(key, []).append((rule.name, check))
+    return {key: tuple(found) for key, found in table.items()}
+
+
+def load_rules(path):
+    """Прочитать список правил из JSON: {"rules": [...]} или просто [...]."""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    specs = data.get('rules') if isinstance(data, dict) else data
+    if not isinstance(specs, list):
+        raise ValueError(f"{path}: expected a list of rules")
+    build_rules(specs)      # проверить имена и параметры сразу
+    return specs
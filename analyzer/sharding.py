@@ -0,0 +1,194 @@
+import os
+import queue
+import struct
+import ctypes
+import threading
+import multiprocessing
+from collections import deque
+
+from capture import RawCapture, compile_bpf, SOL_PACKET
+from detector import make_detector, Detection, DEFAULT_THRESHOLDS
+from profiler import start_profiling
+
+# linux/if_packet.h
+PACKET_FANOUT = 18
+PACKET_FANOUT_DATA = 22
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_CBPF = 6
+
+# Программа раздачи: вернуть IPv4-адрес источника, ядро берёт его по модулю
+# числа участников группы - один источник всегда попадает к одному воркеру.
+BPF_FANOUT_BY_SRC = [
+    (0x20, 0, 0, 12),   # ld [12]   ; ip src: программа fanout видит пакет с сетевого заголовка
+    (0x16, 0, 0, 0),    # ret a
+]
+
+STATS_EVERY = 1024      # как часто воркер обновляет общие счётчики
+
+
+def join_fanout(sock, group_id):
+    """Включить сокет в группу PACKET_FANOUT с раздачей по адресу источника.
+
+    На старых ядрах без PACKET_FANOUT_DATA откатывается на хеш потока
+    (тогда пакеты одного источника с разных портов могут разойтись по воркерам).
+    Возвращает использованный режим.
+    """
+    try:
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT, group_id | (PACKET_FANOUT_CBPF << 16))
+        code = compile_bpf(BPF_FANOUT_BY_SRC)
+        buf = ctypes.create_string_buffer(code, len(code))
+        fprog = struct.pack("HP", len(BPF_FANOUT_BY_SRC), ctypes.addressof(buf))
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT_DATA, fprog)
+        return "cbpf"
+    except OSError:
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT, group_id | (PACKET_FANOUT_HASH << 16))
+        return "hash"
+
+
+def capture_worker(index, group_id, iface, mode, window, thresholds, rules, out_queue, counters,
+                   stop_event, profile=None):
+    """Процесс-воркер: свой сокет в fanout-группе и своё состояние по IP.
+
+    Наружу уходят только компактные кортежи срабатываний, не пакеты.
+    profile - путь, куда воркер периодически пишет свой профиль (с суффиксом .<index>).
+    """
+    profiler = dumper = None
+    if profile:
+        profiler, dumper = start_profiling(f"{profile}.{index}")
+    try:
+        capture = RawCapture(iface, profiler=profiler)
+        fanout_mode = join_fanout(capture.sock, group_id)
+    except OSError as e:
+        out_queue.put(('error', index, str(e)))
+        if dumper is not None:
+            dumper.stop()
+        return
+    out_queue.put(('ready', index, fanout_mode))
+
+    detector = make_detector(mode, thresholds, window, rules)
+    process = profiler.wrap('detect', detector.process) if profiler else detector.process
+    seen = [0]
+
+    def handler(src_ip, proto, dst_port, packet_size, ts, flags):
+        seen[0] += 1
+        if seen[0] % STATS_EVERY == 0:
+            counters[index] = seen[0]
+        for det in process(src_ip, dst_port, packet_size, ts, proto, flags):
+            out_queue.put(('det',) + tuple(det))
+
+    try:
+        capture.run(handler, stop_event=stop_event)
+    finally:
+        counters[index] = seen[0]
+        capture.close()
+        if dumper is not None:
+            dumper.stop()
+
+
+class ShardedCapture:
+    """Многопроцессный захват: N воркеров в одной группе PACKET_FANOUT.
+
+    Интерфейс совпадает с DetectionPipeline (start/stop/drain/stats), поэтому
+    GUI и CLI могут использовать любой из них. Пороги фиксируются при start().
+    """
+
+    def __init__(self, workers=None, iface=None, thresholds=DEFAULT_THRESHOLDS, mode='exact',
+                 window=None, rules=None, profile=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.iface = iface
+        self.mode = mode
+        self.window = window
+        self.rules = rules
+        self.profile = profile
+        self.thresholds = thresholds
+        self.ctx = multiprocessing.get_context("spawn")   # не клонировать Tk через fork
+        self.detections = deque()
+        self.suspicious_ips = set()
+        self.rule_counts = {}
+        self.procs = []
+        self.errors = []
+        self.modes = {}
+        self.out_queue = None
+        self.counters = None
+        self.stop_event = None
+        self.collector = None
+        self.running = False
+
+    def set_thresholds(self, thresholds):
+        self.thresholds = thresholds
+
+    def start(self):
+        if self.running:
+            return
+        self.detections.clear()
+        self.suspicious_ips.clear()
+        self.rule_counts.clear()
+        self.errors.clear()
+        self.modes.clear()
+        self.out_queue = self.ctx.Queue()
+        self.counters = self.ctx.Array('Q', self.workers, lock=False)
+        self.stop_event = self.ctx.Event()
+        # Идентификатор группы уникален для процесса-координатора
+        group_id = os.getpid() & 0xffff
+        self.procs = [
+            self.ctx.Process(target=capture_worker, daemon=True,
+                             args=(i, group_id, self.iface, self.mode, self.window, self.thresholds,
+                                   self.rules, self.out_queue, self.counters, self.stop_event,
+                                   self.profile))
+            for i in range(self.workers)
+        ]
+        for proc in self.procs:
+            proc.start()
+        self.running = True
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def wait(self, timeout):
+        self.stop_event.wait(timeout)
+
+    def stop(self):
+        if not self.running:
+            return
+        self.stop_event.set()
+        for proc in self.procs:
+            proc.join()
+        self.running = False
+        self.collector.join()
+        self.collector = None
+
+    def _collect(self):
+        while True:
+            try:
+                msg = self.out_queue.get(timeout=0.1)
+            except queue.Empty:
+                if not self.running:
+                    break
+                continue
+            kind = msg[0]
+            if kind == 'det':
+                det = Detection(*msg[1:])
+                # При откате на хеш потока один IP может прийти от двух воркеров
+                if det.ip not in self.suspicious_ips:
+                    self.suspicious_ips.add(det.ip)
+                    self.rule_counts[det.rule] = self.rule_counts.get(det.rule, 0) + 1
+                    self.detections.append(det)
+            elif kind == 'ready':
+                self.modes[msg[1]] = msg[2]
+            elif kind == 'error':
+                self.errors.append(f"worker {msg[1]}: {msg[2]}")
+
+    def drain(self, max_items=None):
+        out = []
+        while self.detections and (max_items is None or len(out) < max_items):
+            out.append(self.detections.popleft())
+        return out
+
+    def stats(self):
+        return {
+            'processed': sum(self.counters) if self.counters is not None else 0,
+            'queued': 0,
+            'dropped': 0,
+            'suspicious': len(self.suspicious_ips),
+            'rules': dict(self.rule_counts),
+            'workers': self.workers,
+        }
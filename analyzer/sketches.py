@@ -0,0 +1,156 @@
+import math
+import heapq
+from array import array
+
+_GOLDEN = 0x9E3779B1
+
+
+def _mix32(x):
+    """Быстрое перемешивание 32-битного значения (хеш Кнута + xorshift)."""
+    x = (x * _GOLDEN) & 0xffffffff
+    return x ^ (x >> 16)
+
+
+class PortBitmap:
+    """Линейный счётчик (linear counting) различных значений в m-битной маске.
+
+    Сама маска - обычное int, её хранит вызывающий код; класс только
+    задаёт размер и оценку. Относительная ошибка ~ sqrt(e^t - t - 1) / (t * sqrt(m)),
+    где t = n / m; при n <= m/2 это несколько процентов для m = 64..256.
+    """
+
+    def __init__(self, bits=64):
+        self.bits = bits
+        self.mask = bits - 1
+        if bits & self.mask:
+            raise ValueError("bitmap size must be a power of two")
+
+    def add(self, bitmap, value):
+        return bitmap | (1 << (_mix32(value) & self.mask))
+
+    def estimate(self, bitmap):
+        zeros = self.bits - bitmap.bit_count()
+        if zeros == 0:
+            return float(self.bits * math.log(self.bits))   # насыщение
+        return -self.bits * math.log(zeros / self.bits)
+
+
+class HyperLogLog:
+    """HyperLogLog для оценки числа различных ключей при фиксированной памяти.
+
+    2**p регистров по байту, стандартная ошибка ~ 1.04 / sqrt(2**p).
+    """
+
+    def __init__(self, p=12):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add_hash(self, h):
+        h &= 0xffffffffffffffff
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, key):
+        self.add_hash(hash(key))
+
+    def estimate(self):
+        m = self.m
+        total = sum(2.0 ** -r for r in self.registers)
+        e = self.alpha * m * m / total
+        if e <= 2.5 * m:
+            zeros = self.registers.count(0)
+            if zeros:
+                e = m * math.log(m / zeros)
+        return e
+
+    def clear(self):
+        self.registers = bytearray(self.m)
+
+
+class CountMinSketch:
+    """Count-Min Sketch: оценка сверху частоты ключа с фиксированной памятью.
+
+    С вероятностью не меньше 1 - delta переоценка не превышает eps * N,
+    где N - сумма всех добавлений с последней очистки.
+    """
+
+    def __init__(self, eps=0.001, delta=0.01):
+        self.width = int(math.ceil(math.e / eps))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.rows = [array('I', bytes(4 * self.width)) for _ in range(self.depth)]
+        self.total = 0
+
+    def add(self, key, count=1):
+        """Добавить и вернуть новую оценку частоты ключа."""
+        h = hash(key)
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        width = self.width
+        estimate = None
+        for i, row in enumerate(self.rows):
+            j = (h1 + i * h2) % width
+            value = row[j] + count
+            row[j] = value
+            if estimate is None or value < estimate:
+                estimate = value
+        self.total += count
+        return estimate
+
+    def estimate(self, key):
+        h = hash(key)
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        return min(row[(h1 + i * h2) % self.width] for i, row in enumerate(self.rows))
+
+    def clear(self):
+        zero = bytes(4 * self.width)
+        self.rows = [array('I', zero) for _ in range(self.depth)]
+        self.total = 0
+
+
+class TopK:
+    """k самых частых ключей по оценкам Count-Min (куча с ленивым удалением)."""
+
+    def __init__(self, k=20):
+        self.k = k
+        self.counts = {}
+        self.heap = []
+
+    def update(self, key, estimate):
+        counts = self.counts
+        if key in counts:
+            counts[key] = estimate
+            heapq.heappush(self.heap, (estimate, key))
+        elif len(counts) < self.k:
+            counts[key] = estimate
+            heapq.heappush(self.heap, (estimate, key))
+        else:
+            smallest = self._min()
+            if estimate > smallest[0]:
+                del counts[smallest[1]]
+                counts[key] = estimate
+                heapq.heappush(self.heap, (estimate, key))
+        # Не давать куче разрастаться из-за устаревших записей
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(c, k) for k, c in counts.items()]
+            heapq.heapify(self.heap)
+
+    def _min(self):
+        heap = self.heap
+        while True:
+            count, key = heap[0]
+            if self.counts.get(key) == count:
+                return count, key
+            heapq.heappop(heap)
+
+    def items(self):
+        return sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+
+    def clear(self):
+        self.counts.clear()
+        self.heap.clear()
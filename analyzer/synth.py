@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Генератор синтетического трафика с известной разметкой.
+
+Пишет классический pcap (Ethernet/IPv4/TCP) и рядом <имя>.truth.json со
+списком источников, которые детектор обязан найти. Сеть не используется,
+результат воспроизводим при одинаковом seed.
+
+    python synth.py -o /tmp/synthetic.pcap --benign 2000 --scanners 20 --seed 1
+"""
+import json
+import random
+import socket
+import struct
+import argparse
+
+from detector import DEFAULT_THRESHOLDS
+
+ETH_HEADER = b"\x02\x00\x00\x00\x00\x02" + b"\x02\x00\x00\x00\x00\x01" + b"\x08\x00"
+DST_IP = socket.inet_aton("192.0.2.1")
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+MIN_FRAME = 14 + 20 + 20
+
+_ip_header = struct.Struct("!BBHHHBBH4s4s")
+_tcp_header = struct.Struct("!HHIIBBHHH")
+
+
+def build_frame(src_ip, dst_port, size, flags=TCP_ACK, src_port=40000):
+    """Ethernet + IPv4 + TCP кадр длиной size байт (дополняется нулями)."""
+    size = max(size, MIN_FRAME)
+    ip = _ip_header.pack(0x45, 0, size - 14, 0, 0, 64, 6, 0, socket.inet_aton(src_ip), DST_IP)
+    tcp = _tcp_header.pack(src_port, dst_port, 0, 0, 0x50, flags, 65535, 0, 0)
+    return ETH_HEADER + ip + tcp + bytes(size - MIN_FRAME)
+
+
+def _addr(prefix, n):
+    return f"{prefix}.{(n >> 8) & 255}.{n & 255}"
+
+
+def generate(benign=1000, scanners=10, flooders=10, large=10, spoofed=20000,
+             duration=60.0, thresholds=DEFAULT_THRESHOLDS, seed=1):
+    """Вернуть (events, truth): события (ts, src, dport, size, flags) и разметку.
+
+    benign    - клиенты с редкими запросами к 80/443 ниже всех порогов;
+    scanners  - перебор портов (по port_thresh * 4 портов, медленно);
+    flooders  - серия запросов к одному порту быстрее repeat_thresh за окно;
+    large     - короткие всплески пакетов больше max_size;
+    spoofed   - шторм подделанных источников по одному пакету (нагрузка на память,
+                подозрительными не считаются).
+    """
+    rng = random.Random(seed)
+    th = thresholds
+    events = []
+    truth = {}
+
+    for i in range(benign):
+        src = _addr("10.1", i)
+        # Не больше port_thresh портов и не чаще repeat_thresh за окно
+        ports = rng.sample([80, 443, 8080, 22][:max(th.port_thresh, 1)], 1)
+        count = rng.randint(1, max(th.repeat_thresh, 1))
+        t = rng.uniform(0, duration)
+        for _ in range(count):
+            events.append((t, src, ports[0], rng.randint(60, th.max_size), TCP_ACK))
+            t += th.repeat_window * 1.01 / max(th.repeat_thresh, 1) + rng.uniform(0, 1)
+
+    for i in range(scanners):
+        src = _addr("10.2", i)
+        truth[src] = "port_scan"
+        t = rng.uniform(0, duration * 0.8)
+        for port in rng.sample(range(1, 65536), max(th.port_thresh, 1) * 4):
+            events.append((t, src, port, 60, TCP_SYN))
+            t += th.repeat_window * 1.01 / max(th.repeat_thresh, 1)
+
+    for i in range(flooders):
+        src = _addr("10.3", i)
+        truth[src] = "flood"
+        t = rng.uniform(0, duration * 0.8)
+        for _ in range(th.repeat_thresh * 5):
+            events.append((t, src, 80, 60, TCP_ACK))
+            t += rng.uniform(0.001, 0.02)
+
+    for i in range(large):
+        src = _addr("10.4", i)
+        truth[src] = "large_packets"
+        t = rng.uniform(0, duration * 0.8)
+        for _ in range(3):
+            events.append((t, src, 443, rng.randint(th.max_size + 1, 1500), TCP_ACK))
+            t += rng.uniform(0.5, 2.0)
+
+    for i in range(spoofed):
+        src = f"{rng.randint(11, 99)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        events.append((rng.uniform(0, duration), src, rng.choice((80, 443)), 60, TCP_SYN))
+
+    events.sort(key=lambda e: e[0])
+    return events, truth
+
+
+def write_pcap(path, events, start=1700000000.0):
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        record = struct.Struct("<IIII")
+        for ts, src, dport, size, flags in events:
+            frame = build_frame(src, dport, size, flags)
+            ts += start
+            sec = int(ts)
+            usec = int((ts - sec) * 1e6)
+            f.write(record.pack(sec, usec, len(frame), len(frame)))
+            f.write(frame)
+
+
+def truth_path(pcap_path):
+    return pcap_path.rsplit(".", 1)[0] + ".truth.json"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic traffic generator for the analyzer")
+    parser.add_argument("-o", "--output", default="synthetic.pcap")
+    parser.add_argument("--benign", type=int, default=1000)
+    parser.add_argument("--scanners", type=int, default=10)
+    parser.add_argument("--flooders", type=int, default=10)
+    parser.add_argument("--large", type=int, default=10)
+    parser.add_argument("--spoofed", type=int, default=20000)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    events, truth = generate(args.benign, args.scanners, args.flooders, args.large,
+                             args.spoofed, args.duration, seed=args.seed)
+    write_pcap(args.output, events)
+    with open(truth_path(args.output), "w") as f:
+        json.dump({"malicious": truth, "packets": len(events), "seed": args.seed}, f, indent=2)
+    print(f"{args.output}: {len(events)} packets, {len(truth)} malicious sources")
+
+
+if __name__ == "__main__":
+    main()
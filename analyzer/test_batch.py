@@ -0,0 +1,57 @@
+import struct
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import batch
+from synth import build_frame
+
+START = 1700000000
+
+# Смещения в кадре Ethernet + IPv4: флаги и смещение фрагмента
+FRAG_AT = 14 + 6
+MORE_FRAGMENTS = 0x2000
+
+
+def _fragment(frame, value):
+    return frame[:FRAG_AT] + struct.pack("!H", value) + frame[FRAG_AT + 2:]
+
+
+def _write_pcap(path, frames):
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for i, (frame, wire_len) in enumerate(frames):
+            f.write(struct.pack("<IIII", START + i, 0, len(frame), wire_len))
+            f.write(frame)
+
+
+def test_cross_check_agrees_on_truncated_and_fragmented_packets(tmp_path):
+    frames = [(build_frame("10.0.0.1", port, 100), 100) for port in (22, 80, 443)]
+    # Четвёртый порт сканера - TCP-заголовок обрезан до порта: dport = 0 в обоих движках
+    truncated = build_frame("10.0.0.1", 8080, 100)[:14 + 20 + 2]
+    frames.append((truncated, 100))
+    # Хвостовой фрагмент не учитывается, первый (MF, смещение 0) - учитывается
+    frames.append((_fragment(build_frame("10.0.0.2", 80, 1000), 185), 1000))
+    frames.append((_fragment(build_frame("10.0.0.3", 80, 1000), MORE_FRAGMENTS), 1000))
+    path = tmp_path / "edge.pcap"
+    _write_pcap(path, frames)
+
+    packets = batch.load_pcap(path)
+    assert len(packets) == 5
+    assert packets['dport'][3] == 0
+
+    same, only_batch, only_stream = batch.cross_check(str(path))
+    assert same, (only_batch, only_stream)
+    found = {(d.ip, d.rule) for d in batch.analyze(packets)}
+    assert found == {("10.0.0.1", "ports"), ("10.0.0.3", "size")}
+
+
+def test_unsupported_link_type_is_reported(tmp_path):
+    path = tmp_path / "linktype.pcap"
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 999))
+        f.write(struct.pack("<IIII", START, 0, 40, 40) + bytes(40))
+
+    with pytest.raises(ValueError, match="unsupported link type 999"):
+        batch.load_pcap(path)
@@ -0,0 +1,47 @@
+import os
+import time
+import socket
+
+import pytest
+
+from capture import RawCapture, raw_capture_available
+from sharding import join_fanout
+
+WORKERS = 4
+SOURCES = [f"127.0.0.{i}" for i in range(2, 18)]
+PORT = 39517
+
+
+@pytest.mark.skipif(not raw_capture_available(), reason="AF_PACKET needs root")
+def test_fanout_keeps_each_source_on_one_worker():
+    group_id = (os.getpid() + 1) & 0xffff
+    captures = [RawCapture("lo", use_mmap=False) for _ in range(WORKERS)]
+    try:
+        modes = {join_fanout(capture.sock, group_id) for capture in captures}
+        if modes != {"cbpf"}:
+            pytest.skip("kernel has no PACKET_FANOUT_DATA")
+
+        for src in SOURCES:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.bind((src, 0))
+                for _ in range(5):
+                    sock.sendto(b"x", ("127.0.0.1", PORT))
+
+        workers_by_src = {}
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline:
+            for index, capture in enumerate(captures):
+                def handler(src_ip, proto, dst_port, size, ts, flags, index=index):
+                    if dst_port == PORT:
+                        workers_by_src.setdefault(src_ip, set()).add(index)
+                capture._read_socket(handler)
+            if len(workers_by_src) == len(SOURCES):
+                break
+            time.sleep(0.05)
+    finally:
+        for capture in captures:
+            capture.close()
+
+    assert set(workers_by_src) == set(SOURCES)
+    assert all(len(workers) == 1 for workers in workers_by_src.values())
+    assert len(set().union(*workers_by_src.values())) > 1
@@ -0,0 +1,279 @@
+"""Снимок в виде одного сжатого tar-архива, записываемого потоком.
+
+Файлы читаются по списку (scan_tree или индекс изменений) и сразу идут в
+tarfile в потоковом режиме 'w|' - без промежуточных копий на диске.
+Поток архива режется на блоки, блоки сжимаются пулом потоков (zlib, bz2,
+lzma и zstd отпускают GIL) и пишутся по порядку. Каждый блок - отдельный
+gzip-член / bz2-поток / xz-поток / zstd-кадр; их склейка - корректный файл,
+который читают tar, gzip, xz, zstd и модуль tarfile.
+
+Чтение исходных файлов и запись архива можно ограничить по скорости
+(throttle.py), чтобы резервная копия не отнимала диск у рабочей нагрузки.
+"""
+import os
+import io
+import bz2
+import grp
+import pwd
+import lzma
+import zlib
+import stat
+import time
+import logging
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from changeindex import scan_tree, KIND_DIR, KIND_LINK
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_NAME = "archive.tar"
+COMPRESS_THREADS = os.cpu_count() or 1
+READ_SIZE = 1024 * 1024
+
+# codec: (расширение, уровень по умолчанию, допустимые уровни, размер блока)
+CODECS = {
+    'none': ('', 0, range(0, 1), 1024 * 1024),
+    'gzip': ('.gz', 6, range(1, 10), 1024 * 1024),
+    'bz2': ('.bz2', 9, range(1, 10), 900 * 1024),
+    'xz': ('.xz', 6, range(0, 10), 8 * 1024 * 1024),
+    'zstd': ('.zst', 3, range(1, 23), 4 * 1024 * 1024),
+}
+
+
+def check_codec(codec, level=None):
+    """Проверить кодек и уровень, вернуть уровень (по умолчанию - свой у каждого кодека)."""
+    if codec not in CODECS:
+        raise ValueError(f"unknown archive codec: {codec}")
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError("zstd codec requires the 'zstandard' package")
+    default_level, levels = CODECS[codec][1:3]
+    level = default_level if level is None else level
+    if level not in levels:
+        raise ValueError(f"{codec}: compression level must be in {levels.start}..{levels.stop - 1}")
+    return level
+
+
+def _compressor(codec, level):
+    """Функция сжатия одного независимого блока."""
+    if codec == 'none':
+        return None
+    if codec == 'gzip':
+        # wbits=31 - полноценный gzip-член с заголовком и CRC
+        return lambda data: zlib.compress(data, level, wbits=31)
+    if codec == 'bz2':
+        return lambda data: bz2.compress(data, level)
+    if codec == 'xz':
+        return lambda data: lzma.compress(data, preset=level)
+    cctx = zstandard.ZstdCompressor(level=level)
+    return cctx.compress
+
+
+def archive_name(codec):
+    return ARCHIVE_NAME + CODECS[codec][0]
+
+
+class ParallelCompressor(io.RawIOBase):
+    """Файлоподобный объект для записи: сжимает блоки в пуле и пишет их по порядку."""
+
+    def __init__(self, fileobj, codec='gzip', level=None, threads=COMPRESS_THREADS, throttle=None):
+        super().__init__()
+        level = check_codec(codec, level)
+        self.fileobj = fileobj
+        self.compress = _compressor(codec, level)
+        self.block_size = CODECS[codec][3]
+        self.throttle = throttle
+        self.buf = bytearray()
+        self.queue = deque()
+        self.max_queued = max(2, threads * 2)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="compress") \
+            if threads > 1 and self.compress is not None else None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        n = len(data)
+        self.bytes_in += n
+        buf = self.buf
+        buf += data
+        if len(buf) >= self.block_size:
+            self._submit(bytes(buf))
+            buf.clear()
+        return n
+
+    def _submit(self, block):
+        if self.compress is None:
+            self._emit(block)
+        elif self.pool is None:
+            self._emit(self.compress(block))
+        else:
+            self.queue.append(self.pool.submit(self.compress, block))
+            # Не держать в памяти больше max_queued блоков: ждать самый старый
+            while len(self.queue) >= self.max_queued:
+                self._emit(self.queue.popleft().result())
+
+    def _emit(self, data):
+        if self.throttle is not None:
+            self.throttle.consume(len(data))
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buf:
+                self._submit(bytes(self.buf))
+                self.buf.clear()
+            while self.queue:
+                self._emit(self.queue.popleft().result())
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+            super().close()
+
+
+class _SourceReader:
+    """Чтение исходного файла ровно size байт: с ограничением скорости и
+    дополнением нулями, если файл укоротился во время архивирования (как GNU tar)."""
+
+    def __init__(self, f, size, path, throttle):
+        self.f = f
+        self.left = size
+        self.path = path
+        self.throttle = throttle
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        if not n:
+            return b""
+        data = self.f.read(n)
+        if len(data) < n:
+            logging.warning(f"{self.path}: file shrank during backup, padding with zeros")
+            data += bytes(n - len(data))
+        self.left -= n
+        if self.throttle is not None:
+            self.throttle.consume(n)
+        return data
+
+
+class ArchiveStats:
+    __slots__ = ('files', 'dirs', 'links', 'skipped', 'bytes_in', 'bytes_out', 'elapsed')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        ratio = self.bytes_out / self.bytes_in if self.bytes_in else 0
+        speed = self.bytes_in / self.elapsed / 1e6 if self.elapsed else 0
+        return (f"{self.files} files, {self.dirs} dirs, {self.links} links: "
+                f"{self.bytes_in} -> {self.bytes_out} bytes ({ratio:.1%}) in {self.elapsed:.2f} s "
+                f"({speed:.1f} MB/s)")
+
+
+class _Names:
+    """Кэш uid/gid -> имя: getpwuid на каждый файл заметно замедляет tarfile."""
+
+    def __init__(self):
+        self.users = {}
+        self.groups = {}
+
+    def user(self, uid):
+        name = self.users.get(uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = ""
+            self.users[uid] = name
+        return name
+
+    def group(self, gid):
+        name = self.groups.get(gid)
+        if name is None:
+            try:
+                name = grp.getgrgid(gid).gr_name
+            except KeyError:
+                name = ""
+            self.groups[gid] = name
+        return name
+
+
+def archive_tree(source_dir, dest_dir, codec='gzip', level=None, threads=COMPRESS_THREADS,
+                 listing=None, read_throttle=None, write_throttle=None, walk_workers=1):
+    """Записать source_dir в dest_dir/archive.tar.<codec>. Возвращает ArchiveStats."""
+    level = check_codec(codec, level)
+    started = time.monotonic()
+    stats = ArchiveStats()
+    if listing is None:
+        listing = scan_tree(source_dir, workers=walk_workers)
+    names = _Names()
+    os.mkdir(dest_dir)
+    path = os.path.join(dest_dir, archive_name(codec))
+    with open(path, 'wb') as raw:
+        out = ParallelCompressor(raw, codec, level, threads, write_throttle)
+        try:
+            with tarfile.open(fileobj=out, mode='w|', format=tarfile.PAX_FORMAT,
+                              bufsize=READ_SIZE, copybufsize=READ_SIZE) as tar:
+                # Родитель в сортировке раньше потомков - распаковка создаёт каталоги по порядку
+                for rel in sorted(listing):
+                    try:
+                        _add(tar, source_dir, rel, listing[rel], names, read_throttle, stats)
+                    except (FileNotFoundError, NotADirectoryError):
+                        # Удалён после обхода - попадёт в изменения следующего запуска
+                        stats.skipped += 1
+                    # В режиме записи список членов tarfile не нужен, а на миллионе файлов он велик
+                    tar.members.clear()
+        finally:
+            out.close()
+        os.fsync(raw.fileno())
+    stats.bytes_in = out.bytes_in
+    stats.bytes_out = out.bytes_out
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+def _tarinfo(rel, st, names):
+    info = tarfile.TarInfo(rel)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.uname = names.user(st.st_uid)
+    info.gname = names.group(st.st_gid)
+    info.mtime = st.st_mtime
+    return info
+
+
+def _add(tar, source_dir, rel, entry, names, throttle, stats):
+    path = os.path.join(source_dir, rel)
+    if entry.kind == KIND_DIR:
+        info = _tarinfo(rel, os.lstat(path), names)
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        stats.dirs += 1
+    elif entry.kind == KIND_LINK:
+        info = _tarinfo(rel, os.lstat(path), names)
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+        tar.addfile(info)
+        stats.links += 1
+    else:
+        with open(path, 'rb', buffering=0) as f:
+            # Размер и время - на момент открытия, а не обхода
+            st = os.fstat(f.fileno())
+            info = _tarinfo(rel, st, names)
+            info.size = st.st_size
+            tar.addfile(info, _SourceReader(f, st.st_size, path, throttle))
+        stats.files += 1
@@ -0,0 +1,100 @@
+"""Каталог снимков: что лежит в backup_dir, без обхода backup_dir.
+
+Каждый успешный снимок записывается в backup_dir/.catalog.sqlite3 вместе
+с числом файлов, объёмом данных, объёмом реально записанного и временем
+создания. Ротация и статус читают каталог, а не os.listdir + getmtime.
+sync() сверяет каталог с диском - при запуске демона, после ручного
+удаления снимков или после обновления со старой версии без каталога.
+"""
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from collections import namedtuple
+
+from snapshot import list_snapshots
+from chunkstore import is_chunked
+from archive import ARCHIVE_NAME
+
+CATALOG_NAME = ".catalog.sqlite3"
+TIME_FORMAT = "%Y%m%d%H%M%S"
+
+SnapshotInfo = namedtuple('SnapshotInfo', 'name created mode files size stored duration')
+
+
+def snapshot_time(name):
+    """Время создания по метке в имени prefix_YYYYmmddHHMMSS (None - чужое имя)."""
+    try:
+        return datetime.strptime(name.rsplit('_', 1)[-1], TIME_FORMAT).timestamp()
+    except ValueError:
+        return None
+
+
+def _detect_mode(path):
+    if is_chunked(path):
+        return 'chunked'
+    try:
+        if any(name.startswith(ARCHIVE_NAME) for name in os.listdir(path)):
+            return 'archive'
+    except OSError:
+        pass
+    return None
+
+
+class Catalog:
+    """Снимки backup_dir со статистикой. Один объект можно делить между потоками."""
+
+    def __init__(self, backup_dir):
+        self.backup_dir = backup_dir
+        self.path = os.path.join(backup_dir, CATALOG_NAME)
+        os.makedirs(backup_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS snapshots "
+                            "(name TEXT PRIMARY KEY, created REAL NOT NULL, mode TEXT, "
+                            "files INTEGER, size INTEGER, stored INTEGER, duration REAL)")
+
+    def close(self):
+        self.db.close()
+
+    def record(self, name, mode=None, files=None, size=None, stored=None, duration=None, created=None):
+        if created is None:
+            created = snapshot_time(name)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (name, created, mode, files, size, stored, duration))
+
+    def forget(self, name):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+
+    def snapshots(self, prefix):
+        """[SnapshotInfo] снимков с именами prefix_*, от старых к новым."""
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM snapshots ORDER BY created, name").fetchall()
+        start = f"{prefix}_"
+        return [SnapshotInfo(*row) for row in rows if row[0].startswith(start)]
+
+    def latest(self, prefix):
+        """Путь последнего снимка или None."""
+        snapshots = self.snapshots(prefix)
+        return os.path.join(self.backup_dir, snapshots[-1].name) if snapshots else None
+
+    def sync(self, prefix):
+        """Привести каталог к содержимому диска; возвращает (добавлено, забыто)."""
+        on_disk = {name: path for name, path in list_snapshots(self.backup_dir, f"{prefix}_")}
+        known = {info.name for info in self.snapshots(prefix)}
+        added = 0
+        for name in sorted(on_disk.keys() - known):
+            created = snapshot_time(name)
+            if created is None:
+                continue
+            # Статистика старых снимков неизвестна - только время и формат
+            self.record(name, _detect_mode(on_disk[name]), created=created)
+            added += 1
+        gone = known - on_disk.keys()
+        for name in gone:
+            self.forget(name)
+        return added, len(gone)
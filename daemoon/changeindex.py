@@ -0,0 +1,471 @@
+"""Индекс изменений исходного каталога.
+
+ChangeIndex хранит состояние дерева на момент последнего успешного снимка:
+путь -> (тип, размер, mtime_ns, inode, права, владелец, [хеш]). Пока демон
+ждёт следующего запуска, InotifyWatcher копит изменённые пути; перед
+копированием refresh() перечитывает только их и возвращает набор
+изменений. Если inotify недоступен, переполнил очередь или исчерпан лимит
+наблюдений, выполняется полный проход os.scandir - такой же, как без индекса.
+
+Снимок по индексу не обходит дерево заново: неизменившиеся файлы берутся
+из предыдущего снимка сразу, копируются только пути из набора изменений.
+"""
+import os
+import stat
+import gzip
+import json
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+INDEX_NAME = ".change_index.json.gz"
+HASH_CHUNK = 1024 * 1024
+INDEX_VERSION = 1
+RESCAN_INTERVAL = 24 * 3600     # полный проход не реже раза в сутки, даже с inotify
+
+Entry = namedtuple('Entry', 'kind size mtime_ns ino mode uid gid digest')
+
+KIND_DIR = 'd'
+KIND_FILE = 'f'
+KIND_LINK = 'l'
+
+
+def stat_entry(st):
+    mode = st.st_mode
+    if stat.S_ISDIR(mode):
+        # mtime каталога меняется от любого создания/удаления внутри, это не изменение данных
+        return Entry(KIND_DIR, 0, 0, st.st_ino, mode, st.st_uid, st.st_gid, None)
+    if stat.S_ISREG(mode):
+        kind = KIND_FILE
+    elif stat.S_ISLNK(mode):
+        kind = KIND_LINK
+    else:
+        return None
+    return Entry(kind, st.st_size, st.st_mtime_ns, st.st_ino, mode, st.st_uid, st.st_gid, None)
+
+
+def file_digest(path):
+    h = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.digest()
+
+
+def _scan_dir(source_dir, rel_dir, matcher=None):
+    """Записи одного каталога: [(путь, Entry)]. Пропавший каталог - пустой список.
+
+    Исключённое matcher в список не попадает, поэтому в исключённые каталоги
+    обход не спускается.
+    """
+    found = []
+    try:
+        it = os.scandir(os.path.join(source_dir, rel_dir))
+    except (FileNotFoundError, NotADirectoryError):
+        return found
+    with it:
+        for dirent in it:
+            try:
+                entry = stat_entry(dirent.stat(follow_symlinks=False))
+            except FileNotFoundError:
+                continue
+            rel = os.path.join(rel_dir, dirent.name)
+            if matcher and matcher.excluded(rel, entry is not None and entry.kind == KIND_DIR):
+                continue
+            if entry is None:
+                logging.warning(f"Skipping special file: {dirent.path}")
+                continue
+            found.append((rel, entry))
+    return found
+
+
+def scan_tree(source_dir, rel_root="", workers=1, matcher=None):
+    """Обойти дерево: {относительный путь: Entry}. FIFO, сокеты и устройства пропускаются.
+
+    workers > 1 - каталоги читаются пулом потоков: на NFS и холодном кэше
+    обход упирается в задержку каждого stat, а не в процессор.
+    """
+    entries = {}
+    if workers <= 1:
+        stack = [rel_root]
+        while stack:
+            for rel, entry in _scan_dir(source_dir, stack.pop(), matcher):
+                entries[rel] = entry
+                if entry.kind == KIND_DIR:
+                    stack.append(rel)
+        return entries
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan") as pool:
+        running = {pool.submit(_scan_dir, source_dir, rel_root, matcher)}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                for rel, entry in future.result():
+                    entries[rel] = entry
+                    if entry.kind == KIND_DIR:
+                        running.add(pool.submit(_scan_dir, source_dir, rel, matcher))
+    return entries
+
+
+def _same(old, new, use_hash):
+    if old is None:
+        return False
+    if use_hash and old.kind == KIND_FILE and new.kind == KIND_FILE:
+        return (old.digest is not None and old.digest == new.digest
+                and (old.mode, old.uid, old.gid) == (new.mode, new.uid, new.gid))
+    return old[:7] == new[:7]
+
+
+class ChangeIndex:
+    """Состояние source_dir на момент снимка snapshot и текущие изменения.
+
+    use_hash=True - файл с новыми mtime/inode, но прежним содержимым
+    изменением не считается (хеш пересчитывается только у таких файлов).
+    matcher - исключения (matcher.PathMatcher): такие пути не попадают ни в
+    индекс, ни под наблюдение inotify.
+    """
+
+    def __init__(self, source_dir, path, use_hash=False, rescan_interval=RESCAN_INTERVAL, workers=1,
+                 matcher=None):
+        self.source_dir = source_dir
+        self.path = path
+        self.use_hash = use_hash
+        self.workers = workers
+        self.matcher = matcher
+        self.rescan_interval = rescan_interval
+        self.baseline = {}
+        self.current = None
+        self.pending = set()        # отличия current от baseline, копятся до commit()
+        self.snapshot = None
+        self.last_full_scan = 0.0
+        self.watcher = None
+        self.load()
+
+    def load(self):
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable change index {self.path}: {e}")
+            return
+        if data.get('version') != INDEX_VERSION or data.get('source') != self.source_dir:
+            return
+        if data.get('hash', False) != self.use_hash:
+            return
+        self.snapshot = data.get('snapshot')
+        self.baseline = {rel: Entry(*values) for rel, values in data['entries'].items()}
+
+    def save(self):
+        data = {
+            'version': INDEX_VERSION,
+            'source': self.source_dir,
+            'snapshot': self.snapshot,
+            'hash': self.use_hash,
+            'entries': self.baseline,
+        }
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def watch(self):
+        """Включить inotify. False - недоступен, останутся полные проходы."""
+        watcher = InotifyWatcher(self.source_dir, self.matcher)
+        if not watcher.start():
+            return False
+        self.watcher = watcher
+        # Изменения до включения наблюдения не видны - первый refresh всё равно полный
+        self.last_full_scan = 0.0
+        return True
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def refresh(self):
+        """Обновить current и вернуть набор изменившихся путей относительно baseline."""
+        dirty = None
+        if self.watcher is not None and self.watcher.alive:
+            dirty, overflow = self.watcher.take()
+            if overflow or time.time() - self.last_full_scan >= self.rescan_interval:
+                dirty = None
+        if dirty is None or self.current is None:
+            self.current = scan_tree(self.source_dir, workers=self.workers, matcher=self.matcher)
+            self.last_full_scan = time.time()
+            self.pending = set()
+            touched = set(self.current) | set(self.baseline)
+        else:
+            touched = self._rescan(dirty)
+        pending = self.pending
+        for rel in touched:
+            new = self.current.get(rel)
+            old = self.baseline.get(rel)
+            if new is not None and self.use_hash and new.kind == KIND_FILE and new.digest is None:
+                new = self.current[rel] = self._with_digest(rel, new, old)
+            if new is None and old is None or new is not None and _same(old, new, self.use_hash):
+                pending.discard(rel)
+            else:
+                pending.add(rel)
+        return set(pending)
+
+    def _rescan(self, dirty):
+        """Перечитать пути из dirty (каталоги - целиком), вернуть затронутые пути."""
+        current = self.current
+        matcher = self.matcher
+        touched = set()
+        gone = []
+        for rel in sorted(dirty):
+            touched.add(rel)
+            try:
+                entry = stat_entry(os.lstat(os.path.join(self.source_dir, rel)))
+            except (FileNotFoundError, NotADirectoryError):
+                entry = None
+            if entry is not None and matcher and matcher.excluded(rel, entry.kind == KIND_DIR):
+                # Например, файл build заменён каталогом build/ при правиле "build/"
+                entry = None
+            old = current.pop(rel, None)
+            if old is not None and old.kind == KIND_DIR:
+                gone.append(rel + os.sep)
+            if entry is None:
+                continue
+            current[rel] = entry
+            if entry.kind == KIND_DIR:
+                sub = scan_tree(self.source_dir, rel, matcher=matcher)
+                current.update(sub)
+                touched.update(sub)
+        if gone:
+            # Содержимое пересозданных или удалённых каталогов: лишнее уберётся,
+            # существующее уже добавлено scan_tree выше
+            prefixes = tuple(gone)
+            for rel in [r for r in current if r.startswith(prefixes)]:
+                if not os.path.lexists(os.path.join(self.source_dir, rel)):
+                    del current[rel]
+                touched.add(rel)
+            touched.update(r for r in self.baseline if r.startswith(prefixes))
+        return touched
+
+    def _with_digest(self, rel, new, old):
+        if old is not None and old.digest is not None and old[:7] == new[:7]:
+            return new._replace(digest=old.digest)
+        try:
+            digest = file_digest(os.path.join(self.source_dir, rel)).hex()
+        except OSError:
+            return new
+        return new._replace(digest=digest)
+
+    def commit(self, snapshot):
+        """Снимок snapshot записан по current: он становится новой точкой отсчёта."""
+        self.baseline = dict(self.current)
+        self.pending = set()
+        self.snapshot = snapshot
+        self.save()
+
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+_event = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """Рекурсивное наблюдение за каталогом, копит изменённые относительные пути.
+
+    Исключённые каталоги не наблюдаются: кэши и сборки часто и меняются
+    чаще всего, и съедают лимит max_user_watches.
+    """
+
+    def __init__(self, root, matcher=None):
+        self.root = root
+        self.matcher = matcher
+        self.fd = None
+        self.libc = None
+        self.wds = {}               # wd -> относительный путь каталога
+        self.dirty = set()
+        self.overflow = False
+        self.alive = False
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            return False
+        self.libc = libc
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logging.warning(f"inotify unavailable: {os.strerror(ctypes.get_errno())}")
+            return False
+        self.fd = fd
+        if not self._add_tree(""):
+            os.close(fd)
+            self.fd = None
+            return False
+        self.alive = True
+        self.thread = threading.Thread(target=self._run, name="inotify", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.alive = False
+
+    def take(self):
+        """Забрать накопленные пути: (set, было ли переполнение)."""
+        with self.lock:
+            dirty, overflow = self.dirty, self.overflow
+            self.dirty = set()
+            self.overflow = False
+        return dirty, overflow
+
+    def _add_watch(self, rel):
+        path = os.path.join(self.root, rel) if rel else self.root
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logging.warning("inotify watch limit reached (fs.inotify.max_user_watches), "
+                                "falling back to full scans")
+                return False
+            # Каталог успел исчезнуть или недоступен - его заметит очередной проход
+            return err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES)
+        self.wds[wd] = rel
+        return True
+
+    def _add_tree(self, rel_root):
+        stack = [rel_root]
+        while stack:
+            rel = stack.pop()
+            if not self._add_watch(rel):
+                return False
+            try:
+                with os.scandir(os.path.join(self.root, rel) if rel else self.root) as it:
+                    for dirent in it:
+                        if dirent.is_dir(follow_symlinks=False):
+                            sub = os.path.join(rel, dirent.name)
+                            if not (self.matcher and self.matcher.excluded(sub, True)):
+                                stack.append(sub)
+            except OSError:
+                pass
+        return True
+
+    def _rewatch(self):
+        """После переполнения очереди: заново расставить наблюдения по всему дереву.
+
+        События о новых каталогах могли потеряться - без этого изменения в них
+        не были бы видны до суточного полного прохода. Для уже наблюдаемого
+        каталога ядро возвращает прежний wd; наблюдения исчезнувших снимаются.
+        """
+        old = self.wds
+        self.wds = {}
+        if not self._add_tree(""):
+            return False
+        for wd in old:
+            if wd not in self.wds:
+                self.libc.inotify_rm_watch(self.fd, wd)
+        return True
+
+    def _remove_tree(self, rel_root):
+        prefix = rel_root + os.sep
+        for wd, rel in list(self.wds.items()):
+            if rel == rel_root or rel.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.wds[wd]
+
+    def _run(self):
+        fd = self.fd
+        while not self.stop_event.is_set():
+            ready, _, _ = select.select([fd], [], [], 1.0)
+            if not ready:
+                continue
+            try:
+                data = os.read(fd, 256 * 1024)
+            except BlockingIOError:
+                continue
+            self._handle(data)
+
+    def _handle(self, data):
+        new_dirs = []
+        dirty = []
+        overflow = lost = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = _event.unpack_from(data, offset)
+            name = data[offset + _event.size:offset + _event.size + length].rstrip(b"\0")
+            offset += _event.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = lost = True
+                continue
+            rel_dir = self.wds.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.wds[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if not rel_dir:
+                    overflow = True     # сам корень удалён или перемещён
+                continue
+            if not name:
+                continue
+            rel = os.path.join(rel_dir, os.fsdecode(name))
+            if self.matcher and self.matcher.excluded(rel, bool(mask & IN_ISDIR)):
+                continue
+            dirty.append(rel)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                new_dirs.append(rel)
+            elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                # Наблюдения переехали вместе с каталогом и сообщали бы старые пути;
+                # на новом месте их заново поставит IN_MOVED_TO
+                self._remove_tree(rel)
+        for rel in new_dirs:
+            if not self._add_tree(rel):
+                overflow = True
+                self.alive = False
+        # Наблюдения - до выставления overflow: полный проход в refresh() пойдёт
+        # уже после них, и ничего между ними не потеряется
+        if lost and self.alive and not self._rewatch():
+            self.alive = False
+        with self.lock:
+            self.dirty.update(dirty)
+            self.overflow = self.overflow or overflow
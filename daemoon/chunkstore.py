@@ -0,0 +1,475 @@
+"""Дедуплицирующее хранилище чанков для снимков демона.
+
+Файлы режутся на чанки по содержимому (gear-хеш, как в FastCDC): граница
+ставится там, где хеш последних WINDOW байт даёт нули под маской, поэтому
+вставка или правка в середине файла сдвигает только соседние границы, а
+остальные чанки совпадают с прежними. Чанки лежат в <backup_dir>/.chunks
+под именем своего хеша, одинаковые хранятся один раз.
+
+Снимок backup_* в этом режиме - каталог с одним файлом manifest.jsonl.gz:
+по строке на файл/каталог/ссылку со списком [(хеш, размер), ...] чанков.
+Число ссылок на каждый чанк из всех манифестов хранится в index.sqlite3;
+при удалении снимка release() уменьшает счётчики и удаляет чанки, на
+которые больше никто не ссылается. Имя освобождённого снимка пишется в той
+же транзакции, поэтому повтор после прерванного удаления ссылки не снимает.
+
+При наличии NumPy хеш считается векторно (5 проходов удвоения окна),
+иначе - побайтовым циклом; границы чанков в обоих случаях одинаковые.
+"""
+import os
+import stat
+import gzip
+import json
+import shutil
+import hashlib
+import sqlite3
+import logging
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+
+from changeindex import scan_tree, KIND_DIR, KIND_LINK
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHUNKS_DIR = ".chunks"
+MANIFEST_NAME = "manifest.jsonl.gz"
+INDEX_NAME = "index.sqlite3"
+
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+
+WINDOW = 32                 # бит хеша = байт окна: бит j зависит от последних j+1 байт
+HASH_MASK = 0xffffffff
+
+# Таблица gear фиксирована навсегда: от неё зависят границы уже сохранённых чанков
+GEAR = [int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=4, person=b"daemoon-gear").digest(),
+                       'little') for i in range(256)]
+GEAR_NP = np.array(GEAR, dtype=np.uint32) if np is not None else None
+
+
+def cut_mask(min_size, avg_size):
+    """Маска по старшим битам: средний размер чанка ~ min_size + 2**bits."""
+    bits = max(1, (avg_size - min_size).bit_length() - 1)
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+def _candidates_np(history, block, mask):
+    data = np.frombuffer(history + block, dtype=np.uint8)
+    h = np.take(GEAR_NP, data)
+    tmp = np.empty_like(h)
+    # h[i] = sum(gear[b[i-k]] << k, k < WINDOW) по удвоению окна: 1, 2, 4, ... 32
+    shift = 1
+    while shift < WINDOW:
+        np.left_shift(h[:-shift], shift, out=tmp[:-shift])
+        np.add(h[shift:], tmp[:-shift], out=h[shift:])
+        shift <<= 1
+    # Маска занимает старшие биты: нули под ней - то же, что h < младшего бита маски
+    hits = np.flatnonzero(h < (mask & -mask))
+    hits = hits[hits >= len(history)] - len(history)
+    return hits.tolist()
+
+
+def _candidates_py(state, block, mask):
+    gear = GEAR
+    h = state[0]
+    hits = []
+    for i, b in enumerate(block):
+        h = ((h << 1) + gear[b]) & HASH_MASK
+        if not h & mask:
+            hits.append(i)
+    state[0] = h
+    return hits
+
+
+def iter_chunks(f, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+    """Резать поток f на чанки по содержимому, отдаёт bytes."""
+    mask = cut_mask(min_size, avg_size)
+    buf = b""
+    cands = []          # концы возможных чанков, смещения в buf
+    history = b""       # последние WINDOW - 1 байт потока для векторного хеша
+    state = [0]         # хеш для побайтового цикла
+    eof = False
+    while not eof:
+        block = f.read(READ_SIZE)
+        eof = not block
+        if block:
+            base = len(buf)
+            if np is not None:
+                hits = _candidates_np(history, block, mask)
+                history = (history + block[-(WINDOW - 1):])[-(WINDOW - 1):]
+            else:
+                hits = _candidates_py(state, block, mask)
+            buf += block
+            cands.extend(base + i + 1 for i in hits)
+        start = 0
+        while start < len(buf):
+            # Первая граница не ближе min_size и не дальше max_size от начала чанка
+            j = bisect_left(cands, start + min_size)
+            if j < len(cands) and cands[j] <= start + max_size:
+                end = cands[j]
+            elif len(buf) - start >= max_size:
+                end = start + max_size
+            elif eof:
+                end = len(buf)
+            else:
+                break
+            yield buf[start:end]
+            start = end
+        if start:
+            buf = buf[start:]
+            cands = [c - start for c in cands[bisect_left(cands, start + 1):]]
+
+
+def chunk_id(data):
+    # sha256 здесь быстрее blake2b: на x86 и ARM он аппаратный
+    return hashlib.sha256(data).hexdigest()
+
+
+_store_locks = {}
+_store_locks_guard = threading.Lock()
+
+
+def store_lock(backup_dir):
+    """Блокировка хранилища backup_dir внутри процесса.
+
+    Запись снимка проверяет наличие чанков и переиспользует чанки прежнего
+    манифеста до того, как увеличит их счётчики; release() в это время
+    может удалить такой чанк. Поэтому chunk_tree и удаление снимков-манифестов
+    из разных потоков выполняются под этой блокировкой.
+    """
+    key = os.path.realpath(backup_dir)
+    with _store_locks_guard:
+        lock = _store_locks.get(key)
+        if lock is None:
+            lock = _store_locks[key] = threading.Lock()
+    return lock
+
+
+class ChunkStore:
+    """Каталог чанков со счётчиками ссылок.
+
+    Файл чанка пишется до того, как на него сошлётся манифест, а счётчики
+    увеличиваются одной транзакцией после записи манифеста. После сбоя
+    в хранилище могут остаться лишние чанки, но не висячие ссылки;
+    rebuild() пересчитывает счётчики по манифестам и убирает лишнее.
+    Таблица released - снимки, ссылки которых уже сняты, а каталог ещё не удалён.
+    """
+
+    def __init__(self, backup_dir, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+        if not min_size < avg_size < max_size:
+            raise ValueError("chunk sizes must satisfy min < avg < max")
+        self.backup_dir = backup_dir
+        self.root = os.path.join(backup_dir, CHUNKS_DIR)
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.root, INDEX_NAME))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS chunks "
+                            "(id TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL) "
+                            "WITHOUT ROWID")
+            self.db.execute("CREATE TABLE IF NOT EXISTS released (name TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def close(self):
+        self.db.close()
+
+    def path(self, cid):
+        return os.path.join(self.root, cid[:2], cid)
+
+    def has(self, cid):
+        return self.db.execute("SELECT 1 FROM chunks WHERE id = ?", (cid,)).fetchone() is not None
+
+    def put(self, data):
+        """Сохранить чанк, если его ещё нет. Возвращает (хеш, записан ли)."""
+        cid = chunk_id(data)
+        path = self.path(cid)
+        if self.has(cid) or os.path.exists(path):
+            return cid, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return cid, True
+
+    def read(self, cid):
+        with open(self.path(cid), 'rb') as f:
+            return f.read()
+
+    def add_refs(self, refs):
+        """refs - {хеш: (размер, число ссылок)} из нового манифеста."""
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO chunks (id, size, refs) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET refs = refs + excluded.refs",
+                [(cid, size, n) for cid, (size, n) in refs.items()])
+
+    def released(self, name):
+        return self.db.execute("SELECT 1 FROM released WHERE name = ?", (name,)).fetchone() is not None
+
+    def release(self, snapshot_dir, name=None):
+        """Снять ссылки манифеста снимка и удалить осиротевшие чанки.
+
+        name - имя снимка, не зависящее от переименования каталога перед
+        удалением (по умолчанию имя каталога). Ссылки снимаются один раз:
+        повторный вызов после прерванного удаления только дочищает чанки.
+        Возвращает (число удалённых чанков, освобождено байт).
+        """
+        name = name or os.path.basename(snapshot_dir.rstrip(os.sep))
+        already = self.released(name)
+        refs = {} if already else manifest_refs(os.path.join(snapshot_dir, MANIFEST_NAME))
+        with self.db:
+            if not already:
+                self.db.executemany("UPDATE chunks SET refs = refs - ? WHERE id = ?",
+                                    [(n, cid) for cid, (size, n) in refs.items()])
+                self.db.execute("INSERT INTO released (name) VALUES (?)", (name,))
+            dead = self.db.execute("SELECT id, size FROM chunks WHERE refs <= 0").fetchall()
+            self.db.execute("DELETE FROM chunks WHERE refs <= 0")
+        freed = 0
+        for cid, size in dead:
+            try:
+                os.remove(self.path(cid))
+                freed += size
+            except FileNotFoundError:
+                pass
+        return len(dead), freed
+
+    def forget_released(self, name):
+        """Каталог снимка удалён - отметка о снятых ссылках больше не нужна."""
+        with self.db:
+            self.db.execute("DELETE FROM released WHERE name = ?", (name,))
+
+    def rebuild(self, snapshots=None):
+        """Пересчитать счётчики по манифестам и удалить чанки без ссылок.
+
+        snapshots - [(имя, каталог)] всех снимков на диске, включая ждущие
+        удаления (по умолчанию - каталоги без точки в начале имени); снимки
+        с уже снятыми ссылками не считаются. Вызывать под store_lock, когда
+        не пишется ни один снимок. Возвращает число удалённых файлов чанков.
+        """
+        if snapshots is None:
+            snapshots = [(name, os.path.join(self.backup_dir, name))
+                         for name in os.listdir(self.backup_dir) if not name.startswith(".")]
+        total = {}
+        names = set()
+        for name, path in sorted(snapshots):
+            names.add(name)
+            manifest = os.path.join(path, MANIFEST_NAME)
+            if self.released(name) or not os.path.exists(manifest):
+                continue
+            for cid, (size, n) in manifest_refs(manifest).items():
+                old = total.get(cid)
+                total[cid] = (size, n + (old[1] if old else 0))
+        with self.db:
+            self.db.execute("DELETE FROM chunks")
+            # Отметки снимков, каталогов которых уже нет
+            for (name,) in self.db.execute("SELECT name FROM released").fetchall():
+                if name not in names:
+                    self.db.execute("DELETE FROM released WHERE name = ?", (name,))
+        self.add_refs(total)
+        removed = 0
+        for sub in os.listdir(self.root):
+            sub_path = os.path.join(self.root, sub)
+            if not os.path.isdir(sub_path):
+                continue
+            for cid in os.listdir(sub_path):
+                if cid not in total:
+                    os.remove(os.path.join(sub_path, cid))
+                    removed += 1
+        return removed
+
+    def stats(self):
+        count, size, refs = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refs), 0) FROM chunks").fetchone()
+        return {'chunks': count, 'stored_bytes': size, 'references': refs}
+
+
+def read_manifest(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def manifest_refs(path):
+    refs = {}
+    for entry in read_manifest(path):
+        for cid, size in entry.get('chunks', ()):
+            old = refs.get(cid)
+            refs[cid] = (size, old[1] + 1 if old else 1)
+    return refs
+
+
+def is_chunked(snapshot_dir):
+    return os.path.exists(os.path.join(snapshot_dir, MANIFEST_NAME))
+
+
+class ChunkStats:
+    __slots__ = ('files', 'reused', 'chunked', 'chunks', 'new_chunks', 'bytes_read', 'bytes_written')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        return (f"{self.files} files: {self.reused} unchanged, {self.chunked} chunked, "
+                f"{self.new_chunks}/{self.chunks} new chunks, {self.bytes_written} of "
+                f"{self.bytes_read} bytes stored")
+
+
+def _previous_entries(prev_dir):
+    """{путь: запись} файлов предыдущего снимка для пропуска неизменившихся."""
+    if not prev_dir or not is_chunked(prev_dir):
+        return {}
+    return {e['path']: e for e in read_manifest(os.path.join(prev_dir, MANIFEST_NAME))
+            if e['type'] == 'file'}
+
+
+def chunk_tree(source_dir, dest_dir, store, prev_dir=None, listing=None, walk_workers=1,
+               read_throttle=None, write_throttle=None):
+    """Записать снимок source_dir в dest_dir в виде манифеста чанков store.
+
+    Файлы с тем же размером и mtime, что в предыдущем снимке, не читаются:
+    их список чанков берётся из прежнего манифеста. listing - готовый список
+    {путь: Entry} из ChangeIndex вместо обхода дерева. read_throttle и
+    write_throttle ограничивают чтение файлов и запись новых чанков.
+    Возвращает ChunkStats.
+    """
+    stats = ChunkStats()
+    previous = _previous_entries(prev_dir)
+    if listing is None:
+        listing = scan_tree(source_dir, workers=walk_workers)
+    refs = {}
+    os.mkdir(dest_dir)
+    manifest_path = os.path.join(dest_dir, MANIFEST_NAME)
+    with gzip.open(manifest_path, 'wt', encoding='utf-8', compresslevel=6) as out:
+        # Родитель в сортировке раньше потомков - restore_tree создаёт каталоги по порядку
+        for rel in sorted(listing):
+            entry = listing[rel]
+            path = os.path.join(source_dir, rel)
+            try:
+                if entry.kind == KIND_DIR:
+                    # В индексе mtime каталогов не хранится
+                    st = os.lstat(path)
+                    record = {'path': rel, 'type': 'dir', 'mode': stat.S_IMODE(st.st_mode),
+                              'mtime_ns': st.st_mtime_ns}
+                elif entry.kind == KIND_LINK:
+                    record = {'path': rel, 'type': 'link', 'mode': stat.S_IMODE(entry.mode),
+                              'mtime_ns': entry.mtime_ns, 'target': os.readlink(path)}
+                else:
+                    record = {'path': rel, 'type': 'file', 'mode': stat.S_IMODE(entry.mode),
+                              'mtime_ns': entry.mtime_ns, 'size': entry.size,
+                              'chunks': _file_chunks(path, entry, previous.get(rel), store, stats,
+                                                     read_throttle, write_throttle)}
+                    for cid, size in record['chunks']:
+                        old = refs.get(cid)
+                        refs[cid] = (size, old[1] + 1 if old else 1)
+            except FileNotFoundError:
+                # Удалён во время снимка
+                continue
+            out.write(json.dumps(record, separators=(',', ':')) + "\n")
+    store.add_refs(refs)
+    return stats
+
+
+def _file_chunks(path, entry, prev, store, stats, read_throttle=None, write_throttle=None):
+    stats.files += 1
+    if prev is not None and prev['size'] == entry.size and prev['mtime_ns'] == entry.mtime_ns:
+        stats.reused += 1
+        return prev['chunks']
+    stats.chunked += 1
+    chunks = []
+    with open(path, 'rb') as f:
+        for data in iter_chunks(f, store.min_size, store.avg_size, store.max_size):
+            cid, written = store.put(data)
+            chunks.append((cid, len(data)))
+            stats.chunks += 1
+            stats.bytes_read += len(data)
+            if read_throttle is not None:
+                read_throttle.consume(len(data))
+            if written:
+                stats.new_chunks += 1
+                stats.bytes_written += len(data)
+                if write_throttle is not None:
+                    write_throttle.consume(len(data))
+    return chunks
+
+
+def restore_tree(snapshot_dir, store, dest_dir, select=None, workers=1):
+    """Собрать дерево снимка обратно в dest_dir.
+
+    select - предикат относительного пути (только выбранное и каталоги над
+    ним), workers > 1 - файлы собираются из чанков пулом потоков.
+    Возвращает число восстановленных файлов.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    dirs = []
+    files = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="restore") as pool:
+        pending = []
+        for entry in read_manifest(os.path.join(snapshot_dir, MANIFEST_NAME)):
+            rel = entry['path']
+            if select is not None and not select(rel):
+                continue
+            path = os.path.join(dest_dir, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            kind = entry['type']
+            if kind == 'dir':
+                os.makedirs(path, exist_ok=True)
+                dirs.append((path, entry))
+                continue
+            if kind == 'link':
+                os.symlink(entry['target'], path)
+                continue
+            pending.append(pool.submit(_restore_file, store, path, entry))
+            files += 1
+            # Не копить в очереди весь манифест
+            if len(pending) >= workers * 4:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+    # Каталоги - после файлов, иначе их mtime сбросится
+    for path, entry in reversed(dirs):
+        os.chmod(path, entry['mode'])
+        os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+    return files
+
+
+def _restore_file(store, path, entry):
+    with open(path, 'xb') as f:
+        for cid, size in entry['chunks']:
+            f.write(store.read(cid))
+    os.chmod(path, entry['mode'])
+    os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+
+def remove_snapshot(snapshot_dir, store=None, name=None):
+    """Удалить снимок; для снимка-манифеста - сначала снять ссылки на чанки.
+
+    name - имя снимка для release(), если каталог уже переименован.
+    """
+    if not is_chunked(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+        return
+    name = name or os.path.basename(snapshot_dir.rstrip(os.sep))
+    own = store is None
+    if own:
+        store = ChunkStore(os.path.dirname(snapshot_dir.rstrip(os.sep)))
+    try:
+        removed, freed = store.release(snapshot_dir, name)
+        logging.info(f"Released {removed} chunks ({freed} bytes) of {snapshot_dir}")
+        shutil.rmtree(snapshot_dir)
+        store.forget_released(name)
+    finally:
+        if own:
+            store.close()
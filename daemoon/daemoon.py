@@ -8,7 +8,21 @@ from datetime import datetime
 import signal
 import sys
 import argparse
-import fnmatch
+import re
+import sqlite3
+
+from snapshot import snapshot_tree, list_snapshots, latest_snapshot, COMPARE_MODES
+from chunkstore import ChunkStore, chunk_tree, remove_snapshot, store_lock, AVG_SIZE
+from changeindex import ChangeIndex, INDEX_NAME, scan_tree, KIND_FILE
+from copyengine import CopyEngine, COPY_WORKERS
+from archive import archive_tree, check_codec, COMPRESS_THREADS
+from throttle import make_throttle
+from matcher import PathMatcher
+from catalog import Catalog, CATALOG_NAME, snapshot_time
+from retention import Retention, Pruner, PARTIAL_SUFFIX
+from scheduler import Scheduler, CronSchedule, IntervalSchedule
+from verify import record_checksums, checksum_path, forget_checksums, verify_snapshot
+from restore import restore_snapshot
 
 # Конфигурационные пути
 CONFIG_DIR = "/home/joshi/.config/backup_daemon"
@@ -16,6 +30,10 @@ CONFIG_FILE = os.path.join(CONFIG_DIR, "config.json")
 LOG_FILE = "/home/joshi/backup_daemon.log"
 PID_FILE = "/home/joshi/backup_daemon.pid"
 
+BACKUP_MODES = ('full', 'incremental', 'chunked', 'archive')
+BACKUP_PREFIX = "backup"
+JOB_WORKERS = 4         # заданий одновременно, если не задано max_parallel_jobs
+
 is_running = False
 
 def load_config(config_path):
@@ -33,7 +51,7 @@ def setup_logging(log_file):
         if os.path.isdir(log_file):
             log_file = os.path.join(log_file, "backup_daemon.log")  # Добавить имя файла к директории
         logging.basicConfig(filename=log_file, level=logging.INFO, 
-                           format='%(asctime)s - %(levelname)s - %(message)s',
+                           format='%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s',
                            datefmt='%Y-%m-%d %H:%M:%S')
     except Exception as e:
         print(f"Error setting up logging: {e}")
@@ -41,45 +59,152 @@ def setup_logging(log_file):
                            format='%(asctime)s - %(message)s',
                            datefmt='%Y-%m-%d %H:%M:%S')
 
-def cleanup_old_backups(backup_dir, max_backups=30):
-    """Удалить старые резервные копии."""
+def cleanup_old_backups(backup_dir, max_backups=30, prefix=BACKUP_PREFIX, retention=None,
+                        catalog=None, pruner=None):
+    """Удалить старые резервные копии.
+
+    retention - политика Retention (по умолчанию max_backups последних),
+    список снимков берётся из catalog, если он есть; pruner удаляет в фоне.
+    """
     try:
-        backups = []
-        for item in os.listdir(backup_dir):
-            item_path = os.path.join(backup_dir, item)
-            if os.path.isdir(item_path) and item.startswith("backup_"):
-                backups.append((item_path, os.path.getmtime(item_path)))
-        
-        backups.sort(key=lambda x: x[1], reverse=True)
-        
-        if len(backups) > max_backups:
-            for backup_path, _ in backups[max_backups:]:
-                shutil.rmtree(backup_path)
-                logging.info(f"Removed old backup: {backup_path}")
+        if retention is None:
+            retention = Retention(last=max_backups)
+        if catalog is not None:
+            snapshots = [(info.name, info.created) for info in catalog.snapshots(prefix)]
+        else:
+            # По метке времени в имени: mtime каталога снимка копируется с исходного
+            snapshots = [(name, snapshot_time(name)) for name, _ in list_snapshots(backup_dir, f"{prefix}_")]
+            snapshots = [s for s in snapshots if s[1] is not None]
+        expired = retention.expired(snapshots)
+        if pruner is not None:
+            pruner.prune(expired)
+            return
+        for name in expired:
+            backup_path = os.path.join(backup_dir, name)
+            remove_snapshot(backup_path)
+            forget_checksums(backup_dir, name)
+            logging.info(f"Removed old backup: {backup_path}")
                 
     except Exception as e:
         logging.error(f"Error cleaning up old backups: {e}")
 
-def backup_files(source_dir, backup_dir, max_backups=30):
-    """Создать резервные копии файлов из исходного каталога в каталог резервных копий."""
+def backup_files(source_dir, backup_dir, max_backups=30, mode='incremental', compare='mtime',
+                 chunk_size=AVG_SIZE, index=None, copy_workers=COPY_WORKERS,
+                 archive_codec='gzip', archive_level=None, archive_threads=COMPRESS_THREADS,
+                 read_limit=0, write_limit=0, matcher=None, prefix=BACKUP_PREFIX,
+                 retention=None, catalog=None, pruner=None, checksums=True):
+    """Создать резервные копии файлов из исходного каталога в каталог резервных копий.
+
+    mode='full' - полная копия каждый раз, 'incremental' - неизменившиеся
+    файлы становятся жёсткими ссылками на предыдущий снимок (snapshot.py),
+    'chunked' - снимок хранится манифестом чанков общего хранилища (chunkstore.py),
+    'archive' - снимок - один сжатый tar (archive.py). read_limit/write_limit
+    ограничивают чтение и запись в МБ/с во всех режимах.
+    matcher - исключения (matcher.PathMatcher), prefix - начало имён снимков.
+    catalog (catalog.py) получает статистику снимка, retention и pruner
+    (retention.py) - ротация с удалением в фоне. checksums - записать для
+    снимка с жёсткими ссылками манифест контрольных сумм (verify.py).
+    С индексом изменений (changeindex.py) копия без изменений пропускается -
+    тогда возвращается None. Файлы копирует пул из copy_workers потоков (copyengine.py).
+    """
+    started = time.monotonic()
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    backup_path = os.path.join(backup_dir, f"backup_{timestamp}")
+    backup_path = os.path.join(backup_dir, f"{prefix}_{timestamp}")
+    # Снимок собирается под временным именем: прерванная копия не станет
+    # базой для следующей и не попадёт в ротацию
+    partial_path = os.path.join(backup_dir, f".{prefix}_{timestamp}{PARTIAL_SUFFIX}")
     
     try:
         # Создать директорию для бэкапов если не существует
         os.makedirs(backup_dir, exist_ok=True)
         
-        shutil.copytree(source_dir, backup_path)
-        logging.info(f"Backup successful: {backup_path}")
+        previous = catalog.latest(prefix) if catalog is not None else latest_snapshot(backup_dir, f"{prefix}_")
+        if catalog is not None and previous and not os.path.isdir(previous):
+            # Снимок удалили вручную - каталог нужно сверить с диском
+            catalog.sync(prefix)
+            previous = catalog.latest(prefix)
+        changed = None
+        if index is not None:
+            changed = index.refresh()
+            # Индекс описывает именно последний снимок - иначе сравнивать не с чем
+            if previous and index.snapshot == os.path.basename(previous):
+                if not changed:
+                    logging.info(f"No changes in {source_dir} since {index.snapshot}, backup skipped")
+                    return None
+            else:
+                changed = None
+            listing = index.current
+        else:
+            # Один обход на запуск; исключённые каталоги в нём не читаются
+            listing = scan_tree(source_dir, workers=copy_workers, matcher=matcher)
+        
+        read_throttle, write_throttle = make_throttle(read_limit), make_throttle(write_limit)
+        if mode == 'archive':
+            stats = archive_tree(source_dir, partial_path, archive_codec, archive_level, archive_threads,
+                                 listing, read_throttle, write_throttle, copy_workers)
+            stored = stats.bytes_out
+            details = str(stats)
+        elif mode == 'chunked':
+            # Пока снимок ссылается на чанки, фоновое удаление не должно их освобождать
+            with store_lock(backup_dir):
+                store = ChunkStore(backup_dir, chunk_size // 4, chunk_size, chunk_size * 4)
+                try:
+                    stats = chunk_tree(source_dir, partial_path, store, previous, listing, copy_workers,
+                                       read_throttle, write_throttle)
+                finally:
+                    store.close()
+            stored = stats.bytes_written
+            details = f"{stats}, base {os.path.basename(previous) if previous else 'none'}"
+        else:
+            if mode == 'full':
+                previous = None
+            with CopyEngine(copy_workers, read_throttle=read_throttle, write_throttle=write_throttle) as engine:
+                stats = snapshot_tree(source_dir, partial_path, previous, compare, listing, changed,
+                                      engine, copy_workers)
+            stored = stats.bytes_copied
+            details = f"{stats}, base {os.path.basename(previous) if previous else 'none'}; copy: {engine.stats}"
+        if changed is not None:
+            details += f", {len(changed)} changed paths"
+        os.rename(partial_path, backup_path)
+        if checksums and mode in ('full', 'incremental'):
+            name = os.path.basename(backup_path)
+            try:
+                prev_checksums = checksum_path(backup_dir, os.path.basename(previous)) if previous else None
+                sums = record_checksums(backup_path, checksum_path(backup_dir, name), prev_checksums,
+                                        copy_workers)
+                details += f"; checksums: {sums}"
+            except OSError as e:
+                # Снимок уже готов - без манифеста его только нельзя будет проверить
+                logging.warning(f"Could not record checksums for {name}: {e}")
+        duration = time.monotonic() - started
+        logging.info(f"Backup successful: {backup_path} ({details}) in {duration:.1f} s")
+        if index is not None:
+            index.commit(os.path.basename(backup_path))
+        if catalog is not None:
+            files = [entry.size for entry in listing.values() if entry.kind == KIND_FILE]
+            catalog.record(os.path.basename(backup_path), mode, len(files), sum(files), stored, duration)
         
         # Очистить старые бэкапы
-        cleanup_old_backups(backup_dir, max_backups)
+        cleanup_old_backups(backup_dir, max_backups, prefix, retention, catalog, pruner)
         
         return True
     except Exception as e:
         logging.error(f"Backup failed: {e}")
+        shutil.rmtree(partial_path, ignore_errors=True)
         return False
 
+def build_matcher(source_dir, backup_dir, patterns):
+    """Собрать исключения один раз на запуск демона.
+
+    Если каталог копий лежит внутри исходного, он исключается сам: иначе
+    каждая копия включала бы все предыдущие.
+    """
+    patterns = list(patterns)
+    rel = os.path.relpath(os.path.realpath(backup_dir), os.path.realpath(source_dir))
+    if rel != os.curdir and not rel.startswith(os.pardir):
+        patterns.append("/" + re.sub(r'([*?\[\\!#])', r'\\\1', rel) + "/")
+    return PathMatcher(patterns)
+
 def write_pid(pid_file):
     """Записать PID процесса в файл."""
     try:
@@ -99,51 +224,158 @@ def remove_pid(pid_file):
     except Exception as e:
         logging.error(f"Error removing PID file: {e}")
 
+class BackupJob:
+    """Одно задание: source_dir -> backup_dir со своими режимом, расписанием и лимитами.
+
+    Настройки - как в корне конфигурации; ошибки в них - ValueError.
+    """
+
+    def __init__(self, name, options):
+        self.name = name
+        try:
+            self.source_dir = options['source_dir']
+            self.backup_dir = options['backup_dir']
+        except KeyError as e:
+            raise ValueError(f"missing {e.args[0]}") from None
+        self.options = options
+        self.max_backups = options.get('max_backups', 30)
+        self.mode = options.get('backup_mode', 'incremental')
+        self.compare = options.get('compare', 'mtime')
+        self.chunk_size = options.get('chunk_size', AVG_SIZE)
+        self.copy_workers = options.get('copy_workers', COPY_WORKERS)
+        self.archive_codec = options.get('archive_codec', 'gzip')
+        self.archive_level = options.get('archive_level')
+        self.archive_threads = options.get('archive_threads', COMPRESS_THREADS)
+        self.read_limit = options.get('read_limit_mb', 0)
+        self.write_limit = options.get('write_limit_mb', 0)
+        self.prefix = options.get('backup_prefix', BACKUP_PREFIX)
+        self.priority = options.get('priority', 0)
+        if not self.prefix or os.sep in self.prefix:
+            raise ValueError(f"invalid backup_prefix: {self.prefix!r}")
+        if self.mode not in BACKUP_MODES:
+            raise ValueError(f"unknown backup_mode: {self.mode}")
+        if self.compare not in COMPARE_MODES:
+            raise ValueError(f"unknown compare mode: {self.compare}")
+        if self.mode == 'archive':
+            check_codec(self.archive_codec, self.archive_level)
+        if not isinstance(self.priority, int):
+            raise ValueError("priority must be an integer")
+        if 'cron' in options:
+            self.schedule = CronSchedule(options['cron'])
+        elif 'interval_seconds' in options:
+            self.schedule = IntervalSchedule(options['interval_seconds'])
+        else:
+            raise ValueError("either interval_seconds or cron is required")
+        try:
+            self.retention = Retention.from_config(options)
+        except TypeError as e:
+            raise ValueError(f"invalid retention settings: {e}") from None
+        self.matcher = build_matcher(self.source_dir, self.backup_dir, options.get('exclude_patterns', []))
+        self.index = None
+        self.catalog = None
+        self.pruner = None
+
+    def open(self):
+        """Индекс изменений, inotify, каталог снимков и фоновое удаление."""
+        if self.options.get('change_index', True):
+            # У заданий с общим backup_dir индексы не должны совпадать
+            index_name = INDEX_NAME if self.prefix == BACKUP_PREFIX else f".{self.prefix}{INDEX_NAME}"
+            self.index = ChangeIndex(self.source_dir,
+                                     self.options.get('index_file', os.path.join(self.backup_dir, index_name)),
+                                     use_hash=self.options.get('index_hash', False),
+                                     workers=self.copy_workers, matcher=self.matcher)
+            if self.options.get('watch', True) and not self.index.watch():
+                logging.info(f"{self.name}: inotify is not available, changes are detected by rescanning")
+        self.catalog = Catalog(self.backup_dir)
+        added, gone = self.catalog.sync(self.prefix)
+        if added or gone:
+            logging.info(f"{self.name}: backup catalog synced: {added} snapshots added, {gone} forgotten")
+        self.pruner = Pruner(self.backup_dir, self.catalog)
+        self.pruner.start()
+        logging.info(f"Job {self.name}: {self.source_dir} -> {self.backup_dir}, {self.mode}, "
+                     f"{self.schedule}, priority {self.priority}, retention: {self.retention}")
+
+    def close(self):
+        if self.pruner is not None:
+            # Дождаться очереди удаления: не обрывать снимок между снятием ссылок и rmtree
+            if not self.pruner.queue.empty():
+                logging.info(f"{self.name}: waiting for expired backups to be removed...")
+            self.pruner.stop()
+        if self.index is not None:
+            self.index.close()
+
+    def run(self):
+        success = backup_files(self.source_dir, self.backup_dir, self.max_backups, self.mode, self.compare,
+                               self.chunk_size, self.index, self.copy_workers, self.archive_codec,
+                               self.archive_level, self.archive_threads, self.read_limit, self.write_limit,
+                               self.matcher, self.prefix, self.retention, self.catalog, self.pruner,
+                               self.options.get('checksums', True))
+        if success:
+            print(f"Backup {self.name} completed at {datetime.now()}")
+        return success is not False
+
+def load_jobs(config):
+    """Задания из секции "jobs" (общие настройки берутся из корня) или одно - из самого файла."""
+    defaults = {key: value for key, value in config.items() if key != 'jobs'}
+    sections = config.get('jobs') or [{}]
+    jobs = []
+    seen = set()
+    for number, section in enumerate(sections, 1):
+        name = section.get('name', f"job{number}" if 'jobs' in config else "default")
+        try:
+            job = BackupJob(name, {**defaults, **section})
+        except ValueError as e:
+            raise ValueError(f"job {name}: {e}") from None
+        key = (os.path.realpath(job.backup_dir), job.prefix)
+        if key in seen or name in {j.name for j in jobs}:
+            raise ValueError(f"job {name}: name or backup_dir/backup_prefix is used by another job")
+        seen.add(key)
+        jobs.append(job)
+    return jobs
+
 def run_backup_daemon(config_path):
     """Запустить демон резервного копирования."""
     global is_running
     is_running = True
 
     config = load_config(config_path)
-    source_dir = config['source_dir']
-    backup_dir = config['backup_dir']
-    interval = config['interval_seconds']
-    log_file = config.get('log_file', LOG_FILE)
-    max_backups = config.get('max_backups', 30)
-    
-    setup_logging(log_file)
+    setup_logging(config.get('log_file', LOG_FILE))
+    try:
+        jobs = load_jobs(config)
+    except ValueError as e:
+        logging.error(f"Invalid configuration: {e}")
+        sys.exit(1)
+    scheduler = Scheduler(config.get('max_parallel_jobs', min(len(jobs), JOB_WORKERS)))
+    for job in jobs:
+        job.open()
+        scheduler.add(job.name, job.run, job.schedule, job.priority)
     write_pid(PID_FILE)  # Записать pid
     
-    logging.info("Starting backup daemon...")
+    logging.info(f"Starting backup daemon with {len(jobs)} jobs...")
     print("Backup daemon started. Use Ctrl+C to stop.")
     
     # Обработка сигналов для корректного завершения
     def signal_handler(sig, frame):
         global is_running
+        if not is_running:
+            # Второй сигнал - не ждать выполняющиеся копии
+            remove_pid(PID_FILE)
+            os._exit(1)
         logging.info(f"Received signal {sig}, stopping daemon...")
         is_running = False
-        remove_pid(PID_FILE) # очищает PID файл
         print("\nStopping daemon...")
-        sys.exit(0)  # Немедленный выход
+        scheduler.stop()
     
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
-    while is_running:
-        try:
-            success = backup_files(source_dir, backup_dir, max_backups)
-            if success:
-                print(f"Backup completed at {datetime.now()}")
-            
-            # Ждать интервал с проверкой флага
-            for _ in range(interval * 10):
-                if not is_running:
-                    break
-                time.sleep(0.1)
-                
-        except Exception as e:
-            logging.error(f"Error in backup loop: {e}")
-            time.sleep(60)
+    scheduler.run()
+    if scheduler.running:
+        logging.info(f"Waiting for {scheduler.running} running backups to finish...")
+    scheduler.wait()
+    for job in jobs:
+        job.close()
+    remove_pid(PID_FILE) # очищает PID файл
 
     logging.info("Daemon stopped.")
     print("Daemon stopped.")
@@ -201,6 +433,93 @@ def show_status():
         print("Daemon status: STOPPED (PID file exists but process is dead)")
         # Очищаем битый PID файл
         remove_pid(PID_FILE)
+    show_catalog()
+
+def show_catalog():
+    """Показать снимки каждого задания из каталога резервных копий."""
+    try:
+        with open(CONFIG_FILE, 'r') as config_file:
+            jobs = load_jobs(json.load(config_file))
+    except (OSError, ValueError):
+        return
+    for job in jobs:
+        if not os.path.exists(os.path.join(job.backup_dir, CATALOG_NAME)):
+            continue
+        try:
+            catalog = Catalog(job.backup_dir)
+            try:
+                snapshots = catalog.snapshots(job.prefix)
+            finally:
+                catalog.close()
+        except (OSError, sqlite3.Error):
+            continue
+        stored = sum(info.stored or 0 for info in snapshots)
+        print(f"{job.name}: {len(snapshots)} backups, {stored / 1e6:.1f} MB written in total")
+        if snapshots:
+            last = snapshots[-1]
+            details = f", {last.files} files, {last.size / 1e6:.1f} MB in {last.duration:.1f} s" \
+                if last.duration is not None else ""
+            print(f"  Last backup: {last.name} ({last.mode or 'unknown mode'}{details})")
+
+def _select_jobs(job_name):
+    with open(CONFIG_FILE, 'r') as config_file:
+        jobs = load_jobs(json.load(config_file))
+    if job_name is None:
+        return jobs
+    jobs = [job for job in jobs if job.name == job_name]
+    if not jobs:
+        raise ValueError(f"no job named {job_name!r}")
+    return jobs
+
+def _job_snapshots(job, snapshot=None, all_snapshots=False):
+    snapshots = [path for _, path in list_snapshots(job.backup_dir, f"{job.prefix}_")]
+    if snapshot is not None:
+        snapshots = [path for path in snapshots if os.path.basename(path) == snapshot]
+        if not snapshots:
+            raise ValueError(f"{job.name}: no snapshot named {snapshot!r}")
+    elif not all_snapshots:
+        snapshots = snapshots[-1:]
+    return snapshots
+
+def verify_backups(job_name=None, snapshot=None, all_snapshots=False, workers=COPY_WORKERS):
+    """Проверить снимки по контрольным суммам. Возвращает код выхода."""
+    try:
+        jobs = _select_jobs(job_name)
+        failed = 0
+        for job in jobs:
+            # Одна inode или чанк общие для многих снимков - читаются один раз
+            seen = {}
+            for path in _job_snapshots(job, snapshot, all_snapshots):
+                report = verify_snapshot(path, workers, seen)
+                print(f"{job.name}: {report}")
+                for rel in report.missing[:20]:
+                    print(f"  missing: {rel}")
+                for rel in report.corrupt[:20]:
+                    print(f"  corrupt: {rel}")
+                if not report.ok and report.skipped is None:
+                    failed += 1
+                    logging.error(f"Verification failed for {path}: {len(report.missing)} missing, "
+                                  f"{len(report.corrupt)} corrupt")
+    except (OSError, ValueError) as e:
+        print(f"Error verifying backups: {e}")
+        return 1
+    return 1 if failed else 0
+
+def restore_backup(target, job_name=None, snapshot=None, paths=None, workers=COPY_WORKERS):
+    """Восстановить снимок (по умолчанию последний) в новый каталог target."""
+    try:
+        jobs = _select_jobs(job_name)
+        if len(jobs) > 1:
+            raise ValueError("several jobs are configured, choose one with --job")
+        snapshots = _job_snapshots(jobs[0], snapshot)
+        if not snapshots:
+            raise ValueError(f"{jobs[0].name}: no snapshots to restore")
+        result = restore_snapshot(snapshots[0], target, paths, workers)
+    except (OSError, ValueError) as e:
+        print(f"Error restoring backup: {e}")
+        return 1
+    print(f"Restored {os.path.basename(snapshots[0])} to {target}: {result}")
+    return 0
 
 def show_logs():
     """Показать логи."""
@@ -216,8 +535,16 @@ def show_logs():
 def main():
     """Основная функция."""
     parser = argparse.ArgumentParser(description='Backup Daemon Service')
-    parser.add_argument('command', choices=['start', 'stop', 'status', 'config', 'logs', 'run'],
-                       help='start: start daemon, stop: stop daemon, status: check status, config: create config, logs: show logs, run: run in foreground')
+    parser.add_argument('command', choices=['start', 'stop', 'status', 'config', 'logs', 'run', 'verify', 'restore'],
+                       help='start: start daemon, stop: stop daemon, status: check status, config: create config, logs: show logs, run: run in foreground, '
+                            'verify: check backups against their checksums, restore: restore a backup into a new directory')
+    parser.add_argument('--job', help='job name (verify, restore)')
+    parser.add_argument('--snapshot', help='snapshot name, default: the latest (verify, restore)')
+    parser.add_argument('--all', action='store_true', help='verify all snapshots, not only the latest')
+    parser.add_argument('--path', action='append', dest='paths', metavar='PATH',
+                        help='restore only this path inside the snapshot (repeatable)')
+    parser.add_argument('--to', dest='target', help='restore target directory, must not exist')
+    parser.add_argument('--workers', type=int, default=COPY_WORKERS, help='parallel hash/copy workers')
     
     args = parser.parse_args()
     
@@ -251,6 +578,16 @@ def main():
             print("Configuration file not found. Run 'backup-daemon config' first.")
             return
         run_backup_daemon(CONFIG_FILE)
+        
+    elif args.command in ('verify', 'restore'):
+        if not os.path.exists(CONFIG_FILE):
+            print("Configuration file not found. Run 'backup-daemon config' first.")
+            return
+        if args.command == 'verify':
+            sys.exit(verify_backups(args.job, args.snapshot, args.all, args.workers))
+        if not args.target:
+            parser.error("restore requires --to DIR")
+        sys.exit(restore_backup(args.target, args.job, args.snapshot, args.paths, args.workers))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
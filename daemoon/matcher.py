@@ -0,0 +1,109 @@
+"""Исключения в стиле .gitignore, собранные в одно регулярное выражение.
+
+Правила exclude_patterns:
+
+  *.log          - по имени на любой глубине ('*' и '?' не переходят через '/');
+  .cache/        - только каталоги;
+  /build         - от корня source_dir (есть '/' в начале или середине);
+  docs/**/*.tmp  - '**' - любое число каталогов;
+  !keep.log      - отмена исключения; действует последнее подходящее правило.
+
+Подряд идущие правила одного знака объединяются в один regex, поэтому без
+'!' проверка пути - один вызов match(). Каталог проверяется как "путь/",
+правила с '/' на конце совпадают только с такой строкой. Исключённый
+каталог не обходится вовсе, и, как в git, '!' не возвращает файлы из него.
+"""
+import re
+
+
+def _glob(segment):
+    """Перевести один компонент пути с '*', '?', '[...]' в regex."""
+    out = []
+    i = 0
+    n = len(segment)
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '\\' and i < n:
+            out.append(re.escape(segment[i]))
+            i += 1
+        elif c == '[':
+            k = i + 1 if i < n and segment[i] in '!^' else i
+            # ']' сразу после '[' или '[!' - обычный символ класса
+            j = segment.find(']', k + 1 if k < n and segment[k] == ']' else k)
+            if j < 0:
+                out.append(r'\[')
+                continue
+            body = segment[i:j].replace('\\', '\\\\')
+            if body[:1] in ('!', '^'):
+                body = '^' + body[1:]
+            out.append(f'[{body}]')
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+
+def translate(pattern):
+    """(regex, отрицание) для одного правила или None для пустой строки и комментария."""
+    pattern = pattern.rstrip(' ')
+    if not pattern or pattern.startswith('#'):
+        return None
+    negated = pattern.startswith('!')
+    if negated:
+        pattern = pattern[1:]
+    elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith('/')
+    # '/' на конце не делает правило привязанным к корню, а '/' в начале - делает
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    if not pattern:
+        return None
+    segments = pattern.split('/')
+    parts = []
+    for idx, segment in enumerate(segments):
+        last = idx == len(segments) - 1
+        if segment == '**':
+            # 'a/**' - всё внутри a, но не сам a; '**/' и '/**/' - ноль и больше каталогов
+            parts.append('.+' if last else '(?:.*/)?')
+        else:
+            parts.append(_glob(segment) + ('' if last else '/'))
+    prefix = '' if anchored else '(?:.*/)?'
+    suffix = '/' if dir_only else '/?'
+    return f"{prefix}{''.join(parts)}{suffix}", negated
+
+
+class PathMatcher:
+    """Проверка относительных путей по списку правил; excluded(rel, is_dir)."""
+
+    def __init__(self, patterns=()):
+        self.patterns = list(patterns)
+        groups = []         # [(отрицание, [regex, ...])] в порядке правил
+        for pattern in self.patterns:
+            rule = translate(pattern)
+            if rule is None:
+                continue
+            regex, negated = rule
+            if groups and groups[-1][0] == negated:
+                groups[-1][1].append(regex)
+            else:
+                groups.append((negated, [regex]))
+        # Проверяются с конца: решает последняя подходящая группа
+        self.groups = [(negated, re.compile('(?:' + '|'.join(regexes) + r')\Z', re.DOTALL).match)
+                       for negated, regexes in reversed(groups)]
+
+    def __bool__(self):
+        return bool(self.groups)
+
+    def excluded(self, rel, is_dir=False):
+        path = rel + '/' if is_dir else rel
+        for negated, match in self.groups:
+            if match(path):
+                return not negated
+        return False
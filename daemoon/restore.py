@@ -0,0 +1,83 @@
+"""Восстановление снимка целиком или выбранных путей в новый каталог.
+
+Снимок с жёсткими ссылками копируется тем же snapshot_tree, что и при
+резервном копировании (без предыдущего снимка - полная копия), через пул
+CopyEngine. Снимок-манифест собирается из чанков пулом потоков, архив
+распаковывается одним потоком - tar читается только подряд.
+Каталог назначения не должен существовать: восстановление никогда не
+перезаписывает живые данные.
+"""
+import os
+import tarfile
+
+from changeindex import scan_tree
+from snapshot import snapshot_tree
+from chunkstore import ChunkStore, is_chunked, restore_tree
+from copyengine import CopyEngine, COPY_WORKERS
+from archive import ARCHIVE_NAME
+from verify import open_archive
+
+
+def path_selector(paths):
+    """Предикат rel -> bool для путей paths внутри снимка (None - всё)."""
+    if not paths:
+        return None
+    roots = tuple(os.path.normpath(p).strip(os.sep) for p in paths)
+    if any(root in ('', os.curdir) for root in roots) or any(r.startswith(os.pardir) for r in roots):
+        raise ValueError("restore paths must be relative paths inside the snapshot")
+    prefixes = tuple(root + os.sep for root in roots)
+    return lambda rel: rel in roots or rel.startswith(prefixes)
+
+
+def _with_parents(listing, selected):
+    """Выбранные пути и каталоги над ними - без них не создать дерево."""
+    result = {}
+    for rel in selected:
+        result[rel] = listing[rel]
+        parent = os.path.dirname(rel)
+        while parent and parent not in result:
+            result[parent] = listing[parent]
+            parent = os.path.dirname(parent)
+    return result
+
+
+def restore_snapshot(snapshot_dir, dest_dir, paths=None, workers=COPY_WORKERS):
+    """Восстановить снимок в dest_dir. Возвращает статистику режима снимка."""
+    if os.path.lexists(dest_dir):
+        raise FileExistsError(f"restore target already exists: {dest_dir}")
+    select = path_selector(paths)
+    if is_chunked(snapshot_dir):
+        store = ChunkStore(os.path.dirname(snapshot_dir.rstrip(os.sep)))
+        try:
+            return f"{restore_tree(snapshot_dir, store, dest_dir, select, workers)} files restored from chunks"
+        finally:
+            store.close()
+    if any(name.startswith(ARCHIVE_NAME) for name in os.listdir(snapshot_dir)):
+        return _restore_archive(snapshot_dir, dest_dir, select)
+    listing = scan_tree(snapshot_dir, workers=workers)
+    if select is not None:
+        listing = _with_parents(listing, [rel for rel in listing if select(rel)])
+    with CopyEngine(workers) as engine:
+        snapshot_tree(snapshot_dir, dest_dir, listing=listing, engine=engine)
+    return engine.stats
+
+
+def _restore_archive(snapshot_dir, dest_dir, select):
+    os.mkdir(dest_dir)
+    count = 0
+    dirs = []
+    extract_filter = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+    with open_archive(snapshot_dir) as tar:
+        for member in tar:
+            if select is None or select(member.name):
+                # Права и время каталогов - после содержимого, как в extractall
+                tar.extract(member, dest_dir, set_attrs=not member.isdir(), **extract_filter)
+                if member.isdir():
+                    dirs.append(member)
+                count += 1
+            tar.members.clear()
+    for member in reversed(dirs):
+        path = os.path.join(dest_dir, member.name)
+        os.chmod(path, member.mode & 0o777)
+        os.utime(path, (member.mtime, member.mtime))
+    return f"{count} archive members extracted"
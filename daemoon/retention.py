@@ -0,0 +1,211 @@
+"""Ротация снимков по схеме дед-отец-сын и их фоновое удаление.
+
+Retention оставляет last последних снимков и, сверх того, самый свежий
+снимок в каждом из hourly последних часов, daily дней, weekly недель и
+monthly месяцев (считаются только периоды, в которых снимки есть).
+Самый новый снимок не удаляется никогда - от него строится следующий.
+
+Pruner удаляет истёкшие снимки в отдельном потоке с nice 19 и классом
+ввода-вывода idle: снимок сразу переименовывается в .<имя>.deleting (из
+ротации и каталога он исчезает мгновенно), а rmtree большого дерева идёт
+в фоне и не задерживает следующую копию. stop() дожидается очереди.
+Недоудалённое после аварийной остановки дочищается при следующем запуске:
+ссылки на чанки снимаются один раз (ChunkStore.release), затем хранилище
+чанков пересчитывается по манифестам (rebuild) - так освобождаются и чанки
+прерванных копий.
+"""
+import os
+import time
+import queue
+import ctypes
+import shutil
+import logging
+import platform
+import threading
+
+from chunkstore import ChunkStore, remove_snapshot, is_chunked, store_lock, CHUNKS_DIR
+from verify import forget_checksums
+
+DELETING_SUFFIX = ".deleting"
+PARTIAL_SUFFIX = ".partial"
+
+# (поле политики, формат периода для time.strftime)
+RULES = (('hourly', '%Y%m%d%H'), ('daily', '%Y%m%d'), ('weekly', '%G%V'), ('monthly', '%Y%m'))
+
+# ioprio_set(2): номера вызова и класс IOPRIO_CLASS_IDLE
+_IOPRIO_SET = {'x86_64': 251, 'aarch64': 30}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_IDLE = 3 << 13
+
+
+class Retention:
+    def __init__(self, last=30, hourly=0, daily=0, weekly=0, monthly=0):
+        for name, value in (('last', last), ('hourly', hourly), ('daily', daily),
+                            ('weekly', weekly), ('monthly', monthly)):
+            if not isinstance(value, int) or value < 0:
+                raise ValueError(f"retention {name} must be a non-negative integer")
+        self.last = last
+        self.hourly = hourly
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+
+    @classmethod
+    def from_config(cls, config):
+        """Из секции "retention"; без неё - прежняя ротация по max_backups."""
+        policy = config.get('retention')
+        if policy is None:
+            return cls(last=config.get('max_backups', 30))
+        unknown = set(policy) - {'last', 'hourly', 'daily', 'weekly', 'monthly'}
+        if unknown:
+            raise ValueError(f"unknown retention keys: {', '.join(sorted(unknown))}")
+        return cls(**policy)
+
+    def __str__(self):
+        return ", ".join(f"{name} {getattr(self, name)}"
+                         for name in ('last', 'hourly', 'daily', 'weekly', 'monthly') if getattr(self, name))
+
+    def keep(self, snapshots):
+        """Имена снимков, которые остаются; snapshots - [(имя, время создания)]."""
+        newest = sorted(snapshots, key=lambda s: (s[1], s[0]), reverse=True)
+        kept = {name for name, _ in newest[:max(self.last, 1)]}
+        for field, fmt in RULES:
+            limit = getattr(self, field)
+            periods = set()
+            for name, created in newest:
+                if len(periods) >= limit:
+                    break
+                period = time.strftime(fmt, time.localtime(created))
+                if period not in periods:
+                    periods.add(period)
+                    kept.add(name)
+        return kept
+
+    def expired(self, snapshots):
+        """Имена снимков на удаление, от старых к новым."""
+        kept = self.keep(snapshots)
+        return [name for name, _ in sorted(snapshots, key=lambda s: (s[1], s[0])) if name not in kept]
+
+
+def _lower_priority():
+    """nice 19 и ioprio idle для текущего потока (в Linux оба задаются на поток)."""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except (AttributeError, OSError):
+        pass
+    number = _IOPRIO_SET.get(platform.machine())
+    if number is not None:
+        try:
+            ctypes.CDLL(None, use_errno=True).syscall(number, _IOPRIO_WHO_PROCESS, tid, _IOPRIO_IDLE)
+        except (OSError, AttributeError):
+            pass
+
+
+class Pruner:
+    """Фоновый поток удаления снимков backup_dir."""
+
+    def __init__(self, backup_dir, catalog=None):
+        self.backup_dir = backup_dir
+        self.catalog = catalog
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        """Запустить поток. Вызывать, пока не идёт ни одна копия в backup_dir."""
+        # Недописанные снимки прерванных копий: ссылки на чанки у них не сняты
+        # или не добавлены, поэтому только удалить каталог, чанки освободит rebuild
+        for entry in sorted(os.listdir(self.backup_dir)):
+            if entry.startswith(".") and entry.endswith(PARTIAL_SUFFIX):
+                logging.info(f"Removing interrupted backup: {entry}")
+                shutil.rmtree(os.path.join(self.backup_dir, entry), ignore_errors=True)
+        self.thread = threading.Thread(target=self._run, name="pruner", daemon=True)
+        self.thread.start()
+        # Остатки удаления, прерванного остановкой демона; release() повторно
+        # ссылки не снимает, если они уже сняты
+        for entry in sorted(os.listdir(self.backup_dir)):
+            if entry.startswith(".") and entry.endswith(DELETING_SUFFIX):
+                self.queue.put((entry[1:-len(DELETING_SUFFIX)], os.path.join(self.backup_dir, entry)))
+        if os.path.isdir(os.path.join(self.backup_dir, CHUNKS_DIR)):
+            self.queue.put('gc')
+
+    def stop(self):
+        """Дождаться удаления всего, что уже в очереди, и остановить поток."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def prune(self, names):
+        """Убрать снимки из ротации сейчас, удалить с диска в фоне."""
+        for name in names:
+            path = os.path.join(self.backup_dir, name)
+            trash = os.path.join(self.backup_dir, f".{name}{DELETING_SUFFIX}")
+            try:
+                os.rename(path, trash)
+            except FileNotFoundError:
+                pass
+            else:
+                logging.info(f"Expired backup: {path}")
+                self.queue.put((name, trash))
+            forget_checksums(self.backup_dir, name)
+            if self.catalog is not None:
+                self.catalog.forget(name)
+
+    def _run(self):
+        _lower_priority()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if item == 'gc':
+                self._collect_garbage()
+            else:
+                self._remove(*item)
+
+    def _snapshots(self):
+        """[(имя, каталог)] всех снимков на диске, включая ждущие удаления."""
+        snapshots = []
+        for entry in os.listdir(self.backup_dir):
+            path = os.path.join(self.backup_dir, entry)
+            if not os.path.isdir(path):
+                continue
+            if entry.startswith(".") and entry.endswith(DELETING_SUFFIX):
+                snapshots.append((entry[1:-len(DELETING_SUFFIX)], path))
+            elif not entry.startswith(".") or entry.endswith(PARTIAL_SUFFIX):
+                # .partial здесь - копия, которая уже добавила ссылки и вот-вот станет снимком
+                snapshots.append((entry, path))
+        return snapshots
+
+    def _collect_garbage(self):
+        started = time.monotonic()
+        try:
+            # Под блокировкой хранилища не пишется ни один снимок-манифест
+            with store_lock(self.backup_dir):
+                store = ChunkStore(self.backup_dir)
+                try:
+                    removed = store.rebuild(self._snapshots())
+                finally:
+                    store.close()
+        except Exception as e:
+            logging.error(f"Error collecting unreferenced chunks in {self.backup_dir}: {e}")
+            return
+        if removed:
+            logging.info(f"Removed {removed} unreferenced chunks in {time.monotonic() - started:.1f} s")
+
+    def _remove(self, name, path):
+        started = time.monotonic()
+        if not os.path.lexists(path):
+            # Уже удалён другим заданием с тем же backup_dir
+            return
+        try:
+            if is_chunked(path):
+                # Не снимать ссылки на чанки, пока идёт снимок, который может их переиспользовать
+                with store_lock(self.backup_dir):
+                    remove_snapshot(path, name=name)
+            else:
+                remove_snapshot(path)
+        except Exception as e:
+            logging.error(f"Error removing old backup {path}: {e}")
+            return
+        logging.info(f"Removed old backup: {path} in {time.monotonic() - started:.1f} s")
@@ -0,0 +1,208 @@
+"""Планировщик заданий демона: интервалы и cron, приоритеты, пул потоков.
+
+Главный цикл не опрашивает часы, а спит на Condition ровно до ближайшего
+срока; раньше его будят только stop() и завершение задания. Готовые
+задания выполняются пулом из workers потоков; если потоков не хватает,
+первыми идут задания с большим priority, при равном - дольше ждущие.
+Задание не запускается второй раз, пока идёт его предыдущий запуск:
+следующий срок считается после завершения (пропущенные за это время
+сроки сливаются в один запуск). Неудачный запуск повторяется с
+удваивающейся паузой от RETRY_MIN до RETRY_MAX, но не позже обычного срока.
+"""
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+RETRY_MIN = 60
+RETRY_MAX = 3600
+CRON_HORIZON = 8 * 366          # дней поиска следующего срока ("30 2 * *" не бывает никогда)
+
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+}
+
+
+def _parse_field(field, lo, hi):
+    """Множество значений поля cron: '*', 'a', 'a-b', списки через ',' и шаг '/n'."""
+    values = set()
+    for part in field.split(','):
+        rng, slash, step = part.partition('/')
+        step = int(step) if slash else 1
+        if rng == '*':
+            start, end = lo, hi
+        elif '-' in rng:
+            start, end = (int(v) for v in rng.split('-', 1))
+        else:
+            start = int(rng)
+            end = hi if slash else start
+        if step < 1 or not lo <= start <= end <= hi:
+            raise ValueError(f"cron field {field!r} is out of range {lo}-{hi}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """Пять полей cron: минута, час, день месяца, месяц, день недели (0 и 7 - воскресенье)."""
+
+    def __init__(self, expr):
+        self.expr = expr
+        fields = CRON_ALIASES.get(expr.strip(), expr).split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression must have 5 fields: {expr!r}")
+        try:
+            self.minutes = _parse_field(fields[0], 0, 59)
+            self.hours = _parse_field(fields[1], 0, 23)
+            self.days = _parse_field(fields[2], 1, 31)
+            self.months = _parse_field(fields[3], 1, 12)
+            self.weekdays = {d % 7 for d in _parse_field(fields[4], 0, 7)}
+        except ValueError as e:
+            raise ValueError(f"invalid cron expression {expr!r}: {e}") from None
+        # Как в cron: если ограничены и день месяца, и день недели, подходит любой из них
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+        self.next_after(time.time())
+
+    def __str__(self):
+        return f"cron '{self.expr}'"
+
+    def _day_matches(self, dt):
+        in_days = dt.day in self.days
+        in_weekdays = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, t):
+        dt = datetime.fromtimestamp(t).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=CRON_HORIZON)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError(f"cron expression {self.expr!r} never fires")
+
+
+class IntervalSchedule:
+    def __init__(self, seconds):
+        if not isinstance(seconds, (int, float)) or seconds <= 0:
+            raise ValueError("interval_seconds must be a positive number")
+        self.seconds = seconds
+
+    def __str__(self):
+        return f"every {self.seconds} s"
+
+    def next_after(self, t):
+        return t + self.seconds
+
+
+class _Job:
+    __slots__ = ('name', 'run', 'schedule', 'priority', 'next_run', 'running', 'failures')
+
+    def __init__(self, name, run, schedule, priority, next_run):
+        self.name = name
+        self.run = run
+        self.schedule = schedule
+        self.priority = priority
+        self.next_run = next_run
+        self.running = False
+        self.failures = 0
+
+
+class Scheduler:
+    """Запуск заданий по расписанию. run() блокирует до stop()."""
+
+    def __init__(self, workers=1):
+        if workers < 1:
+            raise ValueError("scheduler workers must be >= 1")
+        self.workers = workers
+        self.jobs = []
+        self.running = 0
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.pool = None
+
+    def add(self, name, run, schedule, priority=0, run_now=None):
+        """run() -> False означает неудачу. run_now - первый запуск сразу
+        (по умолчанию для интервальных заданий, как в прежнем цикле демона)."""
+        if run_now is None:
+            run_now = isinstance(schedule, IntervalSchedule)
+        now = time.time()
+        with self.cond:
+            self.jobs.append(_Job(name, run, schedule, priority, now if run_now else schedule.next_after(now)))
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+    def run(self):
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        try:
+            with self.cond:
+                while not self.stopping:
+                    now = time.time()
+                    self._dispatch(now)
+                    # stop() зовётся из обработчика сигнала в этом же потоке: его notify
+                    # мог прийти до ожидания, поэтому флаг проверяется перед сном
+                    self.cond.wait_for(lambda: self.stopping, self._timeout(now))
+        finally:
+            self.pool.shutdown(wait=False)
+
+    def wait(self):
+        """Дождаться заданий, которые уже выполняются."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    def _dispatch(self, now):
+        while self.running < self.workers:
+            due = [job for job in self.jobs if not job.running and job.next_run <= now]
+            if not due:
+                return
+            job = max(due, key=lambda j: (j.priority, -j.next_run))
+            job.running = True
+            self.running += 1
+            self.pool.submit(self._execute, job)
+
+    def _timeout(self, now):
+        if self.running >= self.workers:
+            return None         # разбудит завершение задания
+        waiting = [job.next_run for job in self.jobs if not job.running]
+        return max(0.0, min(waiting) - now) if waiting else None
+
+    def _execute(self, job):
+        threading.current_thread().name = f"job-{job.name}"
+        started = time.time()
+        try:
+            ok = job.run() is not False
+        except Exception as e:
+            logging.error(f"Job {job.name} failed: {e}")
+            ok = False
+        with self.cond:
+            job.running = False
+            self.running -= 1
+            now = time.time()
+            regular = max(job.schedule.next_after(started), now)
+            if ok:
+                job.failures = 0
+                job.next_run = regular
+            else:
+                job.failures += 1
+                delay = min(RETRY_MIN * 2 ** (job.failures - 1), RETRY_MAX)
+                job.next_run = min(now + delay, job.schedule.next_after(now))
+                logging.info(f"Job {job.name} will be retried in {job.next_run - now:.0f} s")
+            self.cond.notify()
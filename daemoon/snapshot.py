@@ -0,0 +1,149 @@
+"""Инкрементальные снимки в стиле rsync --link-dest.
+
+Каждый снимок - полное дерево каталогов, но неизменившиеся файлы в нём
+не копируются, а являются жёсткими ссылками на тот же файл предыдущего
+снимка. Копируются только новые и изменённые файлы, поэтому время и место
+на диске растут с объёмом изменений, а не с размером дерева. Удалять любой
+снимок по-прежнему можно простым rmtree - остальные ссылки остаются целы.
+"""
+import os
+import stat
+import errno
+import shutil
+
+from changeindex import scan_tree, file_digest, KIND_DIR, KIND_LINK
+
+BACKUP_PREFIX = "backup_"
+
+COMPARE_MODES = ('mtime', 'hash')
+
+
+def list_snapshots(backup_dir, prefix=BACKUP_PREFIX):
+    """Готовые снимки [(имя, путь)], от старых к новым (метка времени в имени сортируется)."""
+    try:
+        names = os.listdir(backup_dir)
+    except FileNotFoundError:
+        return []
+    snapshots = []
+    for name in sorted(names):
+        path = os.path.join(backup_dir, name)
+        if name.startswith(prefix) and os.path.isdir(path) and not os.path.islink(path):
+            snapshots.append((name, path))
+    return snapshots
+
+
+def latest_snapshot(backup_dir, prefix=BACKUP_PREFIX):
+    snapshots = list_snapshots(backup_dir, prefix)
+    return snapshots[-1][1] if snapshots else None
+
+
+def _unchanged(src_path, entry, prev_path, compare):
+    """Можно ли взять файл из предыдущего снимка вместо копирования."""
+    try:
+        prev_st = os.lstat(prev_path)
+    except OSError:
+        return False
+    # Жёсткая ссылка делит с предыдущим снимком и метаданные,
+    # поэтому права и владелец тоже должны совпадать
+    if (not stat.S_ISREG(prev_st.st_mode) or prev_st.st_size != entry.size
+            or prev_st.st_mode != entry.mode
+            or prev_st.st_uid != entry.uid or prev_st.st_gid != entry.gid):
+        return False
+    if compare == 'hash':
+        return file_digest(src_path) == file_digest(prev_path)
+    return prev_st.st_mtime_ns == entry.mtime_ns
+
+
+def _copy_file(src_path, dst_path, st):
+    shutil.copy2(src_path, dst_path)
+    try:
+        os.chown(dst_path, st.st_uid, st.st_gid)
+    except OSError:
+        pass        # без прав root владельца не сменить - остаётся текущий пользователь
+
+
+class SnapshotStats:
+    __slots__ = ('files', 'linked', 'copied', 'bytes_copied', 'bytes_linked', 'dirs', 'skipped')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        return (f"{self.files} files: {self.copied} copied ({self.bytes_copied} bytes), "
+                f"{self.linked} linked ({self.bytes_linked} bytes), {self.skipped} skipped")
+
+
+def snapshot_tree(source_dir, dest_dir, prev_dir=None, compare='mtime', listing=None, changed=None,
+                  engine=None, walk_workers=1):
+    """Снять снимок source_dir в dest_dir, связывая неизменившиеся файлы с prev_dir.
+
+    compare='mtime' - файл считается прежним при совпадении размера и mtime
+    (как у rsync по умолчанию), 'hash' - при совпадении содержимого.
+    listing - готовый список {путь: Entry} вместо обхода дерева; если к нему
+    передан и changed из ChangeIndex, файлы не сравниваются: всё, чего нет
+    в changed, берётся из prev_dir. engine - CopyEngine для параллельного
+    копирования, без него файлы копируются по одному через shutil.
+    dest_dir не должен существовать. Без prev_dir получается полная копия.
+    Возвращает SnapshotStats.
+    """
+    if compare not in COMPARE_MODES:
+        raise ValueError(f"unknown compare mode: {compare}")
+    if listing is None:
+        listing = scan_tree(source_dir, workers=walk_workers)
+        changed = None
+    stats = SnapshotStats()
+    os.mkdir(dest_dir)
+    stats.dirs += 1
+    dirs = [("", dest_dir)]
+    # Родитель в сортировке всегда раньше своих потомков
+    for rel in sorted(listing):
+        entry = listing[rel]
+        src_path = os.path.join(source_dir, rel)
+        dst_path = os.path.join(dest_dir, rel)
+        try:
+            if entry.kind == KIND_DIR:
+                os.mkdir(dst_path)
+                dirs.append((rel, dst_path))
+                stats.dirs += 1
+            elif entry.kind == KIND_LINK:
+                os.symlink(os.readlink(src_path), dst_path)
+                stats.files += 1
+                stats.copied += 1
+            else:
+                stats.files += 1
+                if prev_dir:
+                    prev_path = os.path.join(prev_dir, rel)
+                    if (rel not in changed if changed is not None
+                            else _unchanged(src_path, entry, prev_path, compare)):
+                        try:
+                            os.link(prev_path, dst_path)
+                            stats.linked += 1
+                            stats.bytes_linked += entry.size
+                            continue
+                        except OSError as e:
+                            # Нет в прежнем снимке, другая ФС или предел числа ссылок на inode
+                            if e.errno not in (errno.ENOENT, errno.EXDEV, errno.EMLINK, errno.EPERM):
+                                raise
+                st = os.lstat(src_path)
+                if engine is not None:
+                    engine.submit(src_path, dst_path, st)
+                else:
+                    _copy_file(src_path, dst_path, st)
+                stats.copied += 1
+                stats.bytes_copied += st.st_size
+        except FileNotFoundError:
+            # Удалён после обхода - попадёт в изменения следующего запуска
+            stats.skipped += 1
+    if engine is not None:
+        engine.wait()
+    # Время каталогов ставится последним: создание файлов внутри его меняет
+    for rel, dst_path in reversed(dirs):
+        try:
+            shutil.copystat(os.path.join(source_dir, rel), dst_path)
+        except FileNotFoundError:
+            pass
+    return stats
@@ -0,0 +1,66 @@
+import os
+import select
+
+import pytest
+
+from changeindex import ChangeIndex, InotifyWatcher, IN_Q_OVERFLOW, _event
+
+
+def _write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def test_refresh_reports_changes_since_commit(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    _write(source / "keep.txt", "same")
+    _write(source / "edit.txt", "old")
+    _write(source / "gone.txt", "bye")
+    index = ChangeIndex(str(source), str(tmp_path / "index.json.gz"))
+    assert index.refresh() == {"keep.txt", "edit.txt", "gone.txt"}
+    index.commit("backup_1")
+
+    _write(source / "edit.txt", "new content")
+    os.remove(source / "gone.txt")
+    os.mkdir(source / "dir")
+    _write(source / "dir" / "new.txt", "x")
+    assert index.refresh() == {"edit.txt", "gone.txt", "dir", os.path.join("dir", "new.txt")}
+    index.commit("backup_2")
+
+    reloaded = ChangeIndex(str(source), str(tmp_path / "index.json.gz"))
+    assert reloaded.snapshot == "backup_2"
+    assert reloaded.refresh() == set()
+
+
+def _drain(fd):
+    data = b""
+    while select.select([fd], [], [], 0.2)[0]:
+        try:
+            data += os.read(fd, 256 * 1024)
+        except BlockingIOError:
+            break
+    return data
+
+
+def test_overflow_rewatches_directories_created_meanwhile(tmp_path):
+    watcher = InotifyWatcher(str(tmp_path))
+    if not watcher.start():
+        pytest.skip("inotify unavailable")
+    # События разбираются вручную: поток чтения не нужен
+    watcher.stop_event.set()
+    watcher.thread.join()
+    try:
+        os.mkdir(tmp_path / "new")
+        _drain(watcher.fd)          # событие о новом каталоге потеряно при переполнении
+        watcher._handle(_event.pack(-1, IN_Q_OVERFLOW, 0, 0))
+        assert watcher.take() == (set(), True)
+
+        _write(tmp_path / "new" / "file", "data")
+        watcher._handle(_drain(watcher.fd))
+        dirty, overflow = watcher.take()
+        assert os.path.join("new", "file") in dirty
+        assert watcher.alive
+    finally:
+        watcher.thread = None
+        watcher.stop()
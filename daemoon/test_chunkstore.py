@@ -0,0 +1,62 @@
+import os
+
+from chunkstore import ChunkStore, chunk_tree, restore_tree, remove_snapshot
+from verify import verify_snapshot
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _store(backup_dir):
+    return ChunkStore(backup_dir, 1024, 4096, 16384)
+
+
+def test_release_is_idempotent_and_rebuild_collects_orphans(tmp_path):
+    source = str(tmp_path / "source")
+    backup_dir = str(tmp_path / "backups")
+    shared = os.urandom(256 << 10)
+    _write(os.path.join(source, "shared.bin"), shared)
+    os.makedirs(backup_dir)
+    first = os.path.join(backup_dir, "backup_1")
+    second = os.path.join(backup_dir, "backup_2")
+
+    store = _store(backup_dir)
+    try:
+        chunk_tree(source, first, store)
+        _write(os.path.join(source, "extra.bin"), os.urandom(64 << 10))
+        chunk_tree(source, second, store, prev_dir=first)
+        references = store.stats()['references']
+
+        # Удаление прервано после release: повторный вызов не снимает ссылки второй раз
+        store.release(first)
+        after_release = store.stats()
+        assert after_release['references'] < references
+        assert store.release(first) == (0, 0)
+        assert store.stats() == after_release
+
+        orphan, written = store.put(os.urandom(2048))
+        assert written
+        assert store.rebuild() == 1
+        assert not os.path.exists(store.path(orphan))
+        assert store.stats() == after_release
+    finally:
+        store.close()
+
+    remove_snapshot(first)
+    assert not os.path.exists(first)
+    assert verify_snapshot(second).ok
+    store = _store(backup_dir)
+    try:
+        dest = str(tmp_path / "restore")
+        assert restore_tree(second, store, dest) == 2
+    finally:
+        store.close()
+    assert _read(os.path.join(dest, "shared.bin")) == shared
@@ -0,0 +1,34 @@
+from matcher import translate, PathMatcher
+
+
+def test_translate_keeps_leading_slash_anchor_on_dir_only_pattern():
+    assert translate('/build/') == ('build/', False)
+    assert translate('build/') == ('(?:.*/)?build/', False)
+    assert translate('# comment') is None
+    assert translate('!keep.log') == ('(?:.*/)?keep\\.log/?', True)
+
+
+def test_anchored_dir_only_pattern_matches_only_at_root():
+    matcher = PathMatcher(['/x/'])
+    assert matcher.excluded('x', True)
+    assert not matcher.excluded('a/x', True)
+    assert not matcher.excluded('x', False)
+
+
+def test_name_pattern_matches_at_any_depth():
+    matcher = PathMatcher(['*.log', '.cache/'])
+    assert matcher.excluded('app.log')
+    assert matcher.excluded('a/b/app.log')
+    assert not matcher.excluded('a/log')
+    assert matcher.excluded('a/.cache', True)
+    assert not matcher.excluded('a/.cache')
+
+
+def test_double_star_and_negation():
+    matcher = PathMatcher(['docs/**/*.tmp', '*.log', '!keep.log'])
+    assert matcher.excluded('docs/x.tmp')
+    assert matcher.excluded('docs/a/b/x.tmp')
+    assert not matcher.excluded('src/docs/x.tmp')
+    assert matcher.excluded('debug.log')
+    assert not matcher.excluded('sub/keep.log')
+    assert not PathMatcher([])
@@ -0,0 +1,89 @@
+import os
+import time
+
+import pytest
+
+from daemoon import backup_files, BACKUP_MODES
+from snapshot import list_snapshots
+from restore import restore_snapshot
+from verify import verify_snapshot
+
+MTIME = 1767225600          # целые секунды - их хранит любой режим, включая tar
+
+
+def _write(root, rel, data, mode=0o644):
+    path = os.path.join(root, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, mode)
+    os.utime(path, (MTIME, MTIME))
+
+
+def _tree(root):
+    """{путь: (тип, содержимое или цель, права, mtime)} без mtime каталогов."""
+    out = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            st = os.lstat(path)
+            if os.path.islink(path):
+                out[rel] = ('link', os.readlink(path))
+            elif os.path.isdir(path):
+                out[rel] = ('dir', st.st_mode & 0o7777)
+            else:
+                with open(path, 'rb') as f:
+                    out[rel] = ('file', f.read(), st.st_mode & 0o7777, int(st.st_mtime))
+    return out
+
+
+def _next_second():
+    # Имена снимков - с точностью до секунды
+    time.sleep(1 - time.time() % 1 + 0.01)
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = tmp_path / "source"
+    _write(root, "a.txt", b"alpha\n")
+    _write(root, "empty", b"")
+    _write(root, "bin/run.sh", b"#!/bin/sh\necho ok\n", 0o755)
+    _write(root, "data/big.bin", os.urandom(3 << 20))
+    _write(root, "data/old.txt", b"to be removed\n", 0o600)
+    os.symlink("a.txt", root / "link")
+    return root
+
+
+@pytest.mark.parametrize("mode", BACKUP_MODES)
+def test_restore_round_trip(tmp_path, source, mode):
+    backup_dir = str(tmp_path / "backups")
+    assert backup_files(str(source), backup_dir, mode=mode, copy_workers=2)
+    first = _tree(source)
+
+    _next_second()
+    _write(source, "a.txt", b"alpha, changed\n")
+    _write(source, "data/new.txt", b"new file\n")
+    os.remove(source / "data/old.txt")
+    assert backup_files(str(source), backup_dir, mode=mode, copy_workers=2)
+    second = _tree(source)
+
+    snapshots = list_snapshots(backup_dir)
+    assert len(snapshots) == 2
+    for (name, snapshot), expected in zip(snapshots, (first, second)):
+        assert verify_snapshot(snapshot).ok
+        dest = str(tmp_path / f"restore_{name}")
+        restore_snapshot(snapshot, dest, workers=2)
+        assert _tree(dest) == expected
+
+
+@pytest.mark.parametrize("mode", BACKUP_MODES)
+def test_restore_selected_paths(tmp_path, source, mode):
+    backup_dir = str(tmp_path / "backups")
+    assert backup_files(str(source), backup_dir, mode=mode, copy_workers=2)
+    _, snapshot = list_snapshots(backup_dir)[-1]
+    dest = str(tmp_path / "restore")
+    restore_snapshot(snapshot, dest, paths=["bin"])
+    assert _tree(dest) == {rel: value for rel, value in _tree(source).items() if rel.startswith("bin")}
+    with pytest.raises(FileExistsError):
+        restore_snapshot(snapshot, dest)
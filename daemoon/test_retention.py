@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from retention import Retention
+
+
+def _snapshots(start, step, count):
+    """[(имя, время)] через равные промежутки, имена как у демона."""
+    out = []
+    for i in range(count):
+        dt = start + step * i
+        out.append((f"backup_{dt:%Y%m%d%H%M%S}", dt.timestamp()))
+    return out
+
+
+def test_last_keeps_newest_and_never_drops_everything():
+    snapshots = _snapshots(datetime(2026, 3, 1, 12), timedelta(hours=1), 5)
+    names = [name for name, _ in snapshots]
+    assert Retention(last=2).keep(snapshots) == set(names[-2:])
+    assert Retention(last=0).keep(snapshots) == {names[-1]}
+    assert Retention(last=2).expired(snapshots) == names[:3]
+
+
+def test_daily_keeps_newest_snapshot_of_each_recent_day():
+    # Снимки в 0, 6, 12, 18 часов пять дней подряд
+    snapshots = _snapshots(datetime(2026, 3, 1), timedelta(hours=6), 20)
+    kept = Retention(last=1, daily=3).keep(snapshots)
+    assert kept == {"backup_20260305180000", "backup_20260304180000", "backup_20260303180000"}
+
+
+def test_policies_add_up():
+    snapshots = _snapshots(datetime(2026, 1, 1), timedelta(days=1), 70)
+    kept = Retention(last=2, monthly=3).keep(snapshots)
+    assert kept == {"backup_20260311000000", "backup_20260310000000",
+                    "backup_20260228000000", "backup_20260131000000"}
+
+
+def test_periods_without_snapshots_are_not_counted():
+    snapshots = [("backup_20260101000000", datetime(2026, 1, 1).timestamp()),
+                 ("backup_20260301000000", datetime(2026, 3, 1).timestamp())]
+    assert Retention(last=1, monthly=2).keep(snapshots) == {name for name, _ in snapshots}
+
+
+def test_from_config():
+    assert Retention.from_config({'max_backups': 7}).last == 7
+    policy = Retention.from_config({'retention': {'last': 3, 'weekly': 4}})
+    assert (policy.last, policy.weekly) == (3, 4)
+    with pytest.raises(ValueError):
+        Retention.from_config({'retention': {'yearly': 1}})
+    with pytest.raises(ValueError):
+        Retention(daily=-1)
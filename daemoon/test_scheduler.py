@@ -0,0 +1,57 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from scheduler import CronSchedule, IntervalSchedule, Scheduler
+
+
+def _next(expr, after):
+    return datetime.fromtimestamp(CronSchedule(expr).next_after(after.timestamp()))
+
+
+def test_cron_next_after_is_strictly_later():
+    assert _next("30 2 * * *", datetime(2026, 3, 10, 1, 0)) == datetime(2026, 3, 10, 2, 30)
+    assert _next("30 2 * * *", datetime(2026, 3, 10, 2, 30)) == datetime(2026, 3, 11, 2, 30)
+    assert _next("*/15 * * * *", datetime(2026, 3, 10, 10, 7, 59)) == datetime(2026, 3, 10, 10, 15)
+    assert _next("@daily", datetime(2026, 12, 31, 23, 59)) == datetime(2027, 1, 1)
+
+
+def test_cron_month_and_weekday_fields():
+    assert _next("0 0 1 * *", datetime(2026, 1, 31, 12)) == datetime(2026, 2, 1)
+    assert _next("0 6 * 4 *", datetime(2026, 3, 10)) == datetime(2026, 4, 1, 6)
+    # 2026-03-14 - суббота: следующий будний день - понедельник
+    assert _next("0 9 * * 1-5", datetime(2026, 3, 14)) == datetime(2026, 3, 16, 9)
+    # 7 - тоже воскресенье
+    assert _next("0 0 * * 7", datetime(2026, 2, 27)) == datetime(2026, 3, 1)
+
+
+def test_cron_day_of_month_or_weekday():
+    # Ограничены оба поля - подходит любой: 13-е число или пятница
+    cron = "0 0 13 * 5"
+    assert _next(cron, datetime(2026, 3, 1)) == datetime(2026, 3, 6)
+    assert _next(cron, datetime(2026, 3, 11)) == datetime(2026, 3, 13)
+    assert _next(cron, datetime(2026, 3, 13)) == datetime(2026, 3, 20)
+
+
+def test_cron_rejects_bad_expressions():
+    for expr in ("* * * *", "60 * * * *", "0 0 30 2 *", "*/0 * * * *"):
+        with pytest.raises(ValueError):
+            CronSchedule(expr)
+
+
+def test_stop_during_dispatch_is_not_lost():
+    scheduler = Scheduler()
+    scheduler.add("job", lambda: None, IntervalSchedule(2), run_now=False)
+    dispatch = scheduler._dispatch
+
+    def dispatch_and_stop(now):
+        # stop() из обработчика сигнала приходит, пока цикл не ждёт
+        dispatch(now)
+        scheduler.stop()
+
+    scheduler._dispatch = dispatch_and_stop
+    started = time.monotonic()
+    scheduler.run()
+    scheduler.wait()
+    assert time.monotonic() - started < 1
@@ -0,0 +1,38 @@
+"""Ограничение скорости ввода-вывода.
+
+Throttle - ведро токенов в виде "виртуального расписания": каждый consume(n)
+сдвигает момент, когда канал освободится, на n / rate секунд и спит, если
+этот момент ушёл вперёд больше чем на burst секунд. Один объект можно делить
+между потоками - суммарная скорость не превысит rate.
+"""
+import time
+import threading
+
+BURST = 0.25        # сколько секунд трафика можно отдать без ожидания
+
+
+class Throttle:
+    def __init__(self, rate, burst=BURST):
+        if rate <= 0:
+            raise ValueError("throttle rate must be positive")
+        self.rate = float(rate)
+        self.burst = burst
+        self.next_time = time.monotonic()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.next_time = max(now, self.next_time) + n / self.rate
+            delay = self.next_time - now - self.burst
+        if delay > 0:
+            self.waited += delay
+            time.sleep(delay)
+
+
+def make_throttle(mb_per_sec):
+    """Throttle по лимиту в МБ/с из конфигурации; 0 или None - без ограничения."""
+    if not mb_per_sec:
+        return None
+    return Throttle(mb_per_sec * 1024 * 1024)
@@ -0,0 +1,267 @@
+"""Контрольные суммы снимков и проверка их целостности.
+
+Для снимков с жёсткими ссылками (full, incremental) после записи снимка
+создаётся манифест backup_dir/.checksums/<снимок>.jsonl.gz: путь, размер,
+mtime_ns, inode и sha256 каждого файла. Неизменившийся файл снимка - та же
+inode, что в предыдущем снимке, поэтому его хеш берётся из прежнего
+манифеста по ключу (inode, размер, mtime_ns); читаются только новые копии.
+
+verify_snapshot() перечитывает содержимое и сравнивает с манифестом.
+Хеши считает пул потоков (hashlib отпускает GIL); общий для запуска seen
+позволяет прочитать каждую inode и каждый чанк один раз, сколько бы
+снимков на них ни ссылалось. Снимки-манифесты чанков проверяются по
+sha256 самих чанков (он же их имя), архивы - полным чтением: gzip, bz2,
+xz и zstd проверяют свои CRC при распаковке.
+"""
+import os
+import io
+import gzip
+import json
+import lzma
+import zlib
+import time
+import tarfile
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from changeindex import scan_tree, KIND_FILE
+from chunkstore import ChunkStore, is_chunked, read_manifest, MANIFEST_NAME
+from archive import ARCHIVE_NAME, zstandard
+from copyengine import COPY_WORKERS
+
+CHECKSUMS_DIR = ".checksums"
+HASH_CHUNK = 1024 * 1024
+
+# Ошибки распаковки повреждённого архива
+ARCHIVE_ERRORS = (OSError, EOFError, ValueError, tarfile.TarError, zlib.error, lzma.LZMAError) \
+    + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def checksum_path(backup_dir, name):
+    return os.path.join(backup_dir, CHECKSUMS_DIR, f"{name}.jsonl.gz")
+
+
+def forget_checksums(backup_dir, name):
+    try:
+        os.remove(checksum_path(backup_dir, name))
+    except FileNotFoundError:
+        pass
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def read_checksums(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class ChecksumStats:
+    __slots__ = ('files', 'hashed', 'reused', 'bytes_hashed', 'elapsed')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def __str__(self):
+        return (f"{self.files} files: {self.hashed} hashed ({self.bytes_hashed} bytes), "
+                f"{self.reused} reused in {self.elapsed:.2f} s")
+
+
+def record_checksums(snapshot_dir, out_path, prev_path=None, workers=COPY_WORKERS):
+    """Записать манифест контрольных сумм снимка; prev_path - манифест предыдущего."""
+    started = time.monotonic()
+    stats = ChecksumStats()
+    cache = {}
+    if prev_path is not None and os.path.exists(prev_path):
+        cache = {(e['ino'], e['size'], e['mtime_ns']): e['sha256'] for e in read_checksums(prev_path)}
+    listing = scan_tree(snapshot_dir, workers=workers)
+    files = sorted(rel for rel, entry in listing.items() if entry.kind == KIND_FILE)
+    digests = {}
+    todo = []
+    for rel in files:
+        entry = listing[rel]
+        digest = cache.get((entry.ino, entry.size, entry.mtime_ns))
+        if digest is not None:
+            digests[rel] = digest
+            stats.reused += 1
+        else:
+            todo.append(rel)
+            stats.bytes_hashed += entry.size
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash") as pool:
+        for rel, digest in zip(todo, pool.map(file_hash, (os.path.join(snapshot_dir, r) for r in todo),
+                                              chunksize=16)):
+            digests[rel] = digest
+    stats.hashed = len(todo)
+    stats.files = len(files)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as out:
+        for rel in files:
+            entry = listing[rel]
+            out.write(json.dumps({'path': rel, 'size': entry.size, 'mtime_ns': entry.mtime_ns,
+                                  'ino': entry.ino, 'sha256': digests[rel]}, separators=(',', ':')) + "\n")
+    os.replace(tmp_path, out_path)
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+class VerifyReport:
+    """Итог проверки снимка: checked объектов, bytes прочитано, missing и corrupt - пути."""
+
+    def __init__(self, snapshot_dir):
+        self.snapshot = os.path.basename(snapshot_dir)
+        self.kind = None
+        self.checked = 0
+        self.bytes = 0
+        self.missing = []
+        self.corrupt = []
+        self.skipped = None         # причина, по которой снимок не проверялся
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return not self.missing and not self.corrupt and self.skipped is None
+
+    def __str__(self):
+        if self.skipped is not None:
+            return f"{self.snapshot}: not verified ({self.skipped})"
+        speed = self.bytes / self.elapsed / 1e6 if self.elapsed else 0
+        state = "OK" if self.ok else f"{len(self.missing)} missing, {len(self.corrupt)} corrupt"
+        return (f"{self.snapshot} ({self.kind}): {state}; {self.checked} checked, {self.bytes} bytes read "
+                f"in {self.elapsed:.1f} s ({speed:.1f} MB/s)")
+
+
+def _hash_chunk(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None, 0
+    return hashlib.sha256(data).hexdigest(), len(data)
+
+
+def verify_snapshot(snapshot_dir, workers=COPY_WORKERS, seen=None):
+    """Проверить снимок. seen - общий между снимками словарь уже прочитанного."""
+    started = time.monotonic()
+    report = VerifyReport(snapshot_dir)
+    seen = {} if seen is None else seen
+    backup_dir = os.path.dirname(snapshot_dir.rstrip(os.sep))
+    if is_chunked(snapshot_dir):
+        report.kind = 'chunked'
+        _verify_chunks(snapshot_dir, backup_dir, workers, seen, report)
+    elif any(name.startswith(ARCHIVE_NAME) for name in os.listdir(snapshot_dir)):
+        report.kind = 'archive'
+        _verify_archive(snapshot_dir, report)
+    else:
+        report.kind = 'tree'
+        path = checksum_path(backup_dir, report.snapshot)
+        if os.path.exists(path):
+            _verify_tree(snapshot_dir, path, workers, seen, report)
+        else:
+            report.skipped = "no checksum manifest"
+    report.elapsed = time.monotonic() - started
+    return report
+
+
+def _verify_tree(snapshot_dir, manifest, workers, seen, report):
+    expected = {}           # inode -> [(путь, sha256)]
+    todo = []
+    for entry in read_checksums(manifest):
+        path = os.path.join(snapshot_dir, entry['path'])
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            report.missing.append(entry['path'])
+            continue
+        if st.st_size != entry['size']:
+            report.corrupt.append(entry['path'])
+            continue
+        report.checked += 1
+        key = ('ino', st.st_dev, st.st_ino)
+        if key not in seen and key not in expected:
+            todo.append((key, path))
+            report.bytes += st.st_size
+        expected.setdefault(key, []).append((entry['path'], entry['sha256']))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify") as pool:
+        for (key, _), digest in zip(todo, pool.map(_safe_hash, (p for _, p in todo), chunksize=16)):
+            seen[key] = digest
+    for key, files in expected.items():
+        actual = seen[key]
+        for rel, digest in files:
+            if actual != digest:
+                report.corrupt.append(rel)
+
+
+def _safe_hash(path):
+    try:
+        return file_hash(path)
+    except OSError as e:
+        logging.error(f"Cannot read {path}: {e}")
+        return None
+
+
+def _verify_chunks(snapshot_dir, backup_dir, workers, seen, report):
+    store = ChunkStore(backup_dir)
+    try:
+        entries = list(read_manifest(os.path.join(snapshot_dir, MANIFEST_NAME)))
+        sizes = {}
+        for entry in entries:
+            for cid, size in entry.get('chunks', ()):
+                sizes[cid] = size
+        todo = [cid for cid in sizes if ('chunk', cid) not in seen]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify") as pool:
+            for cid, (digest, size) in zip(todo, pool.map(_hash_chunk, (store.path(c) for c in todo),
+                                                          chunksize=16)):
+                report.bytes += size
+                seen[('chunk', cid)] = 'missing' if digest is None \
+                    else 'ok' if digest == cid and size == sizes[cid] else 'corrupt'
+    finally:
+        store.close()
+    report.checked = len(sizes)
+    for entry in entries:
+        states = {seen[('chunk', cid)] for cid, _ in entry.get('chunks', ())}
+        if 'missing' in states:
+            report.missing.append(entry['path'])
+        elif 'corrupt' in states:
+            report.corrupt.append(entry['path'])
+
+
+def open_archive(snapshot_dir):
+    """tarfile для чтения архива снимка подряд (режим 'r|')."""
+    name = next(n for n in sorted(os.listdir(snapshot_dir)) if n.startswith(ARCHIVE_NAME))
+    path = os.path.join(snapshot_dir, name)
+    if name.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError("zstd archives require the 'zstandard' package")
+        raw = open(path, 'rb')
+        stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        return tarfile.open(fileobj=io.BufferedReader(stream, HASH_CHUNK), mode='r|')
+    # Не 'r|gz': потоковый gzip в tarfile не читает склеенные gzip-члены
+    return tarfile.open(path, 'r:*')
+
+
+def _verify_archive(snapshot_dir, report):
+    try:
+        with open_archive(snapshot_dir) as tar:
+            for member in tar:
+                report.checked += 1
+                if member.isfile():
+                    f = tar.extractfile(member)
+                    while True:
+                        data = f.read(HASH_CHUNK)
+                        if not data:
+                            break
+                        report.bytes += len(data)
+                tar.members.clear()
+            # tar заканчивается нулевыми блоками раньше потока: CRC последнего
+            # блока кодека проверяется только при чтении до конца
+            while tar.fileobj.read(HASH_CHUNK):
+                pass
+    except ARCHIVE_ERRORS as e:
+        report.corrupt.append(f"{report.snapshot}: {e}")
+